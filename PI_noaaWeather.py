@@ -48,9 +48,11 @@ import socket
 import threading
 import subprocess
 import os
+from collections import deque
 from datetime import datetime
 
-from noaweather import EasyDref, Conf, c, EasyCommand, Tracker
+from noaweather import EasyDref, Conf, c, EasyCommand, Tracker, Corridor, Tile, WindProfile, Transitions, \
+    FrameScheduler, Handoff, Snapshot, CloudSolver, RequestPolicy
 
 
 class Weather:
@@ -58,7 +60,7 @@ class Weather:
 
     alt = 0.0
     ref_winds = {}
-    lat, lon, last_lat, last_lon = 99, 99, False, False
+    lat, lon = 99, 99
 
     def __init__(self, conf, data):
 
@@ -68,6 +70,7 @@ class Weather:
 
         '''
         Bind datarefs
+        Per frame datarefs are shadowed to skip unchanged writes
         '''
         self.winds = []
         self.clouds = []
@@ -76,11 +79,11 @@ class Weather:
         for i in range(3):
             self.winds.append({
                 'alt': EasyDref('"sim/weather/wind_altitude_msl_m[%d]"' % (i), 'float'),
-                'hdg': EasyDref('"sim/weather/wind_direction_degt[%d]"' % (i), 'float'),
-                'speed': EasyDref('"sim/weather/wind_speed_kt[%d]"' % (i), 'float'),
-                'gust': EasyDref('"sim/weather/shear_speed_kt[%d]"' % (i), 'float'),
-                'gust_hdg': EasyDref('"sim/weather/shear_direction_degt[%d]"' % (i), 'float'),
-                'turbulence': EasyDref('"sim/weather/turbulence[%d]"' % (i), 'float'),
+                'hdg': EasyDref('"sim/weather/wind_direction_degt[%d]"' % (i), 'float', shadow=True, epsilon=0.05),
+                'speed': EasyDref('"sim/weather/wind_speed_kt[%d]"' % (i), 'float', shadow=True, epsilon=0.05),
+                'gust': EasyDref('"sim/weather/shear_speed_kt[%d]"' % (i), 'float', shadow=True, epsilon=0.05),
+                'gust_hdg': EasyDref('"sim/weather/shear_direction_degt[%d]"' % (i), 'float', shadow=True),
+                'turbulence': EasyDref('"sim/weather/turbulence[%d]"' % (i), 'float', shadow=True, epsilon=0.01),
             })
 
         for i in range(3):
@@ -93,17 +96,21 @@ class Weather:
 
         self.windata = []
 
+        # Cloud slots solver
+        self.cloudSolver = CloudSolver()
+        self.cloudsReady = False
+
         self.xpWeatherOn = EasyDref('sim/weather/use_real_weather_bool', 'int')
         self.xpWeatherDownloadOn = EasyDref('sim/weather/download_real_weather', 'int')
-        self.msltemp = EasyDref('sim/weather/temperature_sealevel_c', 'float')
-        self.msldewp = EasyDref('sim/weather/dewpoi_sealevel_c', 'float')
+        self.msltemp = EasyDref('sim/weather/temperature_sealevel_c', 'float', shadow=True, epsilon=0.05)
+        self.msldewp = EasyDref('sim/weather/dewpoi_sealevel_c', 'float', shadow=True, epsilon=0.05)
         self.thermalAlt = EasyDref('sim/weather/thermal_altitude_msl_m', 'float')
-        self.visibility = EasyDref('sim/weather/visibility_reported_m', 'float')
-        self.pressure = EasyDref('sim/weather/barometer_sealevel_inhg', 'float')
+        self.visibility = EasyDref('sim/weather/visibility_reported_m', 'float', shadow=True)
+        self.pressure = EasyDref('sim/weather/barometer_sealevel_inhg', 'float', shadow=True)
 
-        self.precipitation = EasyDref('sim/weather/rain_percent', 'float')
-        self.thunderstorm = EasyDref('sim/weather/thunderstorm_percent', 'float')
-        self.runwayFriction = EasyDref('sim/weather/runway_friction', 'float')
+        self.precipitation = EasyDref('sim/weather/rain_percent', 'float', shadow=True)
+        self.thunderstorm = EasyDref('sim/weather/thunderstorm_percent', 'float', shadow=True)
+        self.runwayFriction = EasyDref('sim/weather/runway_friction', 'float', shadow=True)
 
         self.mag_deviation = EasyDref('sim/flightmodel/position/magnetic_variation', 'float')
 
@@ -111,20 +118,46 @@ class Weather:
 
         # Data
         self.weatherData = False
+        # Incremented on each weatherData or corridor response
+        self.generation = 0
         self.weatherClientThread = False
 
-        self.windAlts = -1
+        # Snapshots published by the client thread, and the data sequence applied by the flight loop
+        self.snapshots = Handoff()
+        self.dataSeq = 0
+        self.appliedSeq = 0
+        # Aircraft position set by the flight loop
+        self.position = (99, 99)
+
+        # Wind profile
+        self.windProfile = False
+        self.windValues = False
+        self.windOffset = [0, 0, 0]
+
+        # Transitions
+        self.transitions = Transitions()
+        self.trTurbulence = self.transitions.pattern('turbulence', Transitions.TURBULENCE)
+        self.trMetarWindHdg = self.transitions.pattern('metar_wind_hdg', Transitions.WIND)
+        self.trPressure = self.transitions.transition('pressure', Transitions.PRESSURE, speed=0.005)
+
+        # Weather requests position policy
+        self.requestPolicy = RequestPolicy()
 
         # Response queue for user queries
-        self.queryResponses = []
+        self.queryResponses = deque()
+
+        # Flight plan weather corridor
+        self.corridor = False
+        self.corridorRoute = []
+
+        # Grid tile for local interpolation
+        self.tile = False
+        self.tileRequested = 0
 
         # Create client socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
         self.die = threading.Event()
-        self.lock = threading.Lock()
-
-        self.newData = False
 
         self.startWeatherServer()
 
@@ -134,28 +167,142 @@ class Weather:
             self.weatherClientThread.start()
 
     def weatherClient(self):
-        """Weather client thread fetches weather from Weather Server"""
+        """Weather client thread fetches weather from Weather Server
+
+        Responses are decoded and preprocessed here, the flight loop only reads the published snapshots.
+        """
 
         # Send something for windows to bind
         self.weatherClientSend('!ping')
+        self.sock.settimeout(0.5)
 
         while True:
-            received = self.sock.recv(1024 * 8)
-            wdata = cPickle.loads(received)
-            if self.die.is_set() or wdata == '!bye':
+            try:
+                received = self.sock.recv(65535)
+            except socket.timeout:
+                received = False
+
+            if self.die.is_set():
                 break
-            elif not 'info' in wdata:
-                # A metar query response
-                self.queryResponses.append(wdata)
-            else:
-                self.weatherData = wdata
-                self.newData = True
+
+            if received and not self.handleResponse(cPickle.loads(received)):
+                break
+
+            self.updateSnapshot()
+
+    def handleResponse(self, wdata):
+        """Stores a decoded server response, returns False on server shutdown"""
+        if wdata == '!bye':
+            return False
+        elif 'corridor' in wdata:
+            self.corridor = Corridor.from_response(wdata)
+            self.generation += 1
+        elif 'tile' in wdata:
+            self.tile = Tile.from_response(wdata)
+        elif not 'info' in wdata:
+            # A metar query response
+            self.queryResponses.append(wdata)
+        else:
+            self.requestPolicy.received()
+            self.weatherData = wdata
+            self.dataSeq += 1
+            self.generation += 1
+        return True
+
+    def updateSnapshot(self):
+        """Publishes a new snapshot on new data or aircraft position change"""
+        wdata = self.weatherData
+        if not wdata:
+            return
+
+        lat, lon = self.position
+        tile = self.conf.use_tiles and self.tile
+        seq, last = self.snapshots.read()
+
+        corridor = self.corridor
+
+        # Interpolate the tile or look up the corridor again on position change (~500m)
+        if last and last.data_seq == self.dataSeq and last.tile is tile and last.corridor is corridor and (
+                not (tile or corridor) or (abs(last.lat - lat) < 0.005 and abs(last.lon - lon) < 0.005)):
+            return
+
+        gfs, wafs = self.tileData(wdata, tile, lat, lon)
+        if gfs is wdata['gfs']:
+            # Look ahead on the route without a tile
+            gfs, wafs = self.corridorData(wdata, corridor, lat, lon)
+
+        profile = False
+        if 'winds' in gfs and len(gfs['winds']):
+            profile = WindProfile.build(gfs['winds'], wdata['metar'], self.conf.metar_agl_limit)
+
+        self.snapshots.publish(Snapshot(self.dataSeq, wdata, tile, gfs, wafs, profile, lat, lon, corridor))
 
     def weatherClientSend(self, msg):
         if self.weatherClientThread:
-            self.sock.sendto(msg, ('127.0.0.1', self.conf.server_port))
+            self.sock.sendto(msg, (self.conf.server_address, self.conf.server_port))
+
+    def tileData(self, wdata, tile, lat, lon):
+        """Returns gfs and wafs data interpolated from the grid tile, or the point data if not available"""
+        if not tile or not tile.contains(lat, lon) or tile.info.get('gfs_cycle') != wdata['info']['gfs_cycle']:
+            return wdata['gfs'], wdata['wafs']
+
+        gfs = dict(wdata['gfs'])
+        gfs['winds'] = tile.winds(lat, lon)
+        gfs['pressure'] = tile.pressure_at(lat, lon) or gfs.get('pressure', False)
+
+        wafs = wdata['wafs']
+        if tile.turbulence_alts:
+            wafs = tile.turbulences(lat, lon)
+
+        return gfs, wafs
+
+    @staticmethod
+    def corridorData(wdata, corridor, lat, lon):
+        """Returns gfs and wafs data of the nearest corridor sample if closer than the point data position"""
+        info = wdata['info']
+        if not corridor or corridor.info.get('gfs_cycle') != info['gfs_cycle']:
+            return wdata['gfs'], wdata['wafs']
+
+        sample = corridor.nearest(lat, lon)
+        if (c.greatCircleDistance((lat, lon), (sample['lat'], sample['lon'])) >=
+                c.greatCircleDistance((lat, lon), (info['lat'], info['lon']))):
+            return wdata['gfs'], wdata['wafs']
+
+        gfs = dict(wdata['gfs'])
+        gfs['winds'] = corridor.winds(sample)
+        gfs['pressure'] = sample['pressure'] or gfs.get('pressure', False)
+
+        wafs = wdata['wafs']
+        if corridor.info.get('wafs_cycle') == info['wafs_cycle'] != 'na':
+            wafs = corridor.turbulences(sample)
+
+        return gfs, wafs
+
+    def requestCorridor(self, waypoints, spacing=20, vspacing=2000):
+        """Requests the weather along a route, spacing in nm and vspacing in ft"""
+        self.corridorRoute = waypoints
+        self.weatherClientSend('@%d|%d|%s' % (spacing, vspacing,
+                                              '|'.join(['%.2f,%.2f' % wpt for wpt in waypoints])))
+
+    def weatherServerRunning(self, timeout=0.3):
+        """Returns True if a weather server answers on the configured address"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(timeout)
+        try:
+            sock.sendto('!ping', (self.conf.server_address, self.conf.server_port))
+            return cPickle.loads(sock.recv(1024)) == '!pong'
+        except (socket.error, cPickle.UnpicklingError, EOFError):
+            return False
+        finally:
+            sock.close()
 
     def startWeatherServer(self):
+        if self.conf.server_shared and self.weatherServerRunning():
+            # Reuse the running shared server
+            print 'XPNoaaWeather: using shared weather server at %s:%d' % (self.conf.server_address,
+                                                                          self.conf.server_port)
+            return
+
         DETACHED_PROCESS = 0x00000008
         args = [self.conf.pythonpath, os.sep.join([self.conf.respath, 'weatherServer.py']), self.conf.syspath]
 
@@ -190,337 +337,101 @@ class Weather:
 
         # set turbulence
         turb *= 10 * self.conf.turbulence_probability
-        turb = c.randPattern('turbulence', turb, elapsed, 20, min_time=1)
+        turb = self.transitions.random(self.trTurbulence, turb, elapsed, 20, min_time=1)
 
         self.winds[0]['turbulence'].value = turb
         self.winds[1]['turbulence'].value = turb
         self.winds[2]['turbulence'].value = turb
 
-    def setWinds(self, winds, elapsed):
-        """Set winds: Interpolate layers and transition new data"""
-
-        winds = winds[:]
-
-        # Append metar layer
-        if 'metar' in self.weatherData and 'wind' in self.weatherData['metar']:
-            alt = self.weatherData['metar']['elevation']
-            hdg, speed, gust = self.weatherData['metar']['wind']
-            extra = {'gust': gust, 'metar': True}
-
-            if 'variable_wind' in self.weatherData['metar'] and self.weatherData['metar']['variable_wind']:
-
-                h1, h2 = self.weatherData['metar']['variable_wind']
-                h1 %= 360
-                if h1 > h2:
-                    var = 360 - h1 + h2
-                else:
-                    var = h2 - h1
-
-                hdg = h1
-                extra['variation'] = c.randPattern('metar_wind_hdg', var, elapsed, min_time=20, max_time=50)
-
-            alt += self.conf.metar_agl_limit
-            alt = c.transition(alt, '0-metar_wind_alt', elapsed, 0.3048)  # 1f/s
-
-            # Fix temperatures
-            if 'temperature' in self.weatherData['metar']:
-                if self.weatherData['metar']['temperature'][0] is not False:
-                    extra['temp'] = self.weatherData['metar']['temperature'][0] + 273.15
-                if self.weatherData['metar']['temperature'][1] is not False:
-                    extra['dew'] = self.weatherData['metar']['temperature'][1] + 273.15
-
-            # remove first wind layer if is too close (for high altitude airports)
-            # TODO: This can break transitions in some cases.
-            if len(winds) > 1 and winds[0][0] < alt + self.conf.metar_agl_limit:
-                winds.pop(0)
-
-            winds = [[alt, hdg, speed, extra]] + winds
-
-        # Search current top and bottom layer:
-        blayer = False
-        nlayers = len(winds)
-
-        if nlayers > 0:
-            for i in range(len(winds)):
-                tlayer = i
-                if winds[tlayer][0] > self.alt:
-                    break
-                else:
-                    blayer = i
-
-            if self.windAlts != tlayer:
-                # Layer change, reset transitions
-                self.windAlts = tlayer
-                c.transitionClearReferences(exclude=[str(blayer), str(tlayer)])
-
-            twind = self.transWindLayer(winds[tlayer], str(tlayer), elapsed)
-
-            if blayer is not False and blayer != tlayer:
-                # We are between 2 layers, interpolate
-                bwind = self.transWindLayer(winds[blayer], str(blayer), elapsed)
-                rwind = self.interpolateWindLayer(twind, bwind, self.alt, blayer)
-
-            else:
-                # We are below the first layer or above the last one.
-                rwind = twind;
-
-            # Set layers
-            self.setWindLayer(0, rwind, elapsed)
-            self.setWindLayer(1, rwind, elapsed)
-            self.setWindLayer(2, rwind, elapsed)
-
-            '''Set temperature and dewpoint.
-            Use next layer if the data is not available'''
-
-            extra = rwind[3]
-            if nlayers > tlayer + 1:
-                altLayer = winds[tlayer + 1]
-            else:
-                altLayer = False
-
-            if 'temp' in extra:
-                self.msltemp.value = c.oat2msltemp(extra['temp'] - 273.15, self.alt)
-            elif altLayer and 'temp' in altLayer[3]:
-                self.msltemp.value = c.oat2msltemp(altLayer[3]['temp'] - 273.15, altLayer[0])
-
-            if 'dew' in extra:
-                self.msldewp.value = c.oat2msltemp(extra['dew'] - 273.15, self.alt)
-            elif altLayer and 'dew' in altLayer[3]:
-                self.msldewp.value = c.oat2msltemp(altLayer[3]['dew'] - 273.15, altLayer[0])
-
-            # Force shear direction 0
-            self.winds[0]['gust_hdg'].value = 0
-            self.winds[1]['gust_hdg'].value = 0
-            self.winds[2]['gust_hdg'].value = 0
-
-    def setWindLayer(self, index, wlayer, elapsed):
-        alt, hdg, speed, extra = wlayer
-
-        wind = self.winds[index]
-
-        if 'variation' in extra:
-            hdg = (hdg + extra['variation']) % 360
-
-        wind['hdg'].value, wind['speed'].value = hdg, speed
-
-        if 'gust' in extra:
-            wind['gust'].value = extra['gust']
-
-    def transWindLayer(self, wlayer, id, elapsed):
-        """Transition wind layer values"""
-        alt, hdg, speed, extra = wlayer
-
-        hdg = c.transitionHdg(hdg, id + '-hdg', elapsed, self.conf.windHdgTransSpeed)
-        speed = c.transition(speed, id + '-speed', elapsed, self.conf.windHdgTransSpeed)
-
-        # Extra vars
-        for var in ['gust', 'rh', 'dew']:
-            if var in extra:
-                extra[var] = c.transition(extra[var], id + '-' + var, elapsed, self.conf.windGustTransSpeed)
-
-        # Special cases
-        if 'gust_hdg' in extra:
-            extra['gust_hdg'] = 0
-
-        return alt, hdg, speed, extra
-
-    def setDrefIfDiff(self, dref, value, max_diff=False):
-        """ Set a Dataref if the current value differs
-            Returns True if value was updated """
-
-        if max_diff is not False:
-            if abs(dref.value - value) > max_diff:
-                dref.value = value
-                return True
-        else:
-            if dref.value != value:
-                dref.value = value
-                return True
-        return False
-
-    def interpolateWindLayer(self, wlayer1, wlayer2, current_altitude, nlayer=1):
-        """Interpolates 2 wind layers
-        layer array: [alt, hdg, speed, extra]"""
-
-        if wlayer1[0] == wlayer2[0]:
-            return wlayer1
-
-        layer = [0, 0, 0, {}]
-
-        layer[0] = current_altitude
-
-        # weight heading interpolation using wind speed
-        if (wlayer1[2] != 0 or wlayer2[2] != 0):
-            expo = 2 * wlayer1[2] / (wlayer1[2] + wlayer2[2])
+    def setWindProfile(self, profile, reset=False):
+        """Sets a new wind profile, the difference with the current values is transitioned"""
+        values = self.windValues
+        if values and not reset:
+            new = profile.lookup(self.alt)
+            self.windOffset = [c.shortHdg(new[0], values[0]), values[1] - new[1], values[2] - new[2]]
         else:
-            expo = 1
-
-        if nlayer:
-            layer[1] = c.expoCosineInterpolateHeading(wlayer1[1], wlayer2[1], wlayer1[0], wlayer2[0],
-                                                      current_altitude, expo)
-            layer[2] = c.interpolate(wlayer1[2], wlayer2[2], wlayer1[0], wlayer2[0], current_altitude)
-        else:
-            # First layer
-            layer[1] = c.expoCosineInterpolateHeading(wlayer1[1], wlayer2[1], wlayer1[0], wlayer2[0],
-                                                      current_altitude, expo)
-            layer[2] = c.expoCosineInterpolate(wlayer1[2], wlayer2[2], wlayer1[0], wlayer2[0], current_altitude, expo)
-
-        if 'variation' not in wlayer1[3]:
-            wlayer1[3]['variation'] = 0
-
-        # Interpolate extras
-        for key in wlayer1[3]:
-            if key in wlayer2[3] and wlayer2[3][key] is not False:
-                if nlayer:
-                    layer[3][key] = c.interpolate(wlayer1[3][key], wlayer2[3][key], wlayer1[0], wlayer2[0],
-                                                  current_altitude)
-                else:
-                    layer[3][key] = c.expoCosineInterpolate(wlayer1[3][key], wlayer2[3][key], wlayer1[0], wlayer2[0],
-                                                            current_altitude)
-            else:
-                # Leave null temp and dew if we can't interpolate
-                if key not in ('temp', 'dew'):
-                    layer[3][key] = wlayer1[3][key]
-
-        return layer
-
-    def setClouds(self):
-
-        if 'clouds' in self.weatherData['gfs']:
-            gfsClouds = self.weatherData['gfs']['clouds']
-        else:
-            gfsClouds = []
-
-        # X-Plane cloud limits
-        minCloud = c.f2m(2000)
-        maxCloud = c.f2m(c.limit(40000, self.conf.max_cloud_height))
-
-        # Minimum redraw difference per layer
-        minRedraw = [c.f2m(500), c.f2m(5000), c.f2m(10000)]
-
-        xpClouds = {
-            'FEW': [1, c.f2m(2000)],
-            'SCT': [2, c.f2m(4000)],
-            'BKN': [3, c.f2m(4000)],
-            'OVC': [4, c.f2m(4000)],
-            'VV': [4, c.f2m(6000)]
-        }
-
-        lastBase = 0
-        maxTop = 0
-        gfsCloudLimit = c.f2m(5600)
-
-        setClouds = []
-
-        if self.weatherData and 'distance' in self.weatherData['metar'] \
-                and self.weatherData['metar']['distance'] < self.conf.metar_distance_limit \
-                and 'clouds' in self.weatherData['metar']:
-
-            clouds = self.weatherData['metar']['clouds'][:]
-
-            gfsCloudLimit += self.weatherData['metar']['elevation']
-
-            for cloud in reversed(clouds):
-                base, cover, extra = cloud
-                top = minCloud
-
-                if cover in xpClouds:
-                    top = base + xpClouds[cover][1]
-                    cover = xpClouds[cover][0]
-
-                # Search for gfs equivalent layer
-                for gfsCloud in gfsClouds:
-                    gfsBase, gfsTop, gfsCover = gfsCloud
-
-                    if gfsBase > 0 and gfsBase - 1500 < base < gfsTop:
-                        top = base + c.limit(gfsTop - gfsBase, maxCloud, minCloud)
-                        break
-
-                if lastBase and top > lastBase: top = lastBase
-                lastBase = base
-
-                setClouds.append([base, top, cover])
+            self.windOffset = [0, 0, 0]
+
+        self.windProfile = profile
+
+    def setWinds(self, elapsed):
+        """Set winds: Lookup the wind profile and transition new data"""
+
+        profile = self.windProfile
+        hdg, speed, gust, temp, dew, variation = profile.lookup(self.alt)
+
+        # Transition to new data
+        offset = self.windOffset
+        if offset[0] or offset[1] or offset[2]:
+            offset[0] = c.decay(offset[0], self.conf.windHdgTransSpeed * elapsed)
+            offset[1] = c.decay(offset[1], self.conf.windHdgTransSpeed * elapsed)
+            offset[2] = c.decay(offset[2], self.conf.windGustTransSpeed * elapsed)
+            hdg = (hdg + offset[0]) % 360
+            speed += offset[1]
+            gust += offset[2]
+
+        # METAR variable wind
+        if variation and profile.variation:
+            hdg = (hdg + variation * self.transitions.random(self.trMetarWindHdg, profile.variation, elapsed,
+                                                             min_time=20, max_time=50)) % 360
+
+        if not self.windValues:
+            self.windValues = [0, 0, 0]
+        self.windValues[0], self.windValues[1], self.windValues[2] = hdg, speed, gust
+
+        # Set layers
+        for wind in self.winds:
+            wind['hdg'].value, wind['speed'].value = hdg, speed
+            wind['gust'].value = gust
+            # Force shear direction 0
+            wind['gust_hdg'].value = 0
 
-                if not maxTop:
-                    maxTop = top
+        # Set temperature and dewpoint.
+        if temp is not None:
+            self.msltemp.value = temp
+        if dew is not None:
+            self.msldewp.value = dew
 
-            # add gfs clouds
-            for cloud in gfsClouds:
-                base, top, cover = cloud
+    def setClouds(self, wdata, reset=False):
+        """Solves the cloud layers for new data, changes are applied by applyClouds"""
+        solver = self.cloudSolver
 
-                if len(setClouds) < 3 and base > max(gfsCloudLimit, maxTop):
-                    cover = c.cc2xp(cover)
+        if reset or not self.cloudsReady:
+            # Start from the layers in x-plane
+            solver.reset([[cloud['bottom'].value, cloud['top'].value, cloud['coverage'].value]
+                          for cloud in self.clouds])
+            self.cloudsReady = True
 
-                    top = base + c.limit(top - base, maxCloud, minCloud)
-                    setClouds = [[base, top, cover]] + setClouds
+        layers = solver.merge(wdata, self.conf.max_cloud_height, self.conf.metar_distance_limit)
+        solver.solve(layers, self.alt)
 
-        else:
-            # GFS-only clouds
-            for cloud in reversed(gfsClouds):
-                base, top, cover = cloud
-                cover = c.cc2xp(cover)
-
-                if cover > 0 and base > 0 and top > 0:
-                    if cover < 3:
-                        top = base + minCloud
-                    else:
-                        top = base + c.limit(top - base, maxCloud, minCloud)
-
-                    if lastBase > top: top = lastBase
-                    setClouds.append([base, top, cover])
-                    lastBase = base
-
-        # Set the Cloud to Datarefs
-        redraw = 0
-        nClouds = len(setClouds)
-        setClouds = list(reversed(setClouds))
-
-        # Push up gfs clouds to prevent redraws
-        if nClouds:
-            if nClouds < 3 and setClouds[0][0] > gfsCloudLimit:
-                setClouds = [[0, minCloud, 0]] + setClouds
-            if 1 < len(setClouds) < 3 and setClouds[1][2] > gfsCloudLimit:
-                setClouds = [setClouds[0], [setClouds[0][2], setClouds[0][2] + minCloud, 0], setClouds[1]]
-
-        nClouds = len(setClouds)
-
-        if not self.data.override_clouds.value:
-            for i in range(3):
-                if nClouds > i:
-                    base, top, cover = setClouds[i]
-                    redraw += self.setDrefIfDiff(self.clouds[i]['bottom'], base, minRedraw[i] + self.alt / 10)
-                    redraw += self.setDrefIfDiff(self.clouds[i]['top'], top, minRedraw[i] + self.alt / 10)
-                    redraw += self.setDrefIfDiff(self.clouds[i]['coverage'], cover, 1)
-                else:
-                    redraw += self.setDrefIfDiff(self.clouds[i]['coverage'], 0)
+        if reset:
+            self.applyClouds(0, force=True)
 
         # Update datarefs
-        bases = []
-        tops = []
-        covers = []
-
-        for layer in setClouds:
-            base, top, cover = layer
-            bases.append(base)
-            tops.append(top)
-            covers.append(cover)
-
-        self.data.cloud_base.value = bases
-        self.data.cloud_top.value = tops
-        self.data.cloud_cover.value = covers
+        self.data.cloud_base.value = [layer[0] for layer in layers]
+        self.data.cloud_top.value = [layer[1] for layer in layers]
+        self.data.cloud_cover.value = [layer[2] for layer in layers]
+
+    def applyClouds(self, elapsed, force=False):
+        """Applies the scheduled cloud changes"""
+        if self.data.override_clouds.value:
+            return
+
+        changes = self.cloudSolver.step(self.alt, elapsed, force)
+        for slot, (base, top, cover) in changes:
+            self.clouds[slot]['bottom'].value = base
+            self.clouds[slot]['top'].value = top
+            self.clouds[slot]['coverage'].value = cover
+
+        if changes:
+            print 'XPNoaaWeather: cloud redraw #%d at %dft, slots: %s' % (
+                self.cloudSolver.redraws, c.m2ft(self.alt),
+                ' '.join(['%d:%d-%dft/%d' % (slot, c.m2ft(base), c.m2ft(top), cover)
+                          for slot, (base, top, cover) in changes]))
 
     def setPressure(self, pressure, elapsed):
-        c.datarefTransition(self.pressure, pressure, elapsed, 0.005)
-
-    @classmethod
-    def cc2xp(self, cover):
-        # Cloud cover to X-plane
-        xp = cover / 100.0 * 4
-        if xp < 1 and cover > 0:
-            xp = 1
-        elif cover > 89:
-            xp = 4
-        return xp
+        self.transitions.dataref(self.trPressure, self.pressure, pressure, elapsed)
 
 
 class Data:
@@ -568,6 +479,14 @@ class Data:
         self.turbulence_alt = EasyDref('xjpc/XPNoaaWeather/weather/turbulence_alt[16]', 'float', register=True)
         self.turbulence_sev = EasyDref('xjpc/XPNoaaWeather/weather/turbulence_sev[16]', 'float', register=True)
 
+        self.nicing = EasyDref('xjpc/XPNoaaWeather/weather/wafs_nicing', 'int', register=True)
+        self.icing_alt = EasyDref('xjpc/XPNoaaWeather/weather/icing_alt[16]', 'float', register=True)
+        self.icing_sev = EasyDref('xjpc/XPNoaaWeather/weather/icing_sev[16]', 'float', register=True)
+
+        self.cb_extent = EasyDref('xjpc/XPNoaaWeather/weather/cb_extent', 'float', register=True)
+        self.cb_base = EasyDref('xjpc/XPNoaaWeather/weather/cb_base', 'float', register=True)
+        self.cb_top = EasyDref('xjpc/XPNoaaWeather/weather/cb_top', 'float', register=True)
+
         # Metar variables
         self.metar_temperature = EasyDref('xjpc/XPNoaaWeather/weather/metar_temperature', 'float', register=True)
         self.metar_dewpoint = EasyDref('xjpc/XPNoaaWeather/weather/metar_dewpoint', 'float', register=True)
@@ -577,6 +496,21 @@ class Data:
         self.metar_thunderstorm = EasyDref('xjpc/XPNoaaWeather/weather/metar_thunderstorm', 'int', register=True)
         self.metar_runwayFriction = EasyDref('xjpc/XPNoaaWeather/weather/metar_runwayFriction', 'float', register=True)
 
+        # Performance datarefs {name: (mean, max)}
+        self.perf = {}
+
+    def registerPerf(self, names):
+        """Registers rolling mean and max timing datarefs in ms for each name"""
+        for name in names:
+            self.perf[name] = (EasyDref('xjpc/XPNoaaWeather/perf/%s_mean_ms' % name, 'float', register=True),
+                               EasyDref('xjpc/XPNoaaWeather/perf/%s_max_ms' % name, 'float', register=True))
+
+    def updatePerf(self, histograms):
+        """Publish the rolling timings"""
+        for name, (mean, max) in self.perf.items():
+            if name in histograms:
+                mean.value, max.value = [value * 1000 for value in histograms[name].rolling()]
+
     def updateData(self, wdata):
         """Publish raw Dataref data
         some data is published elsewhere
@@ -623,13 +557,24 @@ class Data:
 
                 turb_fl = []
                 turb_sev = []
-                for layer in wdata['wafs']:
+                for layer in wdata['wafs'][:16]:
                     turb_fl.append(layer[0])
-                    turb_fl.append(layer[1])
+                    turb_sev.append(layer[1])
+
+                self.nturbulence.value = len(turb_fl)
+                self.turbulence_alt.value = turb_fl
+                self.turbulence_sev.value = turb_sev
 
-                self.nturbulence = len(turb_fl)
-                self.turbulence_alt = turb_fl
-                self.turbulence_sev = turb_sev
+            if 'icing' in wdata:
+                icing = wdata['icing'][:16]
+                self.nicing.value = len(icing)
+                self.icing_alt.value = [layer[0] for layer in icing]
+                self.icing_sev.value = [layer[1] for layer in icing]
+
+            cb = wdata.get('cb', {})
+            self.cb_extent.value = cb.get('extent', 0)
+            self.cb_base.value = cb.get('base', 0)
+            self.cb_top.value = cb.get('top', 0)
 
 
 class PythonInterface:
@@ -648,9 +593,30 @@ class PythonInterface:
         self.latdr = EasyDref('sim/flightmodel/position/latitude', 'double')
         self.londr = EasyDref('sim/flightmodel/position/longitude', 'double')
         self.altdr = EasyDref('sim/flightmodel/position/elevation', 'double')
+        self.agldr = EasyDref('sim/flightmodel/position/y_agl', 'float')
+        self.gsdr = EasyDref('sim/flightmodel/position/groundspeed', 'float')
 
         self.data = Data(self)
         self.weather = Weather(self.conf, self.data)
+        self.snapshot = None
+
+        # Flight loop tasks: status and server communication are deferred on long frames
+        self.scheduler = FrameScheduler()
+        self.scheduler.add('status', self.floopStatus, self.conf.status_refresh_rate, FrameScheduler.LOW)
+        self.scheduler.add('queries', self.floopQueries, 0.2, FrameScheduler.LOW)
+        self.scheduler.add('tracker', self.floopTracker, 60, FrameScheduler.LOW)
+        self.scheduler.add('requests', self.floopRequests, 0.5, FrameScheduler.LOW)
+        self.scheduler.add('newData', self.floopNewData, FrameScheduler.ON_DATA, budget=0.005)
+        self.scheduler.add('clouds', self.floopClouds, 1)
+        self.scheduler.add('pressure', self.floopPressure, 0.1)
+        self.scheduler.add('winds', self.floopWinds)
+        self.scheduler.add('turbulence', self.floopTurbulence, 0.1)
+
+        # Optional timing datarefs
+        if self.conf.profiling:
+            self.data.registerPerf(['frame', 'status', 'newData', 'setClouds', 'updateData', 'clouds', 'pressure',
+                                    'winds', 'turbulence'])
+            self.scheduler.add('perf', self.floopPerf, 1, FrameScheduler.LOW)
 
         # floop
         self.floop = self.floopCallback
@@ -672,13 +638,15 @@ class PythonInterface:
                                           description="Toggle METAR query window.")
 
         # Flightloop counters
-        self.flcounter = 0
         self.fltime = 1
-        self.lastParse = 0
+        self.lastRouteCheck = 0
 
         self.newAptLoaded = False
 
         self.aboutlines = 26
+        # Status lines pushed to the widgets and weather data lines cache per generation
+        self.statusLines = []
+        self.statusCache = (-1, [])
 
         # Tracker
         self.tracker = Tracker(self.conf, 4, 'http://x-plane.joanpc.com/NOAAWeather')
@@ -857,6 +825,7 @@ class PythonInterface:
 
         # Create status captions
         self.statusBuff = []
+        self.statusLines = []
         for i in range(self.aboutlines):
             y -= 15
             self.statusBuff.append(XPCreateWidget(x, y, x + 40, y - 20, 1, '--', 0, window, xpWidgetClass_Caption))
@@ -980,7 +949,9 @@ class PythonInterface:
                 # Zero turbulence data if disabled
                 self.conf.set_turb = XPGetWidgetProperty(self.turbCheck, xpProperty_ButtonState, None)
                 if not self.conf.set_turb:
-                    for i in range(3): self.weather.winds[i]['turbulence'].value = 0
+                    for i in range(3):
+                        self.weather.winds[i]['turbulence'].invalidate()
+                        self.weather.winds[i]['turbulence'].value = 0
 
                 self.conf.download = XPGetWidgetProperty(self.downloadCheck, xpProperty_ButtonState, None)
 
@@ -1025,7 +996,7 @@ class PythonInterface:
                 self.aboutWindowUpdate()
 
                 # Reset things
-                self.weather.newData = True
+                self.weather.appliedSeq = -1
                 self.newAptLoaded = True
 
                 return 1
@@ -1051,18 +1022,35 @@ class PythonInterface:
     def updateStatus(self):
         '''Updates status window'''
 
-        sysinfo = self.weatherInfo()
+        sysinfo = self.weatherInfo()[:self.aboutlines]
 
-        i = 0
-        for label in sysinfo:
-            XPSetWidgetDescriptor(self.statusBuff[i], label)
-            i += 1
-            if i > self.aboutlines - 1:
-                break
+        # Only push changed captions
+        lines = self.statusLines
+        for i, label in enumerate(sysinfo):
+            if i >= len(lines) or lines[i] != label:
+                XPSetWidgetDescriptor(self.statusBuff[i], label)
+        self.statusLines = sysinfo
 
     def weatherInfo(self):
         """Return an array of strings with formatted weather data"""
 
+        # Weather data lines are formatted once per data generation
+        if self.statusCache[0] != self.weather.generation:
+            self.statusCache = (self.weather.generation, self.weatherDataInfo())
+
+        sysinfo = list(self.statusCache[1])
+
+        wdata = self.weather.weatherData
+        if wdata and 'info' in wdata:
+            sysinfo[1] = '    LAT: %.2f/%.2f LON: %.2f/%.2f FL: %02.f MAGNETIC DEV: %.2f' % (
+                self.latdr.value, wdata['info']['lat'], self.londr.value, wdata['info']['lon'],
+                c.m2ft(self.altdr.value) / 100, self.weather.mag_deviation.value)
+
+        return sysinfo
+
+    def weatherDataInfo(self):
+        """Return an array of strings with formatted weather data, the position line is left empty"""
+
         if not self.weather.weatherData:
             sysinfo = ['Data not ready. Please wait.']
         else:
@@ -1070,9 +1058,7 @@ class PythonInterface:
             if 'info' in wdata:
                 sysinfo = [
                     'XPNoaaWeather %s Status:' % self.conf.__VERSION__,
-                    '    LAT: %.2f/%.2f LON: %.2f/%.2f FL: %02.f MAGNETIC DEV: %.2f' % (
-                        self.latdr.value, wdata['info']['lat'], self.londr.value, wdata['info']['lon'],
-                        c.m2ft(self.altdr.value) / 100, self.weather.mag_deviation.value),
+                    '',
                     '    GFS Cycle: %s' % (wdata['info']['gfs_cycle']),
                     '    WAFS Cycle: %s' % (wdata['info']['wafs_cycle']),
                 ]
@@ -1152,6 +1138,22 @@ class PythonInterface:
 
                 sysinfo += ['WAFS TURBULENCE: FL|SEV %d' % (len(wdata['wafs'])), tblayers]
 
+            if wdata.get('icing') or wdata.get('cb'):
+                iclayers = ''
+                for alt, sev in wdata.get('icing', []):
+                    if sev > 0:
+                        iclayers += '   %03d|%.1f ' % (alt * 3.28084 / 100, sev)
+                cb = wdata.get('cb', {})
+                if cb:
+                    iclayers += '   CB %d%% FL%03d-%03d' % (cb['extent'], cb.get('base', 0) * 3.28084 / 100,
+                                                          cb.get('top', 0) * 3.28084 / 100)
+                sysinfo += ['WAFS ICING: FL|SEV' + iclayers]
+
+            if self.weather.corridor:
+                corridor = self.weather.corridor
+                sysinfo += ['ROUTE CORRIDOR: %d samples %dnm' % (len(corridor.samples),
+                                                                 corridor.samples[-1]['distance'] / 1852)]
+
         sysinfo += ['--'] * (self.aboutlines - len(sysinfo))
 
         return sysinfo
@@ -1297,6 +1299,16 @@ class PythonInterface:
         else:
             self.createMetarWindow()
 
+    def getFlightPlan(self):
+        """Returns the FMS flight plan waypoints [(lat, lon), ]"""
+        waypoints = []
+        for i in range(XPLMCountFMSEntries()):
+            outType, outID, outRef, outAltitude, outLat, outLon = [], [], [], [], [], []
+            XPLMGetFMSEntryInfo(i, outType, outID, outRef, outAltitude, outLat, outLon)
+            if outLat and outLon:
+                waypoints.append((round(outLat[0], 2), round(outLon[0], 2)))
+        return waypoints
+
     def dumpLog(self):
         """Dumps all the information to a file to report bugs"""
 
@@ -1331,7 +1343,7 @@ class PythonInterface:
 
         pprint(self.weather.weatherData, f, width=160)
         f.write('\n--- Transition data Data --- \n')
-        pprint(c.transrefs, f, width=160)
+        pprint(self.weather.transitions.dump(), f, width=160)
 
         f.write('\n--- Weather Datarefs --- \n')
         # Dump winds datarefs
@@ -1357,6 +1369,16 @@ class PythonInterface:
         vars['altitude'] = self.altdr.value
         pprint(vars, f, width=160)
 
+        f.write('\n--- Cloud solver ---\n')
+        pprint(self.weather.cloudSolver.dump(), f, width=160)
+
+        f.write('\n--- Dataref writes ---\n')
+        pprint(EasyDref.writeStats(), f, width=160)
+
+        f.write('\n--- Flight loop tasks (ms) ---\n')
+        pprint(self.scheduler.report(), f, width=160)
+        f.write('\n%s\n' % self.scheduler.histogram())
+
         f.write('\n--- Overrides ---\n')
 
         vars = {}
@@ -1398,125 +1420,180 @@ class PythonInterface:
     def floopCallback(self, elapsedMe, elapsedSim, counter, refcon):
         """Flight Loop Callback"""
 
-        # Update status window
+        # Store altitude
+        self.weather.alt = self.altdr.value
+
+        # Last weather snapshot published by the client thread
+        seq, self.snapshot = self.weather.snapshots.read()
+        if self.snapshot and self.snapshot.data_seq != self.weather.appliedSeq:
+            self.scheduler.trigger('newData')
+
+        self.scheduler.run(elapsedMe)
+
+        return -1
+
+    def floopStatus(self, elapsed):
+        """Update status window"""
         if self.aboutWindow and XPIsWidgetVisible(self.aboutWindowWidget):
             self.updateStatus()
 
-        # Handle server misc requests
-        if len(self.weather.queryResponses):
-            msg = self.weather.queryResponses.pop()
+    def floopQueries(self, elapsed):
+        """Handle server misc requests"""
+        while len(self.weather.queryResponses):
+            msg = self.weather.queryResponses.popleft()
             if 'metar' in msg:
                 self.metarQueryCallback(msg)
 
-        ''' Return if the plugin is disabled '''
+    def floopTracker(self, elapsed):
         if not self.conf.enabled:
-            return -1
+            return
 
-        # tracker
-        self.last_track += elapsedMe
+        self.last_track += elapsed
         if (self.last_track > 60 * 15):
             self.tracker.track('running/FL%d0' % (c.m2ft(self.altdr.value) / 1000), 'running')
             self.last_track = 0
 
-        ''' Request new data from the weather server (if required)'''
-        self.flcounter += elapsedMe
-        self.fltime += elapsedMe
-        if self.flcounter > self.conf.parserate and self.weather.weatherClientThread:
-
-            lat, lon = round(self.latdr.value, 1), round(self.londr.value, 1)
-
-            # Request data on postion change, every 0.1 degree or 60 seconds
-            if (lat, lon) != (self.weather.last_lat, self.weather.last_lon) or (self.fltime - self.lastParse) > 60:
-                self.weather.last_lat, self.weather.last_lon = lat, lon
-
-                self.weather.weatherClientSend("?%.2f|%.2f\n" % (lat, lon))
-
-                self.flcounter = 0
-                self.lastParse = self.fltime
-
-        # Store altitude
-        self.weather.alt = self.altdr.value
-        wdata = self.weather.weatherData
-
-        ''' Return if there's no weather data'''
-        if self.weather.weatherData is False:
-            return -1
-
-        ''' Data set on new weather Data '''
-        if self.weather.newData:
-            rain, ts, friction = 0, 0, 0
-
-            # Clear transitions on airport load
-            if self.newAptLoaded:
-                c.transitionClearReferences()
-                c.randRefs = {}
-                self.newAptLoaded = False
-
-            # Set metar values
-            if 'visibility' in wdata['metar']:
-                visibility = c.limit(wdata['metar']['visibility'], self.conf.max_visibility)
-
-                if not self.data.override_visibility.value:
-                    self.weather.visibility.value = visibility
-
-                self.data.visibility.value = visibility
+    def floopRequests(self, elapsed):
+        """Request new data from the weather server (if required)"""
+        if not self.conf.enabled:
+            return
 
-            if 'precipitation' in wdata['metar']:
-                p = wdata['metar']['precipitation']
-                for precp in p:
-                    precip, wet = c.metar2xpprecipitation(precp, p[precp]['int'], p[precp]['int'], p[precp]['recent'])
+        lat, lon = self.latdr.value, self.londr.value
 
-                    if precip is not False:
-                        rain = precip
-                    if wet is not False:
-                        friction = wet
+        # Position for the client thread tile interpolation
+        self.weather.position = (lat, lon)
 
-                if 'TS' in p:
-                    ts = 0.5
-                    if p['TS']['int'] == '-':
-                        ts = 0.25
-                    elif p['TS']['int'] == '+':
-                        ts = 1
+        self.fltime += elapsed
+        if self.weather.weatherClientThread:
 
-            if not self.data.override_precipitation.value:
-                self.weather.thunderstorm.value = ts
-                self.weather.precipitation.value = rain
+            # Request data on postion change depending on height and speed, or every 60 seconds
+            policy = self.weather.requestPolicy
+            if policy.check(self.fltime, lat, lon, self.agldr.value, self.gsdr.value):
+                policy.send(self.fltime, lat, lon)
+                self.weather.weatherClientSend("?%.2f|%.2f\n" % (lat, lon))
 
-            self.data.metar_precipitation.value = rain
-            self.data.metar_thunderstorm.value = ts
+            # Request a new grid tile when leaving the current one
+            if self.conf.use_tiles:
+                tile = self.weather.tile
+                if (not tile or not tile.contains(lat, lon)) and (self.fltime - self.weather.tileRequested) > 5:
+                    self.weather.tileRequested = self.fltime
+                    self.weather.weatherClientSend('#%.2f|%.2f' % (lat, lon))
+
+            # Request the flight plan weather corridor on route change
+            if (self.fltime - self.lastRouteCheck) > 30:
+                self.lastRouteCheck = self.fltime
+                route = self.getFlightPlan()
+                if len(route) > 1 and route != self.weather.corridorRoute:
+                    self.weather.requestCorridor(route)
+
+    def floopNewData(self, elapsed):
+        """Data set on new weather Data"""
+        snapshot = self.snapshot
+        if not self.conf.enabled or not snapshot:
+            return
+        wdata = snapshot.wdata
+
+        rain, ts, friction = 0, 0, 0
+
+        # X-plane could have changed the shadowed datarefs
+        EasyDref.invalidateAll()
+
+        # Clear transitions on airport load
+        reset = self.newAptLoaded
+        if self.newAptLoaded:
+            self.weather.transitions.reset()
+            self.weather.windValues = False
+            self.newAptLoaded = False
+
+        # Set metar values
+        if 'visibility' in wdata['metar']:
+            visibility = c.limit(wdata['metar']['visibility'], self.conf.max_visibility)
+
+            if not self.data.override_visibility.value:
+                self.weather.visibility.value = visibility
+
+            self.data.visibility.value = visibility
+
+        if 'precipitation' in wdata['metar']:
+            p = wdata['metar']['precipitation']
+            for precp in p:
+                precip, wet = c.metar2xpprecipitation(precp, p[precp]['int'], p[precp]['int'], p[precp]['recent'])
+
+                if precip is not False:
+                    rain = precip
+                if wet is not False:
+                    friction = wet
+
+            if 'TS' in p:
+                ts = 0.5
+                if p['TS']['int'] == '-':
+                    ts = 0.25
+                elif p['TS']['int'] == '+':
+                    ts = 1
+
+        if not self.data.override_precipitation.value:
+            self.weather.thunderstorm.value = ts
+            self.weather.precipitation.value = rain
+
+        self.data.metar_precipitation.value = rain
+        self.data.metar_thunderstorm.value = ts
+
+        if not self.data.override_runway_friction.value:
+            self.weather.runwayFriction.value = friction
+
+        self.data.metar_runwayFriction.value = friction
+
+        self.weather.appliedSeq = snapshot.data_seq
+
+        # Set clouds
+        if self.conf.set_clouds:
+            with self.scheduler.phase('setClouds'):
+                self.weather.setClouds(wdata, reset)
+
+        # Update Dataref data
+        with self.scheduler.phase('updateData'):
+            self.data.updateData(wdata)
 
-            if not self.data.override_runway_friction.value:
-                self.weather.runwayFriction.value = friction
+    def floopPerf(self, elapsed):
+        self.data.updatePerf(self.scheduler.histograms())
 
-            self.data.metar_runwayFriction.value = friction
+    def enforcedData(self):
+        """Returns the snapshot to be enforced or False"""
+        if not self.conf.enabled or not self.snapshot:
+            return False
+        return self.snapshot
 
-            self.weather.newData = False
+    def floopClouds(self, elapsed):
+        if self.enforcedData() and self.conf.set_clouds:
+            self.weather.applyClouds(elapsed)
 
-            # Set clouds
-            if self.conf.set_clouds:
-                self.weather.setClouds()
+    def floopPressure(self, elapsed):
+        snapshot = self.enforcedData()
+        if not snapshot or self.data.override_pressure.value or not self.conf.set_pressure:
+            return
 
-            # Update Dataref data
-            self.data.updateData(wdata)
+        # Set METAR or GFS pressure
+        metar = snapshot.wdata['metar']
+        if 'pressure' in metar and metar['pressure'] is not False:
+            self.weather.setPressure(metar['pressure'], elapsed)
+        elif 'pressure' in snapshot.gfs:
+            self.weather.setPressure(snapshot.gfs['pressure'], elapsed)
 
-        ''' Data enforced/interpolated/transitioned on each cycle '''
-        if not self.data.override_pressure.value and self.conf.set_pressure:
-            # Set METAR or GFS pressure
-            if 'pressure' in wdata['metar'] and wdata['metar']['pressure'] is not False:
-                self.weather.setPressure(wdata['metar']['pressure'], elapsedMe)
-            elif self.conf.set_pressure and 'pressure' in wdata['gfs']:
-                self.weather.setPressure(wdata['gfs']['pressure'], elapsedMe)
+    def floopWinds(self, elapsed):
+        snapshot = self.enforcedData()
+        if not snapshot or not snapshot.profile or self.data.override_winds.value or not self.conf.set_wind:
+            return
 
-        # Set winds
-        if not self.data.override_winds.value and self.conf.set_wind and 'winds' in wdata['gfs'] and len(
-                wdata['gfs']['winds']):
-            self.weather.setWinds(wdata['gfs']['winds'], elapsedMe)
+        if snapshot.profile is not self.weather.windProfile:
+            self.weather.setWindProfile(snapshot.profile)
+        self.weather.setWinds(elapsed)
 
-        # Set turbulence
-        if not self.data.override_turbulence.value and self.conf.set_turb:
-            self.weather.setTurbulence(wdata['wafs'], elapsedMe)
+    def floopTurbulence(self, elapsed):
+        data = self.enforcedData()
+        if not data or self.data.override_turbulence.value or not self.conf.set_turb:
+            return
 
-        return -1
+        self.weather.setTurbulence(data.wafs, elapsed)
 
     def XPluginStop(self):
         self.tracker.track('stop', 'stop x-plane')
@@ -1541,6 +1618,8 @@ class PythonInterface:
         EasyDref.cleanup()
 
     def XPluginEnable(self):
+        # Publish the plugin datarefs
+        EasyDref.registerPending()
         return 1
 
     def XPluginDisable(self):
@@ -1549,6 +1628,7 @@ class PythonInterface:
     def XPluginReceiveMessage(self, inFromWho, inMessage, inParam):
         if inParam == XPLM_PLUGIN_XPLANE and inMessage == XPLM_MSG_AIRPORT_LOADED:
             self.weather.startWeatherClient()
+            self.weather.requestPolicy.reset()
             self.newAptLoaded = True
         elif inMessage == (0x8000000 | 8090) and inParam == 1:
             # inSimUpdater wants to shutdown
@@ -9,17 +9,34 @@ class EasyDref:
     Easy Dataref access
 
     Copyright (C) 2011  Joan Perez i Cauhe
+
+    Shadow mode keeps the last written value and skips the SDK write if the new
+    value is within epsilon. Array writes only send the changed range.
+
+    Registered datarefs are published in a single pass by registerPending().
     '''
 
     datarefs = []
+    pending = []
+    shadowed = []
     plugin = False
 
-    def __init__(self, dataref, type="float", register=False, writable=False):
+    # SDK write counters
+    writes = 0
+    avoided = 0
+
+    def __init__(self, dataref, type="float", register=False, writable=False, shadow=False, epsilon=0):
         # Clear dataref
         dataref = dataref.strip()
         self.isarray, dref = False, False
         self.register = register
 
+        self.shadow = shadow and not register
+        self.epsilon = epsilon
+        self.shadowValue = None
+        if self.shadow:
+            self.__class__.shadowed.append(self)
+
         if ('"' in dataref):
             dref = dataref.split('"')[1]
             dataref = dataref[dataref.rfind('"') + 1:]
@@ -72,17 +89,9 @@ class EasyDref:
                 if writable: self.setCB = self.set_cb
                 self.getCB = self.get_cb
 
-            self.DataRef = XPLMRegisterDataAccessor(self.plugin, dataref, self.dr_type,
-                                                    writable,
-                                                    self.getCB, self.setCB,
-                                                    self.getCB, self.setCB,
-                                                    self.getCB, self.setCB,
-                                                    self.rgetCB, self.rsetCB,
-                                                    self.rgetCB, self.rsetCB,
-                                                    self.rgetCB, self.rsetCB,
-                                                    0, 0)
-
-            self.__class__.datarefs.append(self)
+            self.writable = writable
+            self.DataRef = False
+            self.__class__.pending.append(self)
 
             # Local shortcut
             self.set = self.set_f
@@ -129,11 +138,48 @@ class EasyDref:
         pass
 
     def set(self, value):
+        if self.shadow:
+            return self.set_shadow(value)
+        EasyDref.writes += 1
         if self.isarray:
             self.rset(self.DataRef, value, self.index, len(value))
         else:
             self.dr_set(self.DataRef, self.cast(value))
 
+    def set_shadow(self, value):
+        last = self.shadowValue
+        epsilon = self.epsilon
+
+        if self.isarray:
+            first, end = 0, len(value)
+            if last is not None and len(last) == end:
+                # Find the changed range
+                while first < end and abs(value[first] - last[first]) <= epsilon:
+                    first += 1
+                while end > first and abs(value[end - 1] - last[end - 1]) <= epsilon:
+                    end -= 1
+                if first == end:
+                    EasyDref.avoided += 1
+                    return
+            EasyDref.writes += 1
+            self.rset(self.DataRef, [self.cast(v) for v in value[first:end]], self.index + first, end - first)
+            if last is not None and len(last) == len(value):
+                # Keep the written values only, changes below epsilon can accumulate
+                last[first:end] = value[first:end]
+            else:
+                self.shadowValue = list(value)
+        else:
+            if last is not None and abs(value - last) <= epsilon:
+                EasyDref.avoided += 1
+                return
+            EasyDref.writes += 1
+            self.dr_set(self.DataRef, self.cast(value))
+            self.shadowValue = value
+
+    def invalidate(self):
+        """Forces the next write, used when x-plane could have changed the value"""
+        self.shadowValue = None
+
     def get(self):
         if (self.isarray):
             list = []
@@ -202,6 +248,32 @@ class EasyDref:
         else:
             self.__dict__[name] = value
 
+    @classmethod
+    def invalidateAll(cls):
+        for dataref in cls.shadowed:
+            dataref.shadowValue = None
+
+    @classmethod
+    def writeStats(cls):
+        """Returns SDK writes and avoided writes of shadowed datarefs"""
+        return {'writes': cls.writes, 'avoided': cls.avoided}
+
+    @classmethod
+    def registerPending(cls):
+        """Registers the datarefs created since the last call"""
+        for dataref in cls.pending:
+            dataref.DataRef = XPLMRegisterDataAccessor(cls.plugin, dataref.dataref, dataref.dr_type,
+                                                       dataref.writable,
+                                                       dataref.getCB, dataref.setCB,
+                                                       dataref.getCB, dataref.setCB,
+                                                       dataref.getCB, dataref.setCB,
+                                                       dataref.rgetCB, dataref.rsetCB,
+                                                       dataref.rgetCB, dataref.rsetCB,
+                                                       dataref.rgetCB, dataref.rsetCB,
+                                                       0, 0)
+            cls.datarefs.append(dataref)
+        del cls.pending[:]
+
     @classmethod
     def cleanup(cls):
         for dataref in cls.datarefs:
@@ -1,9 +1,54 @@
+import sys
+import types
+import importlib
+
 from noaweather.c import c
 from noaweather.conf import Conf
-from noaweather.weathersource import WeatherSource
-from noaweather.gfs import GFS
-from noaweather.metar import Metar
-from noaweather.wafs import WAFS
 from noaweather.EasyDref import EasyDref
 from noaweather.EasyDref import EasyCommand
 from noaweather.tracker import Tracker
+from noaweather.corridor import Corridor
+from noaweather.tile import Tile
+from noaweather.windprofile import WindProfile
+from noaweather.transition import Transitions
+from noaweather.scheduler import FrameScheduler
+from noaweather.handoff import Handoff, Snapshot
+from noaweather.clouds import CloudSolver
+from noaweather.requestpolicy import RequestPolicy
+
+# Weather server classes, imported on first use: the plugin doesn't need them
+LAZY = {'WeatherSource': 'weathersource',
+        'GFS': 'gfs',
+        'Metar': 'metar',
+        'WAFS': 'wafs',
+        'WAFSGrid': 'wafsgrid',
+        'JobScheduler': 'jobs',
+        'Executor': 'executor',
+        'CacheManager': 'cachemanager',
+        'StationIndex': 'stationindex',
+        'WarmStart': 'warmstart',
+        'ServerLog': 'serverlog',
+        }
+
+
+class LazyPackage(types.ModuleType):
+    """Package module importing the LAZY classes on first access"""
+
+    def __init__(self, package):
+        types.ModuleType.__init__(self, package.__name__, package.__doc__)
+        self.__dict__.update(package.__dict__)
+        # Keep the original module alive, python 2 clears the globals of collected modules
+        self.package = package
+
+    def __getattr__(self, name):
+        if name not in self.LAZY:
+            raise AttributeError(name)
+        value = getattr(importlib.import_module('%s.%s' % (self.__name__, self.LAZY[name])), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self.LAZY))
+
+
+sys.modules[__name__] = LazyPackage(sys.modules[__name__])
@@ -9,14 +9,10 @@ of the License, or any later version.
 """
 
 from math import hypot, atan2, degrees, exp, log, radians, sin, cos, sqrt, pi
-from random import random
 
 
 class c:
     """Unit conversion  and misc tools"""
-    # transition references
-    transrefs = {}
-    randRefs = {}
 
     @staticmethod
     def ms2knots(val):
@@ -73,6 +69,26 @@ class c:
         d = EARTH_RADIUS * c
         return d
 
+    @staticmethod
+    def greatCirclePoint(latlong_a, latlong_b, fraction):
+        """Return the intermediate point at fraction of the great circle path between 2 coordinate pairs"""
+        lat1, lon1 = radians(latlong_a[0]), radians(latlong_a[1])
+        lat2, lon2 = radians(latlong_b[0]), radians(latlong_b[1])
+
+        a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        delta = 2 * atan2(sqrt(a), sqrt(1 - a))
+        if delta == 0:
+            return latlong_a[0], latlong_a[1]
+
+        ka = sin((1 - fraction) * delta) / sin(delta)
+        kb = sin(fraction * delta) / sin(delta)
+
+        x = ka * cos(lat1) * cos(lon1) + kb * cos(lat2) * cos(lon2)
+        y = ka * cos(lat1) * sin(lon1) + kb * cos(lat2) * sin(lon2)
+        z = ka * sin(lat1) + kb * sin(lat2)
+
+        return degrees(atan2(z, hypot(x, y))), degrees(atan2(y, x))
+
     @staticmethod
     def interpolate(t1, t2, alt1, alt2, alt):
         if (alt2 - alt1) == 0:
@@ -189,124 +205,14 @@ class c:
     def pa2inhg(pa):
         return pa * 0.0002952998016471232
 
-    @classmethod
-    def datarefTransition(cls, dataref, new, elapsed, speed=0.25, id=False):
-        """Timed dataref transition"""
-
-        # Save reference to ignore x-plane roundings
-        if not id:
-            id = str(dataref.DataRef)
-        if id not in cls.transrefs:
-            cls.transrefs[id] = dataref.value
-
-        # Return if the value is already set
-        if cls.transrefs[id] == new:
-            return
-
-        current = cls.transrefs[id]
-
-        if current > new:
-            dir = -1
-        else:
-            dir = 1
-        if abs(current - new) > speed * elapsed + speed:
-            new = current + dir * speed * elapsed
-
-        cls.transrefs[id] = new
-        dataref.value = new
-
-    @classmethod
-    def transition(cls, new, id, elapsed, speed=0.25):
-        """Time based transition """
-        if not id in cls.transrefs:
-            cls.transrefs[id] = new
-            return new
-
-        current = cls.transrefs[id]
-
-        if current > new:
-            dir = -1
-        else:
-            dir = 1
-        if abs(current - new) > speed * elapsed + speed:
-            new = current + dir * speed * elapsed
-
-        cls.transrefs[id] = new
-
-        return new
-
-    @classmethod
-    def transitionClearReferences(cls, refs=False, exclude=False):
-        """Clear transition references"""
-        if exclude:
-            for ref in cls.transrefs.keys():
-                if ref.split('-')[0] not in exclude:
-                    cls.transrefs.pop(ref)
-            return
-
-        elif refs:
-            for ref in cls.transrefs.keys():
-                if ref.split('-')[0] in refs:
-                    cls.transrefs.pop(ref)
-        else:
-            cls.transrefs = {}
-
-    @classmethod
-    def transitionHdg(cls, new, id, elapsed, speed=0.25):
-        '''Time based wind heading transition '''
-
-        if not id in cls.transrefs:
-            cls.transrefs[id] = new
-            return new
-
-        current = cls.transrefs[id]
-
-        diff = c.shortHdg(current, float(new))
-
-        if abs(diff) < speed * elapsed:
-            newval = new
-        else:
-            if diff > 0:
-                diff = 1
-            else:
-                diff = -1
-            newval = current + diff * speed * elapsed
-            if newval < 0:
-                newval += 360
-            else:
-                newval %= 360
-
-        cls.transrefs[id] = newval
-        return newval
-
-    @classmethod
-    def datarefTransitionHdg(cls, dataref, new, elapsed, vel=1):
-        """Time based wind heading transition"""
-        id = str(dataref.DataRef)
-        if id not in cls.transrefs:
-            cls.transrefs[id] = dataref.value
-
-        if cls.transrefs[id] == new:
-            return
-
-        current = cls.transrefs[id]
-
-        diff = c.shortHdg(current, new)
-        if abs(diff) < vel * elapsed:
-            newval = new
-        else:
-            if diff > 0:
-                diff = +1
-            else:
-                diff = -1
-            newval = current + diff * vel * elapsed
-            if newval < 0:
-                newval += 360
-            else:
-                newval %= 360
-
-        cls.transrefs[id] = newval
-        dataref.value = newval
+    @staticmethod
+    def decay(value, step):
+        """Moves value towards 0 by step"""
+        if value > step:
+            return value - step
+        elif value < -step:
+            return value + step
+        return 0
 
     @staticmethod
     def limit(value, max=None, min=None):
@@ -440,35 +346,6 @@ class c:
         else:
             return int(round(value))
 
-    @classmethod
-    def randPattern(cls, id, max_val, elapsed, max_time=1, min_val=0, min_time=1, heading=False):
-        """ Creates random cosine interpolated "patterns" """
-
-        if id in cls.randRefs:
-            x1, x2, startime, endtime, time = cls.randRefs[id]
-        else:
-            x1, x2, startime, endtime, time = min_val, 0, 0, 0, 0
-
-        if heading:
-            ret = cls.cosineInterpolateHeading(x1, x2, startime, endtime, time)
-        else:
-            ret = cls.cosineInterpolate(x1, x2, startime, endtime, time)
-
-        time += elapsed
-
-        if time >= endtime:
-            # Init randomness
-            x2 = min_val + random() * (max_val - min_val)
-            t2 = min_time + random() * (max_time - min_time)
-
-            x1 = ret
-            startime = time
-            endtime = time + t2
-
-        cls.randRefs[id] = x1, x2, startime, endtime, time
-
-        return ret
-
     @staticmethod
     def middleHeading(hd1, hd2):
         if hd2 > hd1:
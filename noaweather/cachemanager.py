@@ -0,0 +1,196 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import os
+import re
+import threading
+import time
+
+from stats import stats
+from serverlog import log
+
+
+logger = log.logger('cache')
+
+
+class CacheEntry(object):
+    """Cached file"""
+
+    __slots__ = ('path', 'kind', 'size', 'mtime', 'atime')
+
+    def __init__(self, path, kind, size, mtime):
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        # Last use by the server, the file mtime until used
+        self.atime = mtime
+
+
+class CacheManager(object):
+    """Keeps an index of the cache directories and enforces size and age quotas
+
+    Files in use by the sources (current grib files, decoded grids, the METAR database) are never
+    removed. Files of cycles superseded by the current one are removed on the next enforce, the
+    rest when older than the directory max age or, least recently used first, when the directory
+    is over its quota.
+
+    The startup scan also discards partial downloads (.tmp) and undeletable files renamed to -N by
+    util.remove. Later scans only discard them when older than stale seconds.
+    """
+
+    RE_LEFTOVER = re.compile(r'(\.tmp|-[0-9]+)$')
+
+    def __init__(self):
+        self.dirs = {}
+        self.sources = []
+        self.index = {}
+        self.lock = threading.Lock()
+        self.stale = 3600
+        self.evicted = 0
+        self.discarded = 0
+
+    def configure(self, conf):
+        """Sets the cache directories quotas from the configuration
+
+        conf.cache_quota: {directory: [max size in MB, max age in hours], }, 0 for no limit
+        """
+        self.dirs = dict((name, (os.sep.join([conf.cachepath, name]), size * 1024 * 1024, age * 3600))
+                         for name, (size, age) in conf.cache_quota.items())
+        self.stale = conf.download_timeout
+
+    def add_source(self, source):
+        """Adds a source protecting its cache_files()"""
+        self.sources.append(source)
+
+    def register(self, scheduler):
+        scheduler.add('cache', self.enforce, lane='cache', delay=60, interval=600)
+
+    @staticmethod
+    def kind(name):
+        """Returns the artifact kind of a cached file name"""
+        if name.endswith(('.bin', '.json')):
+            return 'grid'
+        if name.endswith('.idx'):
+            return 'idx'
+        if name.endswith('.db'):
+            return 'db'
+        if name.endswith('.txt'):
+            return 'text'
+        return 'grib'
+
+    def active(self):
+        """Returns the set of files in use"""
+        files = set()
+        for source in self.sources:
+            files.update(os.path.normpath(path) for path in source.cache_files())
+        return files
+
+    def superseded(self):
+        """Returns the set of files of older cycles"""
+        files = set()
+        for source in self.sources:
+            files.update(os.path.normpath(path) for path in source.superseded_files())
+        return files
+
+    def touch(self, path):
+        """Records a file access"""
+        entry = self.index.get(os.path.normpath(path))
+        if entry:
+            entry.atime = time.time()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # In use, try again on the next scan
+            return False
+        self.index.pop(path, None)
+        return True
+
+    def scan(self, startup=False):
+        """Updates the index with the files on disk, discards partial and leftover files"""
+        now = time.time()
+        found = set()
+
+        for name, (path, quota, max_age) in self.dirs.items():
+            if not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                filepath = os.path.normpath(os.sep.join([path, filename]))
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                if not os.path.isfile(filepath):
+                    continue
+
+                if self.RE_LEFTOVER.search(filename) or not st.st_size:
+                    if startup or now - st.st_mtime > self.stale:
+                        if self.remove(filepath):
+                            logger.info('Cache: discarded %s' % filename)
+                            self.discarded += 1
+                            continue
+
+                found.add(filepath)
+                entry = self.index.get(filepath)
+                if entry and entry.mtime == st.st_mtime:
+                    continue
+                self.index[filepath] = CacheEntry(filepath, self.kind(filename), st.st_size, st.st_mtime)
+
+        for filepath in set(self.index) - found:
+            self.index.pop(filepath)
+
+    def enforce(self, startup=False):
+        """Scans the cache and removes files over the age and size quotas"""
+        with self.lock, stats.timer('cache_scan'):
+            self.scan(startup)
+            active = self.active()
+            superseded = self.superseded() - active
+            now = time.time()
+
+            for name, (path, quota, max_age) in self.dirs.items():
+                entries = [entry for entry in self.index.values()
+                           if os.path.dirname(entry.path) == os.path.normpath(path)]
+                size = sum(entry.size for entry in entries)
+
+                # Least recently used first
+                for entry in sorted(entries, key=lambda entry: entry.atime):
+                    if entry.path in active or entry.kind == 'db':
+                        continue
+                    expired = entry.path in superseded or (max_age and now - entry.atime > max_age)
+                    if not expired and (not quota or size <= quota):
+                        continue
+                    if self.remove(entry.path):
+                        logger.info('Cache: evicted %s %dMB' % (os.path.basename(entry.path), entry.size / 1048576))
+                        self.evicted += 1
+                        size -= entry.size
+
+    def report(self):
+        """Returns the cache usage by directory"""
+        with self.lock:
+            report = {'evicted': self.evicted, 'discarded': self.discarded, 'dirs': {}}
+            for name, (path, quota, max_age) in self.dirs.items():
+                entries = [entry for entry in self.index.values()
+                           if os.path.dirname(entry.path) == os.path.normpath(path)]
+                kinds = {}
+                for entry in entries:
+                    kinds[entry.kind] = kinds.get(entry.kind, 0) + 1
+                report['dirs'][name] = {'files': len(entries),
+                                        'size_mb': sum(entry.size for entry in entries) / 1048576.0,
+                                        'quota_mb': quota / 1048576,
+                                        'max_age_h': max_age / 3600,
+                                        'kinds': kinds,
+                                        }
+            return report
+
+
+# Server wide cache index
+cache = CacheManager()
@@ -0,0 +1,209 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import time
+from collections import deque
+from itertools import combinations
+
+from c import c
+
+
+class CloudSolver(object):
+    """Assigns cloud layers to the x-plane slots minimizing cloud redraws
+
+    The solver keeps the layers applied to each slot. New layers are assigned to the slots
+    keeping the vertical order with the minimum number of changed slots, a slot is unchanged
+    if base and top are within the slot tolerance and the coverage is the same.
+
+    Slot changes are applied when the aircraft is far from both the applied and the new layer,
+    or after max_delay seconds.
+    """
+
+    SLOTS = 3
+
+    # METAR coverage to x-plane and the default layer height
+    XP_CLOUDS = {
+        'FEW': [1, c.f2m(2000)],
+        'SCT': [2, c.f2m(4000)],
+        'BKN': [3, c.f2m(4000)],
+        'OVC': [4, c.f2m(4000)],
+        'VV': [4, c.f2m(6000)]
+    }
+
+    # Minimum redraw difference per slot
+    TOLERANCE = [c.f2m(500), c.f2m(5000), c.f2m(10000)]
+
+    MIN_CLOUD = c.f2m(2000)
+
+    def __init__(self, margin=c.f2m(3000), max_delay=600):
+        self.margin = margin
+        self.max_delay = max_delay
+
+        # [base, top, cover] applied to each slot
+        self.applied = [[0, self.MIN_CLOUD, 0] for i in range(self.SLOTS)]
+        # [base, top, cover, waiting seconds] or None for each slot
+        self.pending = [None] * self.SLOTS
+
+        self.redraws = 0
+        self.deferred = 0
+        self.log = deque(maxlen=32)
+
+    def reset(self, applied):
+        """Sets the layers currently in x-plane and clears the pending changes"""
+        self.applied = [list(layer) for layer in applied]
+        self.pending = [None] * self.SLOTS
+
+    @classmethod
+    def merge(cls, wdata, max_cloud_height=False, metar_distance_limit=100000):
+        """Merges METAR and GFS clouds, returns up to 3 layers [base, top, cover] sorted by altitude"""
+
+        gfsClouds = wdata['gfs'].get('clouds', [])
+
+        # X-Plane cloud limits
+        minCloud = cls.MIN_CLOUD
+        maxCloud = c.f2m(c.limit(40000, max_cloud_height))
+
+        lastBase = 0
+        maxTop = 0
+        gfsCloudLimit = c.f2m(5600)
+
+        layers = []
+
+        metar = wdata['metar']
+        if 'distance' in metar and metar['distance'] < metar_distance_limit and 'clouds' in metar:
+
+            gfsCloudLimit += metar['elevation']
+
+            for base, cover, extra in reversed(metar['clouds']):
+                top = minCloud
+
+                if cover in cls.XP_CLOUDS:
+                    top = base + cls.XP_CLOUDS[cover][1]
+                    cover = cls.XP_CLOUDS[cover][0]
+
+                # Search for gfs equivalent layer
+                for gfsBase, gfsTop, gfsCover in gfsClouds:
+                    if gfsBase > 0 and gfsBase - 1500 < base < gfsTop:
+                        top = base + c.limit(gfsTop - gfsBase, maxCloud, minCloud)
+                        break
+
+                if lastBase and top > lastBase:
+                    top = lastBase
+                lastBase = base
+
+                layers.append([base, top, cover])
+
+                if not maxTop:
+                    maxTop = top
+
+            # add gfs clouds
+            for base, top, cover in gfsClouds:
+                if len(layers) < cls.SLOTS and base > max(gfsCloudLimit, maxTop):
+                    top = base + c.limit(top - base, maxCloud, minCloud)
+                    layers = [[base, top, c.cc2xp(cover)]] + layers
+
+        else:
+            # GFS-only clouds
+            for base, top, cover in reversed(gfsClouds):
+                cover = c.cc2xp(cover)
+
+                if cover > 0 and base > 0 and top > 0:
+                    if cover < 3:
+                        top = base + minCloud
+                    else:
+                        top = base + c.limit(top - base, maxCloud, minCloud)
+
+                    if lastBase > top:
+                        top = lastBase
+                    layers.append([base, top, cover])
+                    lastBase = base
+
+        return list(reversed(layers))[:cls.SLOTS]
+
+    def changed(self, slot, layer, alt):
+        """True if the layer requires a slot redraw"""
+        applied = self.applied[slot]
+        if layer[2] != applied[2]:
+            return True
+        if not layer[2]:
+            # Both empty
+            return False
+        tolerance = self.TOLERANCE[slot] + alt / 10
+        return abs(layer[0] - applied[0]) > tolerance or abs(layer[1] - applied[1]) > tolerance
+
+    def assign(self, layers, alt):
+        """Returns the slot assignment with less changed slots"""
+        best, best_cost = None, self.SLOTS + 1
+
+        for slots in combinations(range(self.SLOTS), len(layers)):
+            assignment = [None] * self.SLOTS
+            for slot, layer in zip(slots, layers):
+                assignment[slot] = layer
+
+            # Empty slots keep the applied layer hidden between its neighbours
+            floor = 0
+            for slot in range(self.SLOTS):
+                if assignment[slot] is None:
+                    ceiling = min([layer[0] for layer in assignment[slot:] if layer] or [float('inf')])
+                    base = max(min(self.applied[slot][0], ceiling - self.MIN_CLOUD), floor)
+                    assignment[slot] = [base, base + self.MIN_CLOUD, 0]
+                floor = assignment[slot][1]
+
+            cost = sum(self.changed(slot, assignment[slot], alt) for slot in range(self.SLOTS))
+            if cost < best_cost:
+                best, best_cost = assignment, cost
+
+        return best
+
+    def solve(self, layers, alt):
+        """Schedules the slot changes for new layers"""
+        assignment = self.assign(layers, alt)
+        for slot, layer in enumerate(assignment):
+            if self.changed(slot, layer, alt):
+                waiting = self.pending[slot][3] if self.pending[slot] else 0
+                self.pending[slot] = layer + [waiting]
+            else:
+                self.pending[slot] = None
+
+    def near(self, layer, alt):
+        return layer[2] and layer[0] - self.margin < alt < layer[1] + self.margin
+
+    def step(self, alt, elapsed, force=False):
+        """Returns the slots to be written now [(slot, [base, top, cover]), ]"""
+        changes = []
+        for slot, pending in enumerate(self.pending):
+            if not pending:
+                continue
+
+            layer = pending[:3]
+            if not force and pending[3] < self.max_delay and (self.near(layer, alt)
+                                                             or self.near(self.applied[slot], alt)):
+                # Wait until the aircraft leaves the layers
+                if not pending[3]:
+                    self.deferred += 1
+                pending[3] += elapsed
+                continue
+
+            self.log.append((time.strftime('%H:%M:%S'), slot, self.applied[slot], layer, int(pending[3])))
+            self.applied[slot] = layer
+            self.pending[slot] = None
+            changes.append((slot, layer))
+
+        if changes:
+            self.redraws += 1
+        return changes
+
+    def dump(self):
+        return {'applied': self.applied,
+                'pending': self.pending,
+                'redraws': self.redraws,
+                'deferred': self.deferred,
+                'log': list(self.log),
+                }
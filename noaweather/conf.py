@@ -11,7 +11,6 @@ of the License, or any later version.
 import os
 import cPickle
 import sys
-import subprocess
 import json
 
 from c import c
@@ -34,7 +33,17 @@ class Conf:
                         
                     Refer to the following list for millibar Flight Level conversion:'''
 
-    def __init__(self, xplane_path=False):
+    WAFS_JSON_HELP = '''Here you can edit which WAFS turbulence, icing and CB levels will be downloaded from NOAA.
+                    WAFS parameters without a name are listed by number, ex: "parmcat=19 parm=30" (EDR).
+                    If you mess-up just remove this file, a new one will be created with default values.
+
+                    For a full list of parameters and levels check:
+                    https://www.nco.ncep.noaa.gov/pmb/products/gfs/gfs.t00z.wafs_0p25_unblended.f06.grib2.shtml
+                    Remove the current cycle from the cache/gfs to trigger a download with new values.
+
+                    Refer to the following list for millibar Flight Level conversion:'''
+
+    def __init__(self, xplane_path=False, server=False):
 
         if xplane_path:
             self.syspath = xplane_path
@@ -45,14 +54,17 @@ class Conf:
         self.settingsfile = os.sep.join([self.respath, 'settings.pkl'])
         self.serverSettingsFile = os.sep.join([self.respath, 'weatherServer.pkl'])
         self.gfsLevelsFile = os.sep.join([self.respath, 'gfs_levels_config.json'])
+        self.wafsLevelsFile = os.sep.join([self.respath, 'wafs_levels_config.json'])
 
+        # Created by the weather sources
         self.cachepath = os.sep.join([self.respath, 'cache'])
-        if not os.path.exists(self.cachepath):
-            os.makedirs(self.cachepath)
 
         self.setDefautls()
-        self.pluginLoad()
-        self.serverLoad()
+        # The plugin doesn't need the server settings and levels files
+        if server:
+            self.serverLoad()
+        else:
+            self.pluginLoad()
 
         # Config Overrides
         self.parserate = 1
@@ -78,6 +90,7 @@ class Conf:
             wgbin = 'WIN32wgrib2.exe'
 
             # Hide wgrib window for windows users
+            import subprocess
             self.spinfo = subprocess.STARTUPINFO()
             self.spinfo.dwFlags |= 1  # STARTF_USESHOWWINDOW
             self.spinfo.wShowWindow = 0  # 0 or SW_HIDE 0
@@ -86,21 +99,36 @@ class Conf:
             # Linux?
             wgbin = 'linux-glib2.5-i686-wgrib2'
 
-        self.wgrib2bin = os.sep.join([self.respath, 'bin', wgbin])
-
-        # Enforce execution rights
-        try:
-            os.chmod(self.wgrib2bin, 0775)
-        except:
-            pass
-
-        self.pythonpath = self.find_python_path('python2.7')
+        # wgrib2bin and pythonpath are set on first use
+        self.wgrib2file = os.sep.join([self.respath, 'bin', wgbin])
+
+    def __getattr__(self, name):
+        """Finds the binaries on first use"""
+        if name == 'wgrib2bin':
+            # Enforce execution rights
+            if not Conf.can_exec(self.wgrib2file):
+                try:
+                    os.chmod(self.wgrib2file, 0775)
+                except:
+                    pass
+            self.wgrib2bin = self.wgrib2file
+            return self.wgrib2bin
+
+        if name == 'pythonpath':
+            path = self.find_python_path('python2.7')
+            if not path:
+                raise Exception('Unable to find the python binary.')
+            self.pythonpath = self.last_pythonpath = path
+            return path
 
-        if not self.pythonpath:
-            raise Exception('Unable to find the python binary.')
+        raise AttributeError(name)
 
     def find_python_path(self, filename="python2.7"):
         """Where's the fish"""
+        # Found on the last run
+        if self.last_pythonpath and Conf.can_exec(self.last_pythonpath):
+            return self.last_pythonpath
+
         path = sys.executable
 
         if Conf.can_exec(path) and 'python' in path.lower():
@@ -144,11 +172,36 @@ class Conf:
         # Performance tweaks
         self.max_visibility = False  # in SM
         self.max_cloud_height = False  # in feet
+        self.status_refresh_rate = 0.5  # Refresh the status window each #seconds
+        self.profiling = False  # Publish flight loop timings as xjpc/XPNoaaWeather/perf/* datarefs
 
         # Weather server configuration
         self.server_updaterate = 10  # Run the weather loop each #seconds
         self.server_address = '127.0.0.1'
         self.server_port = 8950
+        # Bind address, use '0.0.0.0' to serve plugins on other hosts of the LAN
+        self.server_bind_address = '127.0.0.1'
+        # Shared mode: reuse a running server and keep it alive while other clients use it
+        self.server_shared = False
+        self.server_client_timeout = 300  # Forget idle clients after #seconds
+        self.server_cache_size = 256  # Parsed grib positions kept in memory
+        self.server_stats_interval = 0  # Print server stats to the log each #seconds, 0 disables it
+        # Downloads and decoding executor
+        self.download_workers = 4
+        self.download_host_limit = 2  # Concurrent downloads per host
+        self.download_timeout = 900  # Cancel downloads running for #seconds
+        self.warmstart_interval = 600  # Save the warm start snapshot each #seconds, 0 only on shutdown
+        # Weather server log: DEBUG, INFO, WARNING or ERROR, DEBUG logs every request
+        self.log_level = 'INFO'
+        self.log_modules = {}  # Module levels, ex: {'metar': 'DEBUG'}
+        self.log_max_size = 4  # Rotate weatherServerLog.txt at #MB
+        self.log_backups = 2
+        self.log_queue_size = 4096  # Messages waiting to be written, more are dropped
+        # Cache directory quotas: [max size MB, max age hours], 0 disables the limit
+        self.cache_quota = {'gfs': [2048, 72],
+                            'metar': [256, 24],
+                            'dumplogs': [32, 24 * 30],
+                            }
 
         # Weather server variables
         self.lastgrib = False
@@ -165,12 +218,19 @@ class Conf:
         self.metar_source = 'NOAA'
         self.metar_updaterate = 5  # minutes
 
+        self.last_pythonpath = False
+
         self.tracker_uid = False
         self.tracker_enabled = True
 
         self.ignore_metar_stations = []
 
         self.updateMetarRWX = True
+        # Only write the METAR.rwx stations within #nm of the aircraft, 0 writes all the stations
+        self.metar_rwx_radius = 0
+
+        # Interpolate GFS and WAFS data locally from a grid tile around the aircraft
+        self.use_tiles = True
 
     def saveSettings(self, filepath, settings):
         f = open(filepath, 'w')
@@ -230,7 +290,16 @@ class Conf:
             'metar_updaterate': self.metar_updaterate,
             'tracker_uid': self.tracker_uid,
             'tracker_enabled': self.tracker_enabled,
-            'ignore_metar_stations': self.ignore_metar_stations
+            'ignore_metar_stations': self.ignore_metar_stations,
+            'server_address': self.server_address,
+            'server_port': self.server_port,
+            'server_bind_address': self.server_bind_address,
+            'server_shared': self.server_shared,
+            'use_tiles': self.use_tiles,
+            'status_refresh_rate': self.status_refresh_rate,
+            'profiling': self.profiling,
+            'last_pythonpath': self.last_pythonpath,
+            'metar_rwx_radius': self.metar_rwx_radius,
         }
         self.saveSettings(self.settingsfile, conf)
 
@@ -264,6 +333,13 @@ class Conf:
             self.gfs_variable_list = self.gfs_levels_defaults()
             self.save_gfs_levels(self.gfs_variable_list)
 
+        # Load the WAFS levels file or create a new one.
+        if os.path.isfile(self.wafsLevelsFile):
+            self.wafs_variable_list = self.load_wafs_levels(self.wafsLevelsFile)
+        else:
+            self.wafs_variable_list = self.wafs_levels_defaults()
+            self.save_wafs_levels(self.wafs_variable_list)
+
     @staticmethod
     def gfs_levels_defaults():
         """GFS Levels default config"""
@@ -328,6 +404,66 @@ class Conf:
                 print "Format ERROR parsing gfs levels file: %s" % str(err)
                 return self.gfs_levels_defaults()
 
+    @staticmethod
+    def wafs_levels_defaults():
+        """WAFS Levels default config"""
+        d = [
+            {
+                'vars': [
+                    'parmcat=19 parm=30',  # Eddy Dissipation Param
+                    'parmcat=19 parm=37',  # Icing severity
+                ],
+                'levels': [
+                    '800 mb',  # FL064
+                    '700 mb',  # FL100
+                    '600 mb',  # FL140
+                    '500 mb',  # FL180
+                    '400 mb',  # FL235
+                    '350 mb',  # FL265
+                    '300 mb',  # FL300
+                    '250 mb',  # FL340
+                    '225 mb',  # FL360
+                    '200 mb',  # FL380
+                    '175 mb',  # FL410
+                    '150 mb',  # FL443
+                    '125 mb',  # FL480
+                ],
+            },
+            {
+                'vars': [
+                    'parmcat=6 parm=25',  # Horizontal Extent of Cumulonimbus (CB) %
+                    'parmcat=3 parm=3',  # Cumulonimbus base or top height
+                ],
+                'levels': [
+                    'entire atmosphere',
+                    'entire atmosphere (considered as a single layer)',
+                    'cumulonimbus base',
+                    'cumulonimbus top',
+                ],
+            },
+        ]
+        return d
+
+    def save_wafs_levels(self, levels):
+        """Save wafs levels settings to a json file"""
+        with open(self.wafsLevelsFile, 'w') as f:
+            config = {'comment': [line.strip() for line in iter(self.WAFS_JSON_HELP.splitlines())],
+                      'config': levels,
+                      }
+            level = c.gfs_levels_help_list()
+            config['comment'] += [' | '.join(level[i:i + 5]) for i in range(0, len(level), 5)]
+            json.dump(config, f, indent=2)
+
+    def load_wafs_levels(self, json_file):
+        """Load wafs levels configuration from a json file"""
+
+        with open(json_file, 'r') as f:
+            try:
+                return json.load(f)['config']
+            except (KeyError, Exception) as err:
+                print "Format ERROR parsing wafs levels file: %s" % str(err)
+                return self.wafs_levels_defaults()
+
     @staticmethod
     def can_exec(file_path):
         return os.path.isfile(file_path) and os.access(file_path, os.X_OK)
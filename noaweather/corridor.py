@@ -0,0 +1,192 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from math import cos, radians
+
+from c import c
+
+
+class Corridor(object):
+    """Weather sampled along a route
+
+    Every sample has its position, the distance along the route and a packed float array
+    with a row per vertical level: altitude (m), heading, speed (kt), temperature (K), dew point (K)
+    and turbulence. Missing temperatures and dew points are set to 0.
+
+    Request format: @<spacing nm>|<vertical spacing ft>|<lat>,<lon>|<lat>,<lon>|...
+    """
+
+    FIELDS = ('alt', 'hdg', 'speed', 'temp', 'dew', 'turbulence')
+    MAX_SAMPLES = 48
+    MAX_ALTITUDE = 13716  # FL450 in meters
+    MIN_VSPACING = 152.4  # 500ft in meters
+    # Encoded response limit, under the 9216 bytes default UDP datagram limit of macOS
+    MAX_BYTES = 8192
+    # Encoded sizes of a sample without its levels (position, distance, pressure, cloud layers)
+    # and of the rest of the response
+    SAMPLE_BYTES = 160
+    RESPONSE_BYTES = 256
+
+    def __init__(self, samples, vspacing, info=None):
+        self.samples = samples
+        self.vspacing = vspacing
+        self.info = info or {}
+
+    @staticmethod
+    def parse_request(data):
+        """Returns spacing (m), vertical spacing (m) and the waypoint list from a request"""
+        spacing, vspacing = c.m2kn(float(data[0])), c.f2m(float(data[1]))
+        waypoints = []
+        for wpt in data[2:]:
+            lat, lon = wpt.split(',')
+            waypoints.append((float(lat), float(lon)))
+
+        if spacing <= 0 or vspacing <= 0 or not waypoints:
+            raise ValueError('Bad corridor request')
+
+        return spacing, max(vspacing, Corridor.MIN_VSPACING), waypoints
+
+    @classmethod
+    def max_samples(cls, vspacing, top=MAX_ALTITUDE):
+        """Returns the number of samples of a response that fits in a single datagram"""
+        nlevels = int(top / vspacing) + 1
+        sample = nlevels * len(cls.FIELDS) * 4 + cls.SAMPLE_BYTES
+        return int(c.limit((cls.MAX_BYTES - cls.RESPONSE_BYTES) / sample, cls.MAX_SAMPLES, 2))
+
+    @staticmethod
+    def sample_route(waypoints, spacing, max_samples=MAX_SAMPLES):
+        """Returns positions every spacing meters along the waypoints polyline
+
+        Args:
+            waypoints (list): [(lat, lon), ]
+            spacing (float): Along track spacing in meters
+            max_samples (int): The spacing is increased if the route requires more samples
+
+        Returns:
+            list: [(lat, lon, distance), ]
+        """
+        legs = [0]
+        for i in range(len(waypoints) - 1):
+            legs.append(legs[-1] + c.greatCircleDistance(waypoints[i], waypoints[i + 1]))
+        total = legs[-1]
+
+        if not total:
+            return [(waypoints[0][0], waypoints[0][1], 0)]
+
+        if total / spacing + 2 > max_samples:
+            spacing = total / (max_samples - 1)
+
+        distances = [i * spacing for i in range(int(total / spacing + 1e-6) + 1)]
+        if distances[-1] < total - 1:
+            distances.append(total)
+
+        samples = []
+        for distance in distances:
+            leg = c.limit(bisect_right(legs, distance) - 1, len(waypoints) - 2, 0)
+            length = legs[leg + 1] - legs[leg]
+            fraction = (distance - legs[leg]) / length if length else 0
+            lat, lon = c.greatCirclePoint(waypoints[leg], waypoints[leg + 1], fraction)
+            samples.append((lat, lon, distance))
+
+        return samples
+
+    @staticmethod
+    def layer_bounds(alts, alt):
+        """Returns the lower and upper layer indexes for an altitude"""
+        upper = c.limit(bisect_left(alts, alt), len(alts) - 1, 0)
+        lower = upper - 1 if upper > 0 and alts[upper] > alt else upper
+        return lower, upper
+
+    @classmethod
+    def build(cls, points, gfs_data, wafs_data, vspacing, top=MAX_ALTITUDE):
+        """Builds the corridor samples from the parsed data of each point
+
+        Args:
+            points (list): [(lat, lon, distance), ]
+            gfs_data (list): GFS parsed data for each point
+            wafs_data (list): WAFS parsed turbulence for each point
+            vspacing (float): Vertical spacing in meters
+
+        Returns:
+            list: The corridor samples ready to be sent
+        """
+        levels_alt = [i * vspacing for i in range(int(top / vspacing) + 1)]
+
+        samples = []
+        for (lat, lon, distance), gfs, turbulence in zip(points, gfs_data, wafs_data):
+            winds = gfs and gfs['winds'] or []
+            turbulence = turbulence or []
+            walts = [layer[0] for layer in winds]
+            talts = [layer[0] for layer in turbulence]
+
+            levels = array('f')
+            for alt in levels_alt:
+                hdg, speed, temp, dew, turb = 0, 0, 0, 0, 0
+
+                if winds:
+                    lower, upper = cls.layer_bounds(walts, alt)
+                    l1, l2 = winds[lower], winds[upper]
+                    lalt = c.limit(alt, l2[0], l1[0])
+                    hdg = c.interpolateHeading(l1[1], l2[1], l1[0], l2[0], lalt)
+                    speed = c.interpolate(l1[2], l2[2], l1[0], l2[0], lalt)
+                    if l1[3]['temp'] and l2[3]['temp']:
+                        temp = c.interpolate(l1[3]['temp'], l2[3]['temp'], l1[0], l2[0], lalt)
+                    if l1[3]['dew'] and l2[3]['dew']:
+                        dew = c.interpolate(l1[3]['dew'], l2[3]['dew'], l1[0], l2[0], lalt)
+
+                if turbulence:
+                    lower, upper = cls.layer_bounds(talts, alt)
+                    t1, t2 = turbulence[lower], turbulence[upper]
+                    turb = c.interpolate(t1[1], t2[1], t1[0], t2[0], c.limit(alt, t2[0], t1[0]))
+
+                levels.extend((alt, hdg, speed, temp, dew, turb))
+
+            samples.append({'lat': lat,
+                            'lon': lon,
+                            'distance': distance,
+                            'levels': levels.tostring(),
+                            'clouds': gfs and gfs['clouds'] or [],
+                            'pressure': gfs and gfs['pressure'] or False,
+                            })
+
+        return samples
+
+    @classmethod
+    def from_response(cls, response):
+        """Unpacks a corridor server response"""
+        corridor = response['corridor']
+        for sample in corridor['samples']:
+            levels = array('f')
+            levels.fromstring(sample['levels'])
+            sample['levels'] = levels
+
+        return cls(corridor['samples'], corridor['vspacing'], corridor['info'])
+
+    def nearest(self, lat, lon):
+        """Returns the closest sample to a position"""
+        fudge = cos(radians(lat)) ** 2
+        return min(self.samples, key=lambda s: (s['lat'] - lat) ** 2 + (s['lon'] - lon) ** 2 * fudge)
+
+    def rows(self, sample):
+        """Returns the sample levels as rows [alt, hdg, speed, temp, dew, turbulence]"""
+        nfields = len(self.FIELDS)
+        levels = sample['levels']
+        return [levels[i:i + nfields] for i in range(0, len(levels), nfields)]
+
+    def winds(self, sample):
+        """Returns the sample wind layers in the GFS response format"""
+        return [[alt, hdg, speed, {'temp': temp or False, 'rh': False, 'dew': dew or False, 'gust': 0}]
+                for alt, hdg, speed, temp, dew, turbulence in self.rows(sample)]
+
+    def turbulences(self, sample):
+        """Returns the sample turbulence layers in the WAFS response format"""
+        return [[row[0], row[5]] for row in self.rows(sample)]
@@ -0,0 +1,270 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import threading
+import time
+from collections import deque
+from urlparse import urlparse
+
+from stats import stats
+from serverlog import log
+
+
+logger = log.logger('executor')
+
+
+class Future(object):
+    """Result of an Executor task"""
+
+    PENDING, RUNNING, DONE, CANCELLED = 'pending', 'running', 'done', 'cancelled'
+
+    def __init__(self, executor, name, host, timeout):
+        self.executor = executor
+        self.name = name
+        self.host = host
+        self.timeout = timeout
+
+        self.state = self.PENDING
+        self.timed_out = False
+        # Passed to the task as cancel_event
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+        self.submitted = time.time()
+        self.started = 0
+
+    def cancel(self):
+        """Cancels the task, running tasks stop at their next cancel_event check"""
+        self.cancel_event.set()
+        self.executor.cancel(self)
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def running(self):
+        return self.state == self.RUNNING
+
+    def done(self):
+        return self.done_event.isSet()
+
+    def result(self, timeout=None):
+        """Waits for the task and returns its result or raises its exception"""
+        if not self.done_event.wait(timeout):
+            raise TaskTimeout('%s: no result after %ds' % (self.name, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) when the task is done, now if it already is"""
+        if self.done():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def finish(self, value, error, state=DONE):
+        if self.timed_out:
+            error = TaskTimeout('%s: timeout after %ds' % (self.name, self.timeout))
+        self.value, self.error, self.state = value, error, state
+        self.done_event.set()
+
+        for callback in self.callbacks:
+            callback(self)
+
+
+class Executor(object):
+    """Bounded thread pool for network and decode tasks
+
+    Runs at most workers tasks at a time and host_limit tasks per host, the rest wait in a bounded
+    queue in submit order. Tasks get their future cancel_event, tasks running over their timeout are
+    cancelled and fail with TaskTimeout.
+
+    Threads are started on the first submit.
+    """
+
+    def __init__(self, workers=4, host_limit=2, max_pending=64):
+        self.workers = workers
+        self.host_limit = host_limit
+        self.max_pending = max_pending
+
+        self.pending = deque()
+        self.running = []
+        self.hosts = {}
+        self.threads = []
+
+        self.condition = threading.Condition()
+        self.die = threading.Event()
+
+    def configure(self, workers, host_limit):
+        self.workers = workers
+        self.host_limit = host_limit
+
+    @staticmethod
+    def host_name(host):
+        """Returns the host of an url"""
+        return urlparse(host).netloc or host
+
+    def submit(self, function, *args, **kwargs):
+        """Queues a task, returns its Future
+
+        Kwargs:
+            host (str): Host or url limiting concurrency, tasks without host are only limited by workers
+            timeout (float): Cancel the task after timeout seconds running
+            cancellable (bool): Pass the future cancel_event to the task, True by default
+            name (str): Task name for diagnostics
+
+        Raises:
+            ExecutorFull: if max_pending tasks are waiting
+        """
+        host = self.host_name(kwargs.pop('host', ''))
+        timeout = kwargs.pop('timeout', None)
+        name = kwargs.pop('name', getattr(function, '__name__', 'task'))
+
+        future = Future(self, name, host, timeout)
+        if kwargs.pop('cancellable', True):
+            kwargs['cancel_event'] = future.cancel_event
+
+        with self.condition:
+            if self.die.isSet():
+                raise ExecutorFull('Executor is shut down')
+            if len(self.pending) >= self.max_pending:
+                stats.incr('executor_rejected')
+                raise ExecutorFull('Executor queue full: %d pending tasks' % len(self.pending))
+
+            self.pending.append((future, function, args, kwargs))
+            self.start()
+            self.condition.notify_all()
+
+        return future
+
+    def start(self):
+        """Starts the worker and watchdog threads, must be called with the condition held"""
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        if self.threads:
+            return
+
+        for i in range(self.workers):
+            self.threads.append(threading.Thread(target=self.worker, name='executor-%d' % i))
+        self.threads.append(threading.Thread(target=self.watchdog, name='executor-watchdog'))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def next_task(self):
+        """Returns the first pending task with a free host slot, must be called with the condition held"""
+        for task in self.pending:
+            host = task[0].host
+            if not host or self.hosts.get(host, 0) < self.host_limit:
+                self.pending.remove(task)
+                if host:
+                    self.hosts[host] = self.hosts.get(host, 0) + 1
+                return task
+        return None
+
+    def worker(self):
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None:
+                    if self.die.isSet():
+                        return
+                    self.condition.wait(5)
+                    task = self.next_task()
+
+                future, function, args, kwargs = task
+                future.state = Future.RUNNING
+                future.started = time.time()
+                self.running.append(future)
+
+            stats.timing('executor_wait', future.started - future.submitted)
+            value, error = None, None
+            try:
+                value = function(*args, **kwargs)
+            except Exception as err:
+                error = err
+
+            with self.condition:
+                self.running.remove(future)
+                if future.host:
+                    self.hosts[future.host] -= 1
+                self.condition.notify_all()
+
+            if future.timed_out:
+                stats.incr('executor_timeouts')
+            future.finish(value, error)
+
+    def watchdog(self):
+        """Cancels the tasks running over their timeout"""
+        while not self.die.wait(1):
+            now = time.time()
+            with self.condition:
+                for future in self.running:
+                    if future.timeout and not future.timed_out and now - future.started > future.timeout:
+                        logger.warning('Task %s timeout after %ds, canceling.' % (future.name, future.timeout))
+                        future.timed_out = True
+                        future.cancel_event.set()
+
+    def cancel(self, future):
+        """Removes a pending task, running tasks are notified through their cancel_event"""
+        with self.condition:
+            for task in self.pending:
+                if task[0] is future:
+                    self.pending.remove(task)
+                    break
+            else:
+                return
+
+        stats.incr('executor_cancelled')
+        future.finish(None, TaskCancelled('%s: canceled' % future.name), Future.CANCELLED)
+
+    def status(self):
+        """Returns the running and pending tasks for diagnostics"""
+        now = time.time()
+        with self.condition:
+            return {'running': [{'name': future.name,
+                                 'host': future.host,
+                                 'elapsed': round(now - future.started, 1)} for future in self.running],
+                    'pending': [{'name': task[0].name,
+                                 'host': task[0].host,
+                                 'waiting': round(now - task[0].submitted, 1)} for task in self.pending],
+                    'hosts': dict(self.hosts),
+                    }
+
+    def shutdown(self, timeout=3):
+        """Cancels all the tasks and stops the threads"""
+        with self.condition:
+            self.die.set()
+            futures = [task[0] for task in self.pending] + list(self.running)
+            self.condition.notify_all()
+
+        for future in futures:
+            future.cancel()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class ExecutorFull(Exception):
+    """Raised when the executor can't accept more tasks"""
+
+
+class TaskCancelled(Exception):
+    """The task was canceled before running"""
+
+
+class TaskTimeout(Exception):
+    """The task didn't finish in time"""
+
+
+# Server wide network and decode executor
+executor = Executor()
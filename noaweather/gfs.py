@@ -22,8 +22,7 @@ class GFS(GribWeatherSource):
 
     base_url = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/gfs.'
 
-    download = False
-    download_wait = 0
+    cache_pattern = '*_gfs.t??z.pgrb2full.0p50.f0??'
 
     def __init__(self, conf):
         self.variable_list = conf.gfs_variable_list
@@ -44,12 +43,22 @@ class GFS(GribWeatherSource):
 
     def parse_grib_data(self, filepath, lat, lon):
         """Executes wgrib2 and parses its output"""
-        args = ['-s',
-                '-lon',
-                '%f' % (lon),
-                '%f' % (lat),
-                filepath
-                ]
+        return self.parse_grib_points(filepath, [(lat, lon)])[0]
+
+    def parse_grib_points(self, filepath, points):
+        """Parses a list of positions in a single wgrib2 pass
+
+        Args:
+            filepath (str): Path to the grib file
+            points (list): Positions to parse [(lat, lon), ]
+
+        Returns:
+            list: parsed data for each position
+        """
+        args = ['-s']
+        for lat, lon in points:
+            args += ['-lon', '%f' % (lon), '%f' % (lat)]
+        args.append(filepath)
 
         kwargs = {'stdout': subprocess.PIPE}
 
@@ -58,31 +67,43 @@ class GFS(GribWeatherSource):
 
         p = subprocess.Popen([self.conf.wgrib2bin] + args, **kwargs)
 
+        npoints = len(points)
+        data = [{} for _ in range(npoints)]
+        clouds = [{} for _ in range(npoints)]
+        pressure = [False] * npoints
+
         it = iter(p.stdout)
-        data = {}
-        clouds = {}
-        pressure = False
         for line in it:
             r = line[:-1].split(':')
-            # Level, variable, value
-            level, variable, value = [r[4].split(' '), r[3], r[7].split(',')[2].split('=')[1]]
-
-            if len(level) > 1:
-                if level[1] == 'cloud':
-                    # cloud layer
-                    clouds.setdefault(level[0], {})
-                    if len(level) > 3 and variable == 'PRES':
-                        clouds[level[0]][level[2]] = value
-                    else:
-                        # level coverage/temperature
-                        clouds[level[0]][variable] = value
-                elif level[1] == 'mb':
-                    # wind levels
-                    data.setdefault(level[0], {})
-                    data[level[0]][variable] = value
-                elif level[0] == 'mean':
-                    if variable == 'PRMSL':
-                        pressure = c.pa2inhg(float(value))
+            # Level, variable
+            level, variable = r[4].split(' '), r[3]
+
+            for i in range(npoints):
+                # One lon=,lat=,val= column per requested position
+                value = r[7 + i].split(',')[2].split('=')[1]
+
+                if len(level) > 1:
+                    if level[1] == 'cloud':
+                        # cloud layer
+                        clouds[i].setdefault(level[0], {})
+                        if len(level) > 3 and variable == 'PRES':
+                            clouds[i][level[0]][level[2]] = value
+                        else:
+                            # level coverage/temperature
+                            clouds[i][level[0]][variable] = value
+                    elif level[1] == 'mb':
+                        # wind levels
+                        data[i].setdefault(level[0], {})
+                        data[i][level[0]][variable] = value
+                    elif level[0] == 'mean':
+                        if variable == 'PRMSL':
+                            pressure[i] = c.pa2inhg(float(value))
+
+        return [self.grib2weather(data[i], clouds[i], pressure[i]) for i in range(npoints)]
+
+    @staticmethod
+    def grib2weather(data, clouds, pressure):
+        """Converts parsed grib values to wind and cloud layers"""
 
         windlevels = []
         cloudlevels = []
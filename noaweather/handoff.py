@@ -0,0 +1,51 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+
+class Snapshot(object):
+    """Weather data ready to be used by the flight loop
+
+    Snapshots are built on the weather client thread and never modified after being published.
+    data_seq changes only with new weather server data.
+    """
+
+    __slots__ = ('data_seq', 'wdata', 'tile', 'gfs', 'wafs', 'profile', 'lat', 'lon', 'corridor')
+
+    def __init__(self, data_seq, wdata, tile, gfs, wafs, profile, lat, lon, corridor=False):
+        self.data_seq = data_seq
+        self.wdata = wdata
+        self.tile = tile
+        self.gfs = gfs
+        self.wafs = wafs
+        self.profile = profile
+        self.lat, self.lon = lat, lon
+        self.corridor = corridor
+
+
+class Handoff(object):
+    """Double buffered single producer single consumer handoff
+
+    The producer writes the back slot and then publishes it incrementing the sequence number,
+    the consumer reads the sequence and the front slot. Published values are immutable, a
+    consumer holding a value is never affected by later writes.
+    """
+
+    def __init__(self, value=None):
+        self.slots = [value, value]
+        self.seq = 0
+
+    def publish(self, value):
+        self.slots[(self.seq + 1) % 2] = value
+        self.seq += 1
+
+    def read(self):
+        """Returns the sequence number and the last published value"""
+        seq = self.seq
+        return seq, self.slots[seq % 2]
@@ -0,0 +1,405 @@
+#!/usr/bin/python
+'''
+Headless plugin harness and flight loop benchmark
+
+Runs the plugin on the in memory SDK stub (xplmstub) and drives floopCallback frame by frame
+along a flight track. Weather server requests are answered in process with synthetic data
+or with recorded responses, the client thread work is done between frames and measured apart.
+
+Reports per frame CPU time and net allocated objects (gc tracked objects, with gc
+disabled during the frame):
+
+    harness.py --duration 600 --fps 60 --status --json results.json
+    harness.py --track track.csv --payloads responses.pkl
+
+Track files have one lat,lon[,altitude ft] position per line and second. Payload files have
+consecutive pickled weather server responses, see testclient.py --record.
+
+Startup benchmark: plugin import, XPluginStart and XPluginEnable times on the stub SDK, and
+the weather server time to answer a ping and a first weather request on a cache directory:
+
+    harness.py --startup --runs 5 --cache fixtures/cache
+
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+'''
+import os
+import sys
+import gc
+import socket
+import subprocess
+import json
+import math
+import time
+import random
+import cPickle
+import shutil
+import argparse
+import tempfile
+from pprint import pprint
+
+import xplmstub
+from stats import Histogram
+
+
+class FlightTrack(object):
+    """Positions (lat, lon, alt m) every second, interpolated for each frame"""
+
+    def __init__(self, positions):
+        self.positions = positions
+
+    @classmethod
+    def load(cls, path):
+        positions = []
+        with open(path, 'r') as f:
+            for line in f:
+                cols = line.strip().split(',')
+                if len(cols) > 1 and cols[0][:1] != '#':
+                    try:
+                        alt = float(cols[2]) * 0.3048 if len(cols) > 2 else 10000
+                        positions.append((float(cols[0]), float(cols[1]), alt))
+                    except ValueError:
+                        continue
+        return cls(positions)
+
+    @classmethod
+    def synthetic(cls, rnd, speed, duration):
+        """Straight track climbing to FL350 at 2000 ft/min, speed in kt"""
+        lat, lon = rnd.uniform(-50, 50), rnd.uniform(-180, 180)
+        hdg = math.radians(rnd.uniform(0, 360))
+        step = speed * 1852.0 / 3600 / 111120.0
+
+        positions = []
+        for second in range(int(duration) + 2):
+            alt = min(second * 2000 / 60.0, 35000) * 0.3048
+            positions.append((lat, lon, alt))
+            lat = max(min(lat + step * math.cos(hdg), 85), -85)
+            lon = (lon + step * math.sin(hdg) / math.cos(math.radians(lat)) + 180) % 360 - 180
+        return cls(positions)
+
+    def at(self, t):
+        """Returns lat, lon, alt and ground speed in m/s"""
+        from c import c
+
+        i = min(int(t), len(self.positions) - 2)
+        f = min(t - i, 1)
+        a, b = self.positions[i], self.positions[i + 1]
+        return tuple(a[k] + (b[k] - a[k]) * f for k in range(3)) + (c.greatCircleDistance(a[:2], b[:2]),)
+
+
+class FakeServer(object):
+    """Answers the plugin requests with synthetic or recorded weather server responses"""
+
+    GFS_CYCLE = '2020101200'
+    WAFS_CYCLE = '2020101200'
+    METAR = 'LEBL 121230Z 24012G20KT 210V270 9999 FEW020 SCT040 BKN100 18/12 Q1015'
+
+    def __init__(self, payloads=None):
+        self.payloads = payloads or []
+        self.index = 0
+        self.requests = {}
+
+    @staticmethod
+    def load(path):
+        payloads = []
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    payloads.append(cPickle.load(f))
+                except EOFError:
+                    break
+        return payloads
+
+    @classmethod
+    def gfs(cls, lat, lon):
+        from gfs import GFS
+
+        levels = {}
+        for mb in (1000, 850, 700, 500, 400, 300, 250, 200, 150):
+            height = (1000 - mb) / 850.0
+            levels[str(mb)] = {'UGRD': 5 + 40 * height * math.cos(math.radians(lat + lon)),
+                               'VGRD': 10 * math.sin(math.radians(lon * 3)) + 3 * height,
+                               'TMP': 288 - 60 * height,
+                               'RH': 60 - 40 * height,
+                               }
+        clouds = {'low': {'bottom': 90000, 'top': 80000, 'TCDC': 30 + 20 * math.sin(math.radians(lat * 10))},
+                  'middle': {'bottom': 60000, 'top': 45000, 'TCDC': 70}}
+        return GFS.grib2weather(levels, clouds, 29.92 + 0.2 * math.sin(math.radians(lon * 5)))
+
+    @staticmethod
+    def wafs(lat, lon):
+        return [[alt, max(0, 2 * math.sin(math.radians(lat * 20 + alt / 100.0)))]
+                for alt in (3000, 5500, 7000, 9000, 10500, 12000)]
+
+    def weather(self, lat, lon):
+        from metar import Metar
+        from c import c
+
+        metar = Metar.parse_metar('LEBL', self.METAR, 4)
+        metar['latlon'] = (round(lat, 1) + 0.1, round(lon, 1) + 0.1)
+        metar['distance'] = c.greatCircleDistance((lat, lon), metar['latlon'])
+
+        return {'gfs': self.gfs(lat, lon),
+                'wafs': self.wafs(lat, lon),
+                'icing': [[alt, max(0, math.cos(math.radians(lon * 20 + alt / 100.0)))] for alt in (3000, 5500)],
+                'cb': {'extent': 25, 'base': 1500, 'top': 11000},
+                'metar': metar,
+                'info': {'lat': lat, 'lon': lon, 'gfs_cycle': self.GFS_CYCLE, 'wafs_cycle': self.WAFS_CYCLE},
+                }
+
+    def tile(self, lat, lon):
+        from tile import Tile
+
+        lat0, lon0, nodes = Tile.nodes(lat, lon, 0.5)
+        response = Tile.pack(lat0, lon0, 0.5, [self.gfs(*node) for node in nodes],
+                             [self.wafs(*node) for node in nodes])
+        response['tile']['info'] = {'lat': lat, 'lon': lon, 'gfs_cycle': self.GFS_CYCLE,
+                                    'wafs_cycle': self.WAFS_CYCLE}
+        return response
+
+    def answer(self, msg):
+        """Returns the pickled response to a request or False"""
+        kind = msg[0]
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+
+        response = False
+        if kind == '?' and '|' in msg:
+            lat, lon = [float(value) for value in msg[1:].split('|')]
+            if self.payloads:
+                response = self.payloads[self.index % len(self.payloads)]
+                self.index += 1
+            else:
+                response = self.weather(lat, lon)
+        elif kind == '#' and not self.payloads:
+            lat, lon = [float(value) for value in msg[1:].split('|')]
+            response = self.tile(lat, lon)
+
+        return response and cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL)
+
+
+def load_plugin(xplane_path, settings, timings=None):
+    """Imports and starts the plugin on the stub SDK, records the phase times in timings"""
+    if timings is None:
+        timings = {}
+    xplmstub.install(xplane_path)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    start = time.time()
+    import PI_noaaWeather
+    timings['import'] = time.time() - start
+    from conf import Conf
+
+    # Plugin settings
+    respath = os.sep.join([xplane_path, 'Resources', 'plugins', 'PythonScripts', 'noaweather'])
+    if not os.path.exists(respath):
+        os.makedirs(respath)
+    settings = dict(settings, version=Conf.__VERSION__)
+    with open(os.sep.join([respath, 'settings.pkl']), 'w') as f:
+        cPickle.dump(settings, f)
+
+    # The weather server is emulated
+    PI_noaaWeather.Weather.startWeatherServer = lambda self: None
+
+    plugin = PI_noaaWeather.PythonInterface()
+    start = time.time()
+    plugin.XPluginStart()
+    timings['start'] = time.time() - start
+    start = time.time()
+    plugin.XPluginEnable()
+    timings['enable'] = time.time() - start
+
+    return PI_noaaWeather, plugin
+
+
+def server_startup(cache, port, timeout=60):
+    """Starts an offline weather server, returns the seconds to the first pong and weather response"""
+    server = os.sep.join([os.path.dirname(os.path.abspath(__file__)), 'weatherServer.py'])
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.005)
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, server, '--cache', cache, '--offline', '--port', str(port)],
+                               stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    times = {}
+    try:
+        for name, request in (('pong', '!ping'), ('weather', '?41.3|2.1')):
+            sock.settimeout(0.005 if name == 'pong' else timeout)
+            while name not in times:
+                if time.time() - start > timeout:
+                    raise RuntimeError('No %s from the server after %ds' % (name, timeout))
+                try:
+                    sock.sendto(request, ('127.0.0.1', port))
+                    sock.recv(65535)
+                    times[name] = time.time() - start
+                except socket.error:
+                    # Not bound yet: connection refused or timeout
+                    pass
+    finally:
+        sock.sendto('!shutdown', ('127.0.0.1', port))
+        sock.close()
+        process.wait()
+
+    return times
+
+
+def startup(options):
+    """Plugin and weather server startup benchmark"""
+    xplane_path = tempfile.mkdtemp(prefix='noaweather-harness')
+    cache = options.cache or tempfile.mkdtemp(prefix='noaweather-cache')
+
+    try:
+        timings = {}
+        module, plugin = load_plugin(xplane_path, {'tracker_enabled': False}, timings)
+        calls = sum(xplmstub.calls.values())
+        plugin.XPluginStop()
+
+        pong, weather = Histogram(size=options.runs), Histogram(size=options.runs)
+        for run in range(options.runs):
+            times = server_startup(cache, options.port)
+            pong.add(times['pong'])
+            weather.add(times['weather'])
+
+        return {'plugin_ms': dict((name, value * 1000) for name, value in timings.items()),
+                'plugin_sdk_calls': calls,
+                'server_pong_ms': pong.summary(),
+                'server_first_weather_ms': weather.summary(),
+                'server_cache': options.cache or 'empty',
+                }
+
+    finally:
+        shutil.rmtree(xplane_path, ignore_errors=True)
+        if not options.cache:
+            shutil.rmtree(cache, ignore_errors=True)
+
+
+def run(options):
+    rnd = random.Random(options.seed)
+    xplane_path = tempfile.mkdtemp(prefix='noaweather-harness')
+
+    try:
+        module, plugin = load_plugin(xplane_path, {'tracker_enabled': False,
+                                                   'use_tiles': not options.no_tiles,
+                                                   'profiling': options.profiling})
+
+        server = FakeServer(options.payloads and FakeServer.load(options.payloads))
+        responses = []
+
+        def send(msg):
+            response = server.answer(msg)
+            if response:
+                responses.append(response)
+
+        weather = plugin.weather
+        weather.weatherClientSend = send
+        weather.weatherClientThread = True
+        plugin.newAptLoaded = True
+
+        if options.status:
+            plugin.mainMenuCB(None, 1)
+
+        if options.track:
+            track = FlightTrack.load(options.track)
+            duration = min(options.duration, len(track.positions) - 1)
+        else:
+            duration = options.duration
+            track = FlightTrack.synthetic(rnd, options.speed, duration)
+
+        dt = 1.0 / options.fps
+        frames = int(duration * options.fps)
+
+        cpu, allocations, client = Histogram(size=frames), Histogram(size=frames), Histogram(size=frames)
+        last_snapshot = 0
+        start = time.time()
+
+        for frame in range(frames):
+            t = frame * dt
+            lat, lon, alt, speed = track.at(t)
+            xplmstub.set_dataref('sim/flightmodel/position/latitude', lat)
+            xplmstub.set_dataref('sim/flightmodel/position/longitude', lon)
+            xplmstub.set_dataref('sim/flightmodel/position/elevation', alt)
+            xplmstub.set_dataref('sim/flightmodel/position/y_agl', alt)
+            xplmstub.set_dataref('sim/flightmodel/position/groundspeed', speed)
+
+            # Client thread work: decode responses and publish snapshots
+            if responses or t - last_snapshot > 0.5:
+                cstart = time.clock()
+                while responses:
+                    weather.handleResponse(cPickle.loads(responses.pop(0)))
+                weather.updateSnapshot()
+                client.add(time.clock() - cstart)
+                last_snapshot = t
+
+            gc.disable()
+            objects = gc.get_count()[0]
+            fstart = time.clock()
+
+            xplmstub.run_flight_loops(dt, frame)
+
+            cpu.add(time.clock() - fstart)
+            allocations.add(gc.get_count()[0] - objects)
+            gc.enable()
+
+        elapsed = time.time() - start
+
+        results = {'config': {'duration': duration,
+                              'fps': options.fps,
+                              'frames': frames,
+                              'track': options.track or 'synthetic',
+                              'payloads': options.payloads or 'synthetic',
+                              'status_window': options.status,
+                              'tiles': not options.no_tiles,
+                              },
+                   'elapsed': elapsed,
+                   'frame_cpu_ms': cpu.summary(),
+                   'frame_allocations': allocations.summary(scale=1),
+                   'client_cpu_ms': client.summary(),
+                   'tasks_ms': plugin.scheduler.report(),
+                   'dataref_writes': module.EasyDref.writeStats(),
+                   'sdk_calls': dict(xplmstub.calls),
+                   'requests': server.requests,
+                   'cloud_redraws': weather.cloudSolver.redraws,
+                   }
+
+        plugin.XPluginStop()
+        return results
+
+    finally:
+        shutil.rmtree(xplane_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Headless plugin flight loop benchmark')
+    parser.add_argument('--duration', type=float, default=300, help='Simulated seconds')
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--track', help='Track file, one lat,lon[,alt ft] position per second')
+    parser.add_argument('--speed', type=float, default=450, help='Synthetic track ground speed in kt')
+    parser.add_argument('--payloads', help='Recorded weather server responses')
+    parser.add_argument('--status', action='store_true', help='Open the status window')
+    parser.add_argument('--no-tiles', action='store_true', help='Disable grid tiles')
+    parser.add_argument('--profiling', action='store_true', help='Enable the perf datarefs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--startup', action='store_true', help='Run the startup benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='Server starts of the startup benchmark')
+    parser.add_argument('--cache', help='Server cache directory of the startup benchmark')
+    parser.add_argument('--port', type=int, default=18950, help='Server port of the startup benchmark')
+    parser.add_argument('--json', help='Write the results to a file, - for stdout')
+    options = parser.parse_args()
+
+    if options.json == '-':
+        # Only the results on stdout, the plugin prints go to stderr
+        sys.stdout = sys.stderr
+
+    results = startup(options) if options.startup else run(options)
+    if options.json == '-':
+        sys.stdout = sys.__stdout__
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        pprint(results, width=160)
@@ -0,0 +1,228 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import heapq
+import threading
+import time
+import Queue
+import traceback
+
+from stats import stats
+from serverlog import log
+
+
+logger = log.logger('jobs')
+
+
+class Job(object):
+    """Scheduled weather source job"""
+
+    __slots__ = ('name', 'function', 'lane', 'interval', 'callback', 'backoff', 'max_backoff',
+                 'due', 'seq', 'running', 'triggered', 'runs', 'failures', 'last_run', 'duration', 'error')
+
+    def __init__(self, name, function, lane, interval, callback, backoff, max_backoff):
+        self.name = name
+        self.function = function
+        self.lane = lane
+        self.interval = interval
+        self.callback = callback
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Heap entry identifier, older entries of the job are ignored
+        self.due = 0
+        self.seq = 0
+        self.running = False
+        self.triggered = False
+
+        self.runs = 0
+        # Consecutive failures
+        self.failures = 0
+        self.last_run = 0
+        self.duration = 0
+        self.error = None
+
+    def next_delay(self, result, error):
+        """Seconds to the next run or None for finished one time jobs"""
+        if self.triggered:
+            return 0
+        if error is not None:
+            return min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+        if result is not None:
+            return result
+        return self.interval
+
+
+class Lane(threading.Thread):
+    """Runs the jobs of a lane in order, each lane runs on its own thread"""
+
+    def __init__(self, name, scheduler):
+        self.scheduler = scheduler
+        self.queue = Queue.Queue()
+        threading.Thread.__init__(self, name='lane-%s' % name)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            start = time.time()
+            result, error = None, None
+            try:
+                result = job.function()
+            except Exception as err:
+                error = err
+                logger.error('Job %s failed: %s\n%s' % (job.name, str(err), traceback.format_exc().rstrip()))
+
+            self.scheduler.done(job, result, error, time.time() - start)
+
+
+class JobScheduler(threading.Thread):
+    """Runs weather source jobs when they are due
+
+    Jobs return the seconds to their next run, or None to run again after interval seconds
+    (one time jobs have no interval). Failed jobs are retried with exponential backoff.
+
+    Jobs of the same lane run in order on the lane thread, different lanes run concurrently:
+    a slow METAR update doesn't delay a GFS cycle download.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.heap = []
+        self.lanes = {}
+        self.seq = 0
+
+        self.condition = threading.Condition()
+        self.die = threading.Event()
+        threading.Thread.__init__(self, name='scheduler')
+        self.daemon = True
+
+    def add(self, name, function, lane='default', delay=0, interval=None, callback=None, backoff=30,
+            max_backoff=1800):
+        """Schedules a job
+
+        Args:
+            name (str): Unique job name
+            function (callable): Job function, returns the seconds to the next run or None
+            lane (str): Jobs of the same lane never run concurrently
+            delay (float): Seconds to the first run
+            interval (float): Default seconds between runs, None for one time jobs
+            callback (callable): Called with the result or the exception after each run
+            backoff (float): First retry delay after a failure, doubled on each consecutive failure
+        """
+        job = Job(name, function, lane, interval, callback, backoff, max_backoff)
+        with self.condition:
+            self.jobs[name] = job
+            if lane not in self.lanes:
+                self.lanes[lane] = Lane(lane, self)
+                if self.is_alive():
+                    self.lanes[lane].start()
+            self.push(job, delay)
+        return job
+
+    def push(self, job, delay):
+        """Adds a job to the heap, must be called with the condition held"""
+        self.seq += 1
+        job.seq = self.seq
+        job.due = time.time() + delay
+        heapq.heappush(self.heap, (job.due, job.seq, job))
+        self.condition.notify()
+
+    def trigger(self, name, delay=0):
+        """Runs a job now or in delay seconds if sooner than scheduled"""
+        with self.condition:
+            job = self.jobs.get(name)
+            if not job:
+                return
+            if job.running:
+                job.triggered = True
+            elif time.time() + delay < job.due:
+                self.push(job, delay)
+
+    def remove(self, name):
+        with self.condition:
+            self.jobs.pop(name, None)
+
+    def done(self, job, result, error, duration):
+        """Called by the lane threads when a job finishes"""
+        stats.timing('job.%s' % job.name, duration)
+
+        with self.condition:
+            job.running = False
+            job.runs += 1
+            job.last_run = time.time()
+            job.duration = duration
+            job.error = error and str(error)
+            if error is not None:
+                job.failures += 1
+                stats.incr('job_errors.%s' % job.name)
+            else:
+                job.failures = 0
+
+            delay = job.next_delay(result, error)
+            job.triggered = False
+            if delay is None or self.jobs.get(job.name) is not job:
+                self.jobs.pop(job.name, None)
+            elif not self.die.isSet():
+                self.push(job, delay)
+
+        if job.callback:
+            job.callback(error if error is not None else result)
+
+    def run(self):
+        for lane in self.lanes.values():
+            lane.start()
+
+        with self.condition:
+            while not self.die.isSet():
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due, seq, job = heapq.heappop(self.heap)
+                    if job.seq != seq or self.jobs.get(job.name) is not job:
+                        # Rescheduled or removed
+                        continue
+                    stats.timing('job_lag', now - due)
+                    job.running = True
+                    self.lanes[job.lane].queue.put(job)
+
+                timeout = self.heap[0][0] - now if self.heap else 60
+                self.condition.wait(min(timeout, 60))
+
+    def queue(self):
+        """Returns the job queue for diagnostics, sorted by due time"""
+        now = time.time()
+        with self.condition:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.due)
+            return [{'name': job.name,
+                     'lane': job.lane,
+                     'due_in': 0 if job.running else round(job.due - now, 1),
+                     'running': job.running,
+                     'runs': job.runs,
+                     'failures': job.failures,
+                     'last_run': round(now - job.last_run, 1) if job.last_run else None,
+                     'duration_ms': job.duration * 1000,
+                     'error': job.error,
+                     } for job in jobs]
+
+    def shutdown(self, timeout=3):
+        """Stops the scheduler and waits for the running jobs"""
+        self.die.set()
+        with self.condition:
+            self.condition.notify()
+        for lane in self.lanes.values():
+            lane.queue.put(None)
+        for lane in self.lanes.values():
+            if lane.is_alive():
+                lane.join(timeout)
+        if self.is_alive():
+            self.join(timeout)
@@ -12,16 +12,22 @@ import re
 import os
 import sqlite3
 import math
+import operator
+import struct
 import sys
 from datetime import datetime, timedelta
 import time
-from util import util
+from util import util, LRUCache
 
 from c import c
 from weathersource import WeatherSource
-from weathersource import GribDownloaderError
 from weathersource import GribDownloader
-from weathersource import AsyncTask
+from stationindex import StationIndex
+from stats import stats
+from serverlog import log
+
+
+logger = log.logger('metar')
 
 
 class Metar(WeatherSource):
@@ -48,6 +54,12 @@ class Metar(WeatherSource):
 
     STATION_UPDATE_RATE = 30  # In days
 
+    # stations.txt fixed width columns: icao, lat deg, lat min, N/S, lon deg, lon min, E/W, elevation
+    STATION_COLUMNS = struct.Struct('20x4s15x2sx2ss2x3sx2ssx4s')
+    STATION_MINUTES = dict((fmt % minutes, round(minutes / 60.0, 4))
+                           for minutes in range(60) for fmt in ('%02d', '%2d'))
+    STATION_HEMISPHERES = {'N': 1, 'S': -1, 'E': 1, 'W': -1}
+
     def __init__(self, conf):
 
         self.cache_path = os.sep.join([conf.cachepath, 'metar'])
@@ -57,11 +69,21 @@ class Metar(WeatherSource):
 
         self.th_db = False
 
-        # Download flags
-        self.ms_download = False
-        self.downloading = False
+        # Stations with a report spatial index, restored by the warm start or built after a METAR update
+        self.index = False
+        self.index_path = os.sep.join([self.cache_path, 'stations.idx'])
+
+        # Parsed reports shared between all the server clients
+        self.parsed_cache = LRUCache(conf.server_cache_size)
+        stats.register_cache('metar', self.parsed_cache)
 
-        self.next_metarRWX = time.time() + 30
+        # Incremented when the reports change
+        self.generation = 0
+        # Aircraft positions for the METAR.rwx radius export, set by the server
+        self.positions = lambda: []
+        # Generation and positions of the last METAR.rwx export
+        self.rwx_generation = -1
+        self.rwx_positions = []
 
         # Main db connection, create db if doens't exist
         createdb = True
@@ -74,13 +96,11 @@ class Metar(WeatherSource):
             conf.ms_update = 0
             self.db_create(self.connection)
 
-        # Metar stations update
-        if (time.time() - conf.ms_update) > self.STATION_UPDATE_RATE * 86400:
-            self.ms_download = AsyncTask(GribDownloader.download, self.METAR_STATIONS_URL, 'stations.txt',
-                                         cancel_event=self.die)
-            self.ms_download.start()
-
-        self.last_timestamp = 0
+    def register(self, scheduler):
+        """METAR jobs share a lane, they use the same database connection"""
+        scheduler.add('stations', self.refresh_stations, lane='metar')
+        scheduler.add('metar', self.refresh_metar, lane='metar')
+        scheduler.add('metar_rwx', self.refresh_metar_rwx, lane='metar', delay=30)
 
     def db_connect(self, path):
         """Returns an SQLite connection to the metar database"""
@@ -94,36 +114,87 @@ class Metar(WeatherSource):
         db.commit()
 
     def update_stations(self, db, path):
-        """Updates db's airport information from the METAR station file"""
+        """Updates db's airport information from the METAR station file, keeping the reports
 
-        cursor = db.cursor()
-        parsed = 0
+        Returns the number of stations.
+        """
 
         with open(path, 'r') as f:
-            try:
-                for line in f.readlines():
-                    if line[0] != '!' and len(line) > 80:
-                        icao = line[20:24]
-                        lat = float(line[39:41]) + round(float(line[42:44]) / 60, 4)
-                        if line[44] == 'S':
-                            lat *= -1
-                        lon = float(line[47:50]) + round(float(line[51:53]) / 60, 4)
-                        if line[53] == 'W':
-                            lon *= -1
-                        elevation = int(line[55:59])
-                        if line[20] != ' ' and line[51] != '9':
-                            cursor.execute(
-                                'INSERT OR REPLACE INTO airports (icao, lat, lon, elevation, timestamp) \
-                                 VALUES (?,?,?,?,0)',
-                                (icao.strip('"'), lat, lon, elevation))
-                            parsed += 1
-            except (ValueError, IndexError) as e:
-                print "Error parsing METAR station File: %s" % str(e)
+            lines = f.read().splitlines()
 
+        with stats.timer('metar_stations_parse'):
+            rows, bad = self.parse_stations(lines)
+
+        for number, line in bad[:10]:
+            logger.warning("Error parsing METAR station file line %d: %s" % (number, line.strip()))
+        if bad:
+            logger.warning("%d bad lines in the METAR station file." % len(bad))
+
+        cursor = db.cursor()
+
+        # The report columns are never written: known stations are updated and new ones added
+        with stats.timer('metar_stations_load'):
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.executemany('UPDATE airports SET lat = ?, lon = ?, elevation = ? WHERE icao = ?',
+                               [(lat, lon, elevation, icao) for icao, lat, lon, elevation in rows])
+            cursor.executemany('INSERT OR IGNORE INTO airports (icao, lat, lon, elevation, timestamp, metar) '
+                               'VALUES (?, ?, ?, ?, 0, NULL)', rows)
             db.commit()
-            self.conf.ms_update = time.time()
+        self.conf.ms_update = time.time()
+        self.generation += 1
+
+        return len(rows)
 
-        return parsed
+    @classmethod
+    def parse_stations(cls, lines):
+        """Parses the station file lines by columns
+
+        Returns the station rows (icao, lat, lon, elevation) and the bad (line number, line) list.
+        """
+        # Station lines with a location
+        numbers = [i for i, line in enumerate(lines)
+                   if len(line) >= 80 and line[0] != '!' and line[20] != ' ' and line[51] != '9']
+        if not numbers:
+            return [], []
+
+        icaos, lat_deg, lat_min, ns, lon_deg, lon_min, ew, elevation = zip(
+            *map(cls.STATION_COLUMNS.unpack_from, [lines[i] for i in numbers]))
+
+        bad = set()
+        minutes = cls.STATION_MINUTES.__getitem__
+        hemisphere = cls.STATION_HEMISPHERES.__getitem__
+
+        lats = map(operator.mul, map(operator.add, cls.parse_column(lat_deg, float, bad),
+                                     cls.parse_column(lat_min, minutes, bad)),
+                   cls.parse_column(ns, hemisphere, bad))
+        lons = map(operator.mul, map(operator.add, cls.parse_column(lon_deg, float, bad),
+                                     cls.parse_column(lon_min, minutes, bad)),
+                   cls.parse_column(ew, hemisphere, bad))
+        elevation = cls.parse_column(elevation, int, bad)
+
+        if '"' in ''.join(icaos):
+            icaos = [icao.strip('"') for icao in icaos]
+
+        rows = zip(icaos, lats, lons, elevation)
+        if bad:
+            rows = [row for i, row in enumerate(rows) if i not in bad]
+
+        return rows, [(numbers[i] + 1, lines[numbers[i]]) for i in sorted(bad)]
+
+    @staticmethod
+    def parse_column(column, cast, bad):
+        """Casts a column, adds the index of the values that can't be parsed to bad"""
+        try:
+            return map(cast, column)
+        except (ValueError, KeyError):
+            values = []
+            for i, value in enumerate(column):
+                try:
+                    values.append(cast(value))
+                except (ValueError, KeyError):
+                    bad.add(i)
+                    values.append(0)
+            return values
 
     def update_metar(self, db, path):
         """Updates metar table from Metar file"""
@@ -176,11 +247,19 @@ class Metar(WeatherSource):
 
         f.close()
 
+        if nupdated:
+            self.generation += 1
+
         if not self.conf.keepOldFiles:
             util.remove(path)
 
         return nupdated, nparsed
 
+    @staticmethod
+    def has_stations(db):
+        """True once the stations table has been loaded"""
+        return db.cursor().execute('SELECT 1 FROM airports LIMIT 1').fetchone() is not None
+
     @staticmethod
     def clear_reports(db):
         """Clears all metar reports from the db"""
@@ -188,9 +267,31 @@ class Metar(WeatherSource):
         cursor.execute('UPDATE airports SET metar = NULL, timestamp = 0')
         db.commit()
 
+    def build_index(self, db):
+        """Builds and saves the spatial index of the stations with a report"""
+        cursor = db.cursor()
+        with stats.timer('metar_index'):
+            rows = cursor.execute('SELECT icao, lat, lon, elevation FROM airports WHERE metar NOT NULL').fetchall()
+            index = StationIndex.build(rows)
+            # Swap before closing, lookups take a reference to the current index
+            old_index, self.index = self.index, index
+            if old_index:
+                old_index.close()
+            index.save(self.index_path)
+
     def get_closest_station(self, db, lat, lon, limit=1):
         """Return the closest airport with a metar report"""
 
+        index = self.index
+        if index and limit == 1:
+            try:
+                station = index.nearest(lat, lon, self.conf.ignore_metar_stations or ())
+            except ValueError:
+                # Closed by a rebuild, use the database
+                station = False
+            if station:
+                return self.get_metar(db, station[0])
+
         cursor = db.cursor()
         fudge = math.pow(math.cos(math.radians(lat)), 2)
 
@@ -237,6 +338,15 @@ class Metar(WeatherSource):
         timestamp = int(time.time())
         return ('%02d' % current_cycle.hour, timestamp)
 
+    def get_parsed_metar(self, icao, metar, airport_msl=0):
+        """Returns a copy of the parsed METAR using the shared cache"""
+        key = (icao, metar, airport_msl)
+        weather = self.parsed_cache.get(key)
+        if weather is None:
+            weather = self.parse_metar(icao, metar, airport_msl)
+            self.parsed_cache.set(key, weather)
+        return dict(weather)
+
     @classmethod
     def parse_metar(cls, icao, metar, airport_msl=0):
         """Returns a parsed METAR"""
@@ -383,59 +493,95 @@ class Metar(WeatherSource):
 
         return weather
 
-    def run(self, elapsed):
+    def cache_files(self):
+        return [self.database, os.sep.join([self.cache_path, 'stations.txt'])] + list(StationIndex.paths(self.index_path))
 
-        # Worker thread requires it's own db connection and cursor
+    def worker_db(self):
+        """The jobs lane thread requires its own db connection"""
         if not self.th_db:
             self.th_db = self.db_connect(self.database)
+        return self.th_db
+
+    def refresh_stations(self):
+        """Updates the stations table every STATION_UPDATE_RATE days"""
+        update_rate = self.STATION_UPDATE_RATE * 86400
+        age = time.time() - self.conf.ms_update
+
+        if not self.conf.download:
+            return update_rate
+        if age < update_rate:
+            return update_rate - age
+
+        stations = self.submit(GribDownloader.download,
+                               self.METAR_STATIONS_URL,
+                               os.sep.join([self.cache_path, 'stations.txt']),
+                               host=self.METAR_STATIONS_URL,
+                               timeout=self.conf.download_timeout).result()
+
+        logger.info('Updating metar stations.')
+        nstations = self.update_stations(self.worker_db(), stations)
+        self.build_index(self.worker_db())
+        logger.info('%d metar stations updated.' % nstations)
+
+        return update_rate
+
+    def refresh_metar(self):
+        """Downloads and updates the current METAR cycle"""
+        if self.conf.download:
+            if not self.has_stations(self.worker_db()):
+                # Reports of unknown stations are lost, wait for the first stations load
+                return 60
 
-        # Check for new metar downloaded data
-        if self.download:
-            if not self.download.pending():
-
-                metar_file = self.download.result
-                self.download.join()
-                if isinstance(metar_file, GribDownloaderError):
-                    print "Error downloading METAR: %s" % str(metar_file)
-                else:
-                    print 'Successfully downloaded: %s' % metar_file.split(os.path.sep)[-1]
-                    updated, parsed = self.update_metar(self.th_db, metar_file)
-                    print "METAR updated/parsed: %d/%d" % (updated, parsed)
-
-                self.download = False
-
-        elif self.conf.download:
-            # Download new data if required
             cycle, timestamp = self.get_current_cycle()
-            if (timestamp - self.last_timestamp) > self.conf.metar_updaterate * 60:
-                self.last_timestamp = timestamp
-                self.download_cycle(cycle, timestamp)
-
-        # Update stations table if required
-        if self.ms_download and not self.ms_download.pending():
-            stations = self.ms_download.result
-
-            if isinstance(stations, GribDownloaderError):
-                print "Error downloading metar stations file %s" % stations.message
-
-            else:
-                print 'Updating metar stations.'
-                nstations = self.update_stations(self.th_db, self.ms_download.result)
-                print '%d metar stations updated.' % nstations
-            self.ms_download = False
-
-        # Update METAR.rwx
-        if self.conf.updateMetarRWX and self.conf.syspath and self.next_metarRWX < time.time():
-            if self.update_metar_rwx_file(self.th_db):
-                self.next_metarRWX = time.time() + 300
-                print 'Updated METAR.rwx file.'
-            else:
-                # Retry in 10 sec
-                self.next_metarRWX = time.time() + 10
+            metar_file = self.download_cycle(cycle, timestamp)
+
+            logger.info('Successfully downloaded: %s' % metar_file.split(os.path.sep)[-1])
+            updated, parsed = self.update_metar(self.worker_db(), metar_file)
+            logger.info("METAR updated/parsed: %d/%d" % (updated, parsed))
+            self.build_index(self.worker_db())
+        elif not self.index:
+            self.build_index(self.worker_db())
+
+        return self.conf.metar_updaterate * 60
+
+    def refresh_metar_rwx(self):
+        """Updates METAR.rwx if the reports or, in radius mode, the aircraft positions changed"""
+        if not self.conf.updateMetarRWX or not self.conf.syspath:
+            return 300
+
+        radius = self.conf.metar_rwx_radius
+        if radius:
+            positions = self.positions()
+            if not positions or (self.generation == self.rwx_generation
+                                 and not self.positions_moved(positions, radius / 4.0)):
+                return 60
+        elif self.generation == self.rwx_generation and not self.rwx_positions:
+            return 300
+        else:
+            positions = None
+
+        generation = self.generation
+        stations = self.update_metar_rwx_file(self.worker_db(), positions, radius)
+        if stations is False:
+            # Retry in 10 sec
+            return 10
+
+        self.rwx_generation = generation
+        self.rwx_positions = positions or []
+        logger.info('Updated METAR.rwx file: %d stations.' % stations)
+        return 60 if radius else 300
+
+    def positions_moved(self, positions, distance):
+        """Returns True if an aircraft moved more than distance nm since the last export"""
+        if len(positions) != len(self.rwx_positions):
+            return True
+        for position in positions:
+            if min(c.greatCircleDistance(position, last) for last in self.rwx_positions) > distance * 1852:
+                return True
+        return False
 
     def download_cycle(self, cycle, timestamp):
-        self.downloading = True
-
+        """Downloads a METAR cycle, returns the file path"""
         if not os.path.exists(self.cache_path):
             os.makedirs(self.cache_path)
 
@@ -451,33 +597,67 @@ class Metar(WeatherSource):
             url = self.IVAO_METAR_URL
 
         cache_file = os.path.sep.join([self.cache_path, '%s_%d_%sZ.txt' % (prefix, timestamp, cycle)])
-        print "Downloading METAR: %s" % cache_file.split(os.path.sep)[-1]
-        self.download = AsyncTask(GribDownloader.download, url, cache_file, cancel_event=self.die)
-        self.download.start()
+        logger.info("Downloading METAR: %s" % cache_file.split(os.path.sep)[-1])
+        return self.submit(GribDownloader.download, url, cache_file, host=url,
+                           timeout=self.conf.download_timeout).result()
+
+    def update_metar_rwx_file(self, db, positions=None, radius=0):
+        """Writes the METAR.rwx file, returns the number of stations or False on error
+
+        Writes to a temporary file renamed over METAR.rwx, x-plane never reads a partial file.
 
-    def update_metar_rwx_file(self, db):
-        """Dumps all metar data to the METAR.rwx file"""
+        Args:
+            positions (list): Only write the stations within radius nm of the (lat, lon) positions
+        """
 
         cursor = db.cursor()
+        path = os.sep.join([self.conf.syspath, 'METAR.rwx'])
+        tmp_path = '%s.tmp' % path
 
-        try:
-            f = open(os.sep.join([self.conf.syspath, 'METAR.rwx']), 'w')
-        except (OSError, IOError):
-            print "ERROR updating METAR.rwx file: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
-            return False
-
-        res = cursor.execute('SELECT icao, metar FROM airports WHERE metar NOT NULL')
-
-        while True:
-            rows = res.fetchmany()
-            if rows:
-                for row in rows:
-                    f.write('%s %s\n' % (row[0], row[1]))
-            else:
-                break
+        with stats.timer('metar_rwx'):
+            try:
+                with open(tmp_path, 'w', 1 << 20) as f:
+                    if positions:
+                        rows = self.stations_near(cursor, positions, radius)
+                        f.writelines('%s %s\n' % row for row in rows)
+                        nstations = len(rows)
+                    else:
+                        nstations = 0
+                        res = cursor.execute('SELECT icao, metar FROM airports WHERE metar NOT NULL')
+                        while True:
+                            rows = res.fetchmany(4096)
+                            if not rows:
+                                break
+                            f.writelines('%s %s\n' % row for row in rows)
+                            nstations += len(rows)
+
+                util.replace(tmp_path, path)
+            except (OSError, IOError):
+                logger.error("ERROR updating METAR.rwx file: %s %s" % (sys.exc_info()[0], sys.exc_info()[1]))
+                return False
+
+        return nstations
 
-        f.close()
-        return True
+    @staticmethod
+    def stations_near(cursor, positions, radius):
+        """Returns the (icao, metar) of the stations within radius nm of any of the positions"""
+        stations = {}
+        for lat, lon in positions:
+            dlat = radius / 60.0
+            dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+
+            q = 'SELECT icao, lat, lon, metar FROM airports WHERE metar NOT NULL AND lat BETWEEN ? AND ?'
+            args = [lat - dlat, lat + dlat]
+            if -180 < lon - dlon and lon + dlon < 180:
+                # Longitude filter unless the box crosses the antimeridian
+                q += ' AND lon BETWEEN ? AND ?'
+                args += [lon - dlon, lon + dlon]
+
+            for icao, slat, slon, metar in cursor.execute(q, args):
+                if icao not in stations and c.greatCircleDistance((lat, lon), (slat, slon)) <= radius * 1852:
+                    stations[icao] = metar
+
+        return stations.items()
 
     def shutdown(self):
         super(Metar, self).shutdown()
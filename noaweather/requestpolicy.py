@@ -0,0 +1,93 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+from math import cos, radians, sqrt
+
+from c import c
+
+
+class RequestPolicy(object):
+    """Decides when to request new weather data for the aircraft position
+
+    A new request is sent when the aircraft has moved a distance from the last requested position
+    that depends on the data resolution relevant at its height: METAR station spacing near the
+    ground and the WAFS/GFS grid aloft (the grid tile interpolates between nodes). Distances are
+    measured from the last request, not to cell boundaries, so position jitter can't retrigger it.
+
+    Requests are never repeated while one is in flight, unless it timed out.
+    """
+
+    # Distance thresholds in degrees of latitude
+    METAR_SPACING = 0.1
+    GRID_SPACING = 0.25  # Half a GFS cell, a WAFS cell
+
+    # Height AGL (m) range where the METAR threshold is blended to the grid one
+    LOW_AGL = c.f2m(5000)
+    HIGH_AGL = c.f2m(20000)
+
+    def __init__(self, refresh=60, min_interval=5, timeout=5, still_speed=1):
+        self.refresh = refresh
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.still_speed = still_speed  # m/s
+
+        self.lat, self.lon = False, False
+        self.sent = -refresh
+        self.in_flight = False
+
+        self.requests = 0
+
+    def threshold(self, agl):
+        """Minimum displacement in degrees for a new request"""
+        x = c.limit((agl - self.LOW_AGL) / (self.HIGH_AGL - self.LOW_AGL), 1, 0)
+        return self.METAR_SPACING + (self.GRID_SPACING - self.METAR_SPACING) * x
+
+    def distance(self, lat, lon):
+        """Approximate distance to the last request in degrees of latitude"""
+        dlon = (lon - self.lon + 180) % 360 - 180
+        return sqrt((lat - self.lat) ** 2 + (dlon * cos(radians(lat))) ** 2)
+
+    def check(self, now, lat, lon, agl, speed):
+        """Returns True if a request should be sent now
+
+        Args:
+            now (float): Time in seconds
+            agl (float): Height over the ground in meters
+            speed (float): Ground speed in m/s
+        """
+        age = now - self.sent
+
+        if self.in_flight and age < self.timeout:
+            return False
+        if age < self.min_interval:
+            return False
+
+        if self.lat is False or age > self.refresh:
+            return True
+
+        if speed < self.still_speed:
+            return False
+
+        return self.distance(lat, lon) > self.threshold(agl)
+
+    def send(self, now, lat, lon):
+        self.lat, self.lon = lat, lon
+        self.sent = now
+        self.in_flight = True
+        self.requests += 1
+
+    def received(self):
+        """Called on the weather client thread for each weather response"""
+        self.in_flight = False
+
+    def reset(self):
+        """Forces a request on the next check"""
+        self.lat, self.lon = False, False
+        self.in_flight = False
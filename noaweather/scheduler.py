@@ -0,0 +1,148 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+# time.clock on win32, time.time resolution there is ~15ms
+from timeit import default_timer as timer
+from contextlib import contextmanager
+
+from stats import Histogram
+
+
+class Task(object):
+    """Flight loop task"""
+
+    __slots__ = ('name', 'function', 'interval', 'priority', 'budget', 'elapsed', 'pending', 'deferred',
+                 'overruns', 'last', 'timing')
+
+    def __init__(self, name, function, interval, priority, budget):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.priority = priority
+        self.budget = budget
+        # Time since the last run
+        self.elapsed = 0
+        self.pending = False
+        # Consecutive deferred frames and total budget overruns
+        self.deferred = 0
+        self.overruns = 0
+        # Last run duration
+        self.last = 0
+        self.timing = Histogram(size=512)
+
+
+class FrameScheduler(object):
+    """Runs the flight loop tasks at their rate within a frame time budget
+
+    Tasks run every frame (interval 0), every interval seconds or on demand (ON_DATA) after
+    a trigger(). Tasks are called with the time elapsed since their last run.
+
+    Low priority tasks are deferred to the next frames if the frame is long or the frame budget
+    is already spent, up to max_defer frames.
+    """
+
+    EVERY_FRAME = 0
+    ON_DATA = -1
+
+    HIGH = 0
+    LOW = 1
+
+    def __init__(self, budget=0.002, long_frame=1 / 20.0, max_defer=10):
+        self.budget = budget
+        self.long_frame = long_frame
+        self.max_defer = max_defer
+        self.tasks = []
+        self.names = {}
+        self.frames = 0
+
+        # Frame total and task phases timings
+        self.frame = Histogram(size=512)
+        self.phases = {}
+
+    def add(self, name, function, interval=EVERY_FRAME, priority=HIGH, budget=0.001):
+        """Adds a task, tasks are run in the added order"""
+        task = Task(name, function, interval, priority, budget)
+        self.tasks.append(task)
+        self.names[name] = task
+        return task
+
+    def trigger(self, name):
+        """Runs an on demand task on the next frame"""
+        self.names[name].pending = True
+
+    def run(self, elapsed):
+        self.frames += 1
+        start = timer()
+        long_frame = elapsed > self.long_frame
+
+        for task in self.tasks:
+            task.elapsed += elapsed
+
+            if task.interval == self.ON_DATA:
+                if not task.pending:
+                    continue
+            elif task.elapsed < task.interval:
+                continue
+
+            if task.priority == self.LOW and task.deferred < self.max_defer \
+                    and (long_frame or timer() - start + task.last > self.budget):
+                task.deferred += 1
+                continue
+
+            tstart = timer()
+            task.pending = False
+            task.function(task.elapsed)
+            task.last = timer() - tstart
+
+            task.timing.add(task.last)
+            if task.last > task.budget:
+                task.overruns += 1
+            task.elapsed = 0
+            task.deferred = 0
+
+        self.frame.add(timer() - start)
+
+    @contextmanager
+    def phase(self, name):
+        """Times a part of a task"""
+        start = timer()
+        try:
+            yield
+        finally:
+            if name not in self.phases:
+                self.phases[name] = Histogram(size=512)
+            self.phases[name].add(timer() - start)
+
+    def histograms(self):
+        """Returns all the timing histograms by name"""
+        histograms = {'frame': self.frame}
+        histograms.update(self.phases)
+        for task in self.tasks:
+            histograms[task.name] = task.timing
+        return histograms
+
+    def histogram(self, bounds=(0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01)):
+        """Returns a text histogram of all the timings"""
+        lines = ['%-12s' % 'ms' + ''.join(['%8s' % ('<%g' % (bound * 1000)) for bound in bounds])
+                 + '%8s' % ('>%g' % (bounds[-1] * 1000))]
+        for name, histogram in sorted(self.histograms().items()):
+            lines.append('%-12s' % name + ''.join(['%8d' % count for count in histogram.buckets(bounds)]))
+        return '\n'.join(lines)
+
+    def report(self):
+        """Returns the tasks timings in ms"""
+        report = {'frames': self.frames, 'frame': self.frame.summary()}
+        for name, histogram in self.phases.items():
+            report[name] = histogram.summary()
+        for task in self.tasks:
+            summary = task.timing.summary()
+            summary['overruns'] = task.overruns
+            report[task.name] = summary
+        return report
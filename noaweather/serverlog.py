@@ -0,0 +1,222 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import os
+import sys
+import threading
+import time
+import Queue
+
+from util import util
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+
+class Logger(object):
+    """Module logger"""
+
+    __slots__ = ('server_log', 'name')
+
+    def __init__(self, server_log, name):
+        self.server_log = server_log
+        self.name = name
+
+    def enabled(self, level):
+        return self.server_log.enabled(self.name, level)
+
+    def debug(self, message):
+        self.server_log.log(self.name, DEBUG, message)
+
+    def info(self, message):
+        self.server_log.log(self.name, INFO, message)
+
+    def warning(self, message):
+        self.server_log.log(self.name, WARNING, message)
+
+    def error(self, message):
+        self.server_log.log(self.name, ERROR, message)
+
+
+class LogStream(object):
+    """File like object sending the print output to the log, one message per line"""
+
+    def __init__(self, server_log, name, level):
+        self.server_log = server_log
+        self.name = name
+        self.level = level
+        # print writes the message and the new line apart
+        self.local = threading.local()
+
+    def write(self, data):
+        buffered = getattr(self.local, 'buffer', '') + data
+        lines = buffered.split('\n')
+        self.local.buffer = lines.pop()
+        for line in lines:
+            self.server_log.log(self.name, self.level, line)
+
+    def flush(self):
+        pass
+
+
+class ServerLog(object):
+    """Weather server log
+
+    Messages under the module level are discarded by the caller thread, the rest wait in a bounded
+    queue for the writer thread: logging doesn't add file I/O to the requests. Messages are
+    dropped when the queue is full.
+
+    The log file is rotated at max_bytes keeping backups files, path.1 being the newest.
+    Messages are printed directly until start().
+    """
+
+    def __init__(self):
+        self.level = INFO
+        self.modules = {}
+        self.queue = Queue.Queue(4096)
+        self.max_bytes = 0
+        self.backups = 0
+
+        self.path = None
+        self.stream = None
+        self.thread = None
+        self.dropped = 0
+
+    @staticmethod
+    def level_number(level):
+        """Returns the level of a level name"""
+        for number, name in LEVEL_NAMES.items():
+            if name == str(level).upper():
+                return number
+        raise ValueError('Unknown log level: %s' % level)
+
+    def configure(self, conf):
+        """Sets the levels, queue and rotation from the configuration"""
+        self.level = self.level_number(conf.log_level)
+        self.modules = dict((name, self.level_number(level)) for name, level in conf.log_modules.items())
+        self.queue = Queue.Queue(conf.log_queue_size)
+        self.max_bytes = conf.log_max_size * 1024 * 1024
+        self.backups = conf.log_backups
+
+    def logger(self, name):
+        return Logger(self, name)
+
+    def enabled(self, name, level):
+        return level >= self.modules.get(name, self.level)
+
+    def log(self, name, level, message):
+        if level < self.modules.get(name, self.level):
+            return
+
+        if not self.thread:
+            try:
+                sys.__stdout__.write('%s\n' % message)
+            except (IOError, AttributeError):
+                # No console
+                pass
+            return
+
+        try:
+            self.queue.put_nowait((time.time(), name, level, message))
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self, path=None):
+        """Starts the writer thread, logs to the console without path"""
+        self.path = path
+        self.stream = open(path, 'a') if path else sys.__stdout__
+
+        self.thread = threading.Thread(target=self.writer, name='log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writer(self):
+        last_second, timestamp = 0, ''
+        dropped = 0
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 512:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    break
+                second, name, level, message = record
+                if int(second) != last_second:
+                    last_second = int(second)
+                    timestamp = time.strftime('%b %d %H:%M:%S', time.gmtime(second))
+                lines.append('%s  %-7s %s: %s\n' % (timestamp, LEVEL_NAMES[level], name, message))
+
+            if self.dropped != dropped:
+                lines.append('%s  %-7s log: %d messages dropped, queue full\n' % (timestamp, 'WARNING',
+                                                                                self.dropped - dropped))
+                dropped = self.dropped
+
+            self.write(lines)
+
+            if None in batch:
+                return
+            if self.path and self.max_bytes and self.stream.tell() > self.max_bytes:
+                try:
+                    self.rotate()
+                except (OSError, IOError) as err:
+                    # Keep draining the queue without rotation, to the console if the file is gone
+                    if self.stream.closed:
+                        self.stream, self.path = sys.__stdout__, None
+                    self.max_bytes = 0
+                    self.write(['%s  %-7s log: rotation failed, disabled: %s\n' % (timestamp, 'ERROR', err)])
+
+    def write(self, lines):
+        try:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except (IOError, ValueError, AttributeError):
+            # Disk full or no console
+            pass
+
+    def rotate(self):
+        """Moves the log file to path.1, path.1 to path.2... and reopens it
+
+        The file is reopened even if a move fails, the stream is left closed only if it can't be.
+        """
+        self.stream.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                backup = '%s.%d' % (self.path, i)
+                if os.path.isfile(backup):
+                    util.rename(backup, '%s.%d' % (self.path, i + 1))
+            if self.backups:
+                util.rename(self.path, '%s.1' % self.path)
+            else:
+                util.remove(self.path)
+        finally:
+            self.stream = open(self.path, 'a')
+
+    def shutdown(self, timeout=3):
+        """Writes the pending messages and stops the writer thread"""
+        if not self.thread:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.thread = None
+        if self.path:
+            self.stream.close()
+
+
+# Server wide log
+log = ServerLog()
@@ -0,0 +1,139 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import os
+import math
+import mmap
+import struct
+import cPickle
+
+from util import util
+
+
+class StationIndex(object):
+    """Spatial index of the METAR stations with a report
+
+    Stations are bucketed in 1 degree cells. Records (icao, lat, lon, elevation) are stored sorted
+    by cell in a buffer that can be saved to a file and memory mapped back, cells keeps the
+    (first record, count) of each cell.
+    """
+
+    RECORD = struct.Struct('=4sffi')
+
+    def __init__(self, records, cells):
+        self.records = records
+        self.cells = cells
+        self.size = len(records) / self.RECORD.size if records else 0
+
+    @staticmethod
+    def cell(lat, lon):
+        return int(math.floor(lat)), int(math.floor(lon)) % 360
+
+    @classmethod
+    def build(cls, stations):
+        """Builds an index from a list of (icao, lat, lon, elevation)"""
+        buckets = {}
+        for station in stations:
+            buckets.setdefault(cls.cell(station[1], station[2]), []).append(station)
+
+        records, cells, n = [], {}, 0
+        for cell, bucket in buckets.iteritems():
+            cells[cell] = (n, len(bucket))
+            n += len(bucket)
+            for icao, lat, lon, elevation in bucket:
+                records.append(cls.RECORD.pack(str(icao), lat, lon, int(elevation or 0)))
+
+        return cls(''.join(records), cells)
+
+    @staticmethod
+    def paths(path):
+        return path, '%s.cells' % path
+
+    def save(self, path):
+        """Writes the index atomically"""
+        records_path, cells_path = self.paths(path)
+        for target, write in ((records_path, lambda f: f.write(self.records)),
+                              (cells_path, lambda f: cPickle.dump(self.cells, f, cPickle.HIGHEST_PROTOCOL))):
+            tmp = '%s.tmp' % target
+            with open(tmp, 'wb') as f:
+                write(f)
+            if os.path.isfile(target):
+                util.remove(target)
+            os.rename(tmp, target)
+
+    @classmethod
+    def load(cls, path):
+        """Maps a saved index, returns False if not available"""
+        records_path, cells_path = cls.paths(path)
+        try:
+            with open(cells_path, 'rb') as f:
+                cells = cPickle.load(f)
+            if not os.path.getsize(records_path):
+                return cls('', cells)
+            with open(records_path, 'rb') as f:
+                records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError, ValueError):
+            return False
+        return cls(records, cells)
+
+    def close(self):
+        """Unmaps a loaded index, windows can't remove or replace a mapped file"""
+        if isinstance(self.records, mmap.mmap):
+            self.records.close()
+
+    def __len__(self):
+        return self.size
+
+    def station(self, i):
+        icao, lat, lon, elevation = self.RECORD.unpack_from(self.records, i * self.RECORD.size)
+        return icao.rstrip('\0'), lat, lon, elevation
+
+    def nearest(self, lat, lon, exclude=()):
+        """Returns the closest station (icao, lat, lon, elevation) or False
+
+        Distance is dlat^2 + dlon^2 * cos(lat)^2 like the database query, across the antimeridian.
+        Searches cell rings around the position until no closer station can be found.
+        """
+        if not self.size:
+            return False
+
+        fudge = math.cos(math.radians(lat)) ** 2
+        clat, clon = self.cell(lat, lon)
+        best, best_distance = False, float('inf')
+
+        for ring in range(181):
+            # Min distance of any station in this ring
+            if ring > 1 and (ring - 1) ** 2 * min(1, fudge) > best_distance:
+                break
+
+            for dy, dx in self.ring(ring):
+                cell = self.cells.get((clat + dy, (clon + dx) % 360))
+                if not cell:
+                    continue
+                for i in range(cell[0], cell[0] + cell[1]):
+                    station = self.station(i)
+                    dlon = (station[2] - lon + 180) % 360 - 180
+                    distance = (station[1] - lat) ** 2 + dlon ** 2 * fudge
+                    if distance < best_distance and station[0] not in exclude:
+                        best, best_distance = station, distance
+
+        return best
+
+    @staticmethod
+    def ring(ring):
+        """Cell offsets (dy, dx) at ring cells from the center"""
+        if not ring:
+            return [(0, 0)]
+        cells = []
+        for dx in range(-ring, ring + 1):
+            cells += [(ring, dx), (-ring, dx)]
+        for dy in range(-ring + 1, ring):
+            cells += [(dy, ring), (dy, -ring)]
+        return cells
@@ -0,0 +1,164 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pprint import pformat
+
+from serverlog import log
+
+
+logger = log.logger('stats')
+
+
+class Histogram(object):
+    """Keeps the last size samples to compute percentiles"""
+
+    def __init__(self, size=2048):
+        self.size = size
+        self.samples = []
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.index] = value
+            self.index = (self.index + 1) % self.size
+
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def rolling(self):
+        """Returns mean and max of the kept samples"""
+        if not self.samples:
+            return 0, 0
+        return sum(self.samples) / len(self.samples), max(self.samples)
+
+    def buckets(self, bounds):
+        """Returns the kept samples count for each bound and above the last one"""
+        counts = [0] * (len(bounds) + 1)
+        for sample in self.samples:
+            counts[bisect_left(bounds, sample)] += 1
+        return counts
+
+    @staticmethod
+    def percentile(samples, p):
+        """Returns the p percentile of a sorted sample list"""
+        if not samples:
+            return 0
+        return samples[min(int(len(samples) * p / 100.0), len(samples) - 1)]
+
+    def summary(self, scale=1000):
+        """Returns count, mean, p50, p95, p99 and max, values are scaled (ms by default)"""
+        samples = sorted(self.samples)
+        return {'count': self.count,
+                'mean': self.total / self.count * scale if self.count else 0,
+                'p50': self.percentile(samples, 50) * scale,
+                'p95': self.percentile(samples, 95) * scale,
+                'p99': self.percentile(samples, 99) * scale,
+                'max': self.max * scale,
+                }
+
+
+class Stats(object):
+    """Weather server metrics: counters and latency histograms
+
+    Latencies are recorded in seconds and reported in milliseconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.caches = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start)
+
+    def register_cache(self, name, cache):
+        """Adds an LRUCache hit ratio to the report"""
+        self.caches[name] = cache
+
+    def report(self):
+        """Returns a dict with all the metrics"""
+        with self.lock:
+            report = {'uptime': time.time() - self.start,
+                      'counters': dict(self.counters),
+                      'latency_ms': dict((name, histogram.summary())
+                                         for name, histogram in self.histograms.iteritems()),
+                      }
+
+        caches = {}
+        for name, cache in self.caches.items():
+            total = cache.hits + cache.misses
+            caches[name] = {'hits': cache.hits,
+                            'misses': cache.misses,
+                            'ratio': float(cache.hits) / total if total else 0,
+                            'size': len(cache),
+                            }
+        report['caches'] = caches
+
+        download = report['latency_ms'].get('download')
+        if download and download['count']:
+            # Bytes per second while downloading
+            seconds = download['mean'] * download['count'] / 1000
+            report['download_throughput'] = report['counters'].get('download_bytes', 0) / seconds if seconds else 0
+
+        return report
+
+    def dump(self):
+        """Returns the report as printable text"""
+        return pformat(self.report(), width=160)
+
+
+class StatsDump(object):
+    """Periodically prints the metrics to the log, runs as a JobScheduler job"""
+
+    def __init__(self, stats, interval):
+        self.stats = stats
+        self.interval = interval
+
+    def register(self, scheduler):
+        if self.interval:
+            scheduler.add('stats', self.dump, lane='stats', delay=self.interval, interval=self.interval)
+
+    def dump(self):
+        logger.info('Server stats:\n%s' % self.stats.dump())
+
+    def shutdown(self):
+        pass
+
+
+# Server wide metrics
+stats = Stats()
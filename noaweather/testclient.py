@@ -1,6 +1,16 @@
 #!/usr/bin/python
 '''
-Example weather test client
+Example weather test client and load generator
+
+Without options sends the test requests and prints the responses.
+With --bench replays synthetic or recorded flight tracks from concurrent
+simulated clients and reports throughput, tail latency and lost datagrams:
+
+    testclient.py --bench --clients 16 --rate 2 --duration 60 --json results.json
+    testclient.py --bench --fixtures fixtures/ --track track.csv
+
+Fixtures mode starts a server on the fixtures cache directory (gfs/ and metar/
+like the plugin cache) without downloading anything.
 
 X-plane NOAA GFS weather plugin.
 Copyright (C) 2012-2015 Joan Perez i Cauhe
@@ -13,27 +23,277 @@ of the License, or any later version.
 import socket
 import cPickle
 import sys
+import os
+import json
+import time
+import math
+import random
+import argparse
+import threading
+import subprocess
 from pprint import pprint
 
+from stats import Histogram
+
 # tests requests
 tests = [
     "?%f|%f" % (41.38, 2.18),  # Request weather data for lat/lon
     '?LEBL',  # Request metar of the station
     '?KSEA',
     '?SKBO',
+    # '!stats',      # Server metrics
+    # '!jobs',       # Server job queue
+    # '!cache',      # Server cache usage
     # '!reload',     # Reload configuration
     # '!shutdown',   # Shutdown server
 ]
 
-if len(sys.argv) > 1:
-    tests = sys.argv[1:]
-
 HOST, PORT = "127.0.0.1", 8950
 
-for request in tests:
+RECV_SIZE = 65535
+
+
+class Track(object):
+    """Flight track positions for a simulated client"""
+
+    def __init__(self, positions):
+        self.positions = positions
+        self.index = 0
+
+    def next(self):
+        position = self.positions[self.index % len(self.positions)]
+        self.index += 1
+        return position
+
+    @classmethod
+    def load(cls, path, offset=0):
+        """Loads a recorded track, one lat,lon[,alt] position per line"""
+        positions = []
+        with open(path, 'r') as f:
+            for line in f:
+                cols = line.strip().split(',')
+                if len(cols) > 1 and cols[0][:1] != '#':
+                    try:
+                        positions.append((float(cols[0]), float(cols[1])))
+                    except ValueError:
+                        continue
+        return cls(positions[offset % len(positions):] + positions[:offset % len(positions)])
+
+    @classmethod
+    def synthetic(cls, rnd, speed, interval, steps):
+        """Straight track from a random position, speed in kt and interval in seconds"""
+        lat, lon = rnd.uniform(-60, 60), rnd.uniform(-180, 180)
+        hdg = math.radians(rnd.uniform(0, 360))
+        # Degrees of latitude flown each request
+        step = speed * 1852.0 * interval / 111120.0
+
+        positions = []
+        for i in range(steps):
+            positions.append((lat, lon))
+            lat = max(min(lat + step * math.cos(hdg), 85), -85)
+            lon = (lon + step * math.sin(hdg) / math.cos(math.radians(lat)) + 180) % 360 - 180
+        return cls(positions)
+
+
+class SimClient(threading.Thread):
+    """Sends paced requests along a track and records the results"""
+
+    def __init__(self, address, track, rate, duration, timeout, kinds):
+        self.address = address
+        self.track = track
+        self.interval = 1.0 / rate
+        self.duration = duration
+        self.timeout = timeout
+        self.kinds = kinds
+
+        self.latency = Histogram(size=100000)
+        self.results = {'sent': 0, 'received': 0, 'dropped': 0, 'truncated': 0, 'late': 0, 'bytes': 0}
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def request(self, i):
+        lat, lon = self.track.next()
+        kind = self.kinds[i % len(self.kinds)]
+        if kind == 'tile':
+            return '#%.2f|%.2f' % (lat, lon)
+        # Same rounding as the plugin
+        return '?%.2f|%.2f' % (round(lat, 1), round(lon, 1))
+
+    def drain(self, sock):
+        """Discard responses that arrived after the timeout"""
+        sock.setblocking(0)
+        try:
+            while True:
+                sock.recv(RECV_SIZE)
+                self.results['late'] += 1
+        except socket.error:
+            pass
+        sock.settimeout(self.timeout)
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+
+        start = time.time()
+        i = 0
+        while True:
+            # Latency is measured from the scheduled time to account for server stalls
+            scheduled = start + i * self.interval
+            if scheduled - start > self.duration:
+                break
+            wait = scheduled - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            self.drain(sock)
+            sock.sendto(self.request(i), self.address)
+            self.results['sent'] += 1
+            i += 1
+
+            try:
+                received = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                self.results['dropped'] += 1
+                continue
+
+            self.results['bytes'] += len(received)
+            try:
+                cPickle.loads(received)
+            except Exception:
+                self.results['truncated'] += 1
+                continue
+
+            self.results['received'] += 1
+            self.latency.add(time.time() - scheduled)
+
+        sock.close()
+
+
+def start_fixture_server(fixtures, port):
+    """Starts an offline weather server using the fixtures directory as cache"""
+    server = os.sep.join([os.path.dirname(os.path.abspath(__file__)), 'weatherServer.py'])
+    args = [sys.executable, server, '--cache', fixtures, '--offline', '--port', str(port)]
+    process = subprocess.Popen(args, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    # Wait for the server to answer
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.sendto(request, (HOST, PORT))
-    received = sock.recv(1024 * 8)
+    sock.settimeout(0.5)
+    for i in range(60):
+        try:
+            sock.sendto('!ping', (HOST, port))
+            if cPickle.loads(sock.recv(RECV_SIZE)) == '!pong':
+                return process
+        except socket.error:
+            pass
+    process.kill()
+    raise RuntimeError('Fixture server not responding.')
+
+
+def bench(options):
+    address = (options.host, options.port)
+    rnd = random.Random(options.seed)
+    kinds = options.kinds.split(',')
+
+    server = False
+    if options.fixtures:
+        server = start_fixture_server(options.fixtures, options.port)
+
+    steps = int(options.duration * options.rate) + 1
+    clients = []
+    for i in range(options.clients):
+        if options.track:
+            track = Track.load(options.track, offset=i * options.track_offset)
+        else:
+            track = Track.synthetic(rnd, options.speed, 1.0 / options.rate, steps)
+        clients.append(SimClient(address, track, options.rate, options.duration, options.timeout, kinds))
+
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    latency = Histogram(size=100000)
+    totals = dict.fromkeys(clients[0].results, 0)
+    for client in clients:
+        for key, value in client.results.iteritems():
+            totals[key] += value
+        for sample in client.latency.samples:
+            latency.add(sample)
+
+    results = {'config': {'clients': options.clients,
+                          'rate': options.rate,
+                          'duration': options.duration,
+                          'kinds': kinds,
+                          'track': options.track or 'synthetic',
+                          'fixtures': options.fixtures or False,
+                          },
+               'elapsed': elapsed,
+               'throughput': totals['received'] / elapsed,
+               'latency_ms': latency.summary(),
+               }
+    results.update(totals)
+
+    if server:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(2)
+        try:
+            sock.sendto('!stats', address)
+            results['server'] = cPickle.loads(sock.recv(RECV_SIZE))['stats']
+            sock.sendto('!shutdown', address)
+            sock.recv(RECV_SIZE)
+        except socket.error:
+            server.kill()
+        server.wait()
+
+    return results
+
+
+def run_tests(requests, address, record=False):
+    for request in requests:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(request, address)
+        received = sock.recv(RECV_SIZE)
+
+        print "Request: %s \nResponse:" % (request)
+        pprint(cPickle.loads(received), width=160)
+
+        if record:
+            # Payloads for harness.py
+            with open(record, 'ab') as f:
+                cPickle.dump(cPickle.loads(received), f, cPickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Weather server test client and benchmark')
+    parser.add_argument('requests', nargs='*', help='Requests to send, ex: ?LEBL')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--bench', action='store_true', help='Run the load generator')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent simulated clients')
+    parser.add_argument('--rate', type=float, default=1, help='Requests per second per client')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds')
+    parser.add_argument('--timeout', type=float, default=2, help='Seconds to consider a datagram dropped')
+    parser.add_argument('--kinds', default='weather', help='Comma separated request kinds: weather,tile')
+    parser.add_argument('--track', help='Recorded track file, one lat,lon per line')
+    parser.add_argument('--track-offset', type=int, default=10, help='Track positions between clients')
+    parser.add_argument('--speed', type=float, default=450, help='Synthetic tracks ground speed in kt')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixtures', help='Start an offline server using this cache directory')
+    parser.add_argument('--json', help='Write the results to a file, - for stdout')
+    parser.add_argument('--record', help='Append the responses to a harness.py payloads file')
+    options = parser.parse_args()
 
-    print "Request: %s \nResponse:" % (request)
-    pprint(cPickle.loads(received), width=160)
+    if options.bench:
+        results = bench(options)
+        if options.json == '-':
+            print json.dumps(results, indent=2, sort_keys=True)
+        else:
+            if options.json:
+                with open(options.json, 'w') as f:
+                    json.dump(results, f, indent=2, sort_keys=True)
+            pprint(results, width=160)
+    else:
+        run_tests(options.requests or tests, (options.host, options.port), options.record)
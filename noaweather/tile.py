@@ -0,0 +1,160 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+from array import array
+from math import floor, sin, cos, radians
+
+from c import c
+
+
+class Tile(object):
+    """Grid nodes around a position for client side interpolation
+
+    Nodes are ordered south to north and west to east. Wind values are packed per node and level
+    as [u, v, temp, rh, dew] in knots, kelvin and percent, turbulence per node and level and pressure
+    per node. Missing temperature, humidity and dew point values are packed as 0.
+
+    Request format: #<lat>|<lon>
+    """
+
+    SIZE = 4
+    WIND_FIELDS = 5
+
+    def __init__(self, lat0, lon0, step, size, alts, wind, turbulence_alts, turbulence, pressure, info=None):
+        self.lat0, self.lon0, self.step, self.size = lat0, lon0, step, size
+        self.alts = alts
+        self.wind = wind
+        self.turbulence_alts = turbulence_alts
+        self.turbulence = turbulence
+        self.pressure = pressure
+        self.info = info or {}
+
+    @classmethod
+    def nodes(cls, lat, lon, step, size=SIZE):
+        """Returns the tile origin and the node positions, the position is in the central cell"""
+        lat0 = (floor(lat / step) - (size / 2 - 1)) * step
+        lon0 = (floor(lon / step) - (size / 2 - 1)) * step
+
+        nodes = []
+        for i in range(size):
+            for j in range(size):
+                nlon = (lon0 + j * step + 180) % 360 - 180
+                nodes.append((c.limit(lat0 + i * step, 90, -90), nlon))
+
+        return lat0, lon0, nodes
+
+    @classmethod
+    def pack(cls, lat0, lon0, step, gfs_data, wafs_data, size=SIZE):
+        """Packs the parsed data of every node for the response"""
+
+        alts = gfs_data and gfs_data[0] and [layer[0] for layer in gfs_data[0]['winds']] or []
+        turbulence_alts = wafs_data and wafs_data[0] and [layer[0] for layer in wafs_data[0]] or []
+
+        wind, turbulence, pressure = array('f'), array('f'), array('f')
+
+        for gfs, turb in zip(gfs_data, wafs_data):
+            layers = dict((layer[0], layer) for layer in (gfs and gfs['winds'] or []))
+            for alt in alts:
+                if alt in layers:
+                    hdg, speed, extra = layers[alt][1], layers[alt][2], layers[alt][3]
+                    # Wind from heading to vector
+                    wind.extend((-speed * sin(radians(hdg)), -speed * cos(radians(hdg)),
+                                 extra['temp'] or 0, extra['rh'] or 0, extra['dew'] or 0))
+                else:
+                    wind.extend((0,) * cls.WIND_FIELDS)
+
+            layers = dict(turb or [])
+            turbulence.extend([layers.get(alt, 0) for alt in turbulence_alts])
+
+            pressure.append(gfs and gfs['pressure'] or 0)
+
+        return {'tile': {'lat0': lat0,
+                         'lon0': lon0,
+                         'step': step,
+                         'size': size,
+                         'alts': alts,
+                         'wind': wind.tostring(),
+                         'turbulence_alts': turbulence_alts,
+                         'turbulence': turbulence.tostring(),
+                         'pressure': pressure.tostring(),
+                         }
+                }
+
+    @classmethod
+    def from_response(cls, response):
+        """Unpacks a tile server response"""
+        tile = response['tile']
+        wind, turbulence, pressure = array('f'), array('f'), array('f')
+        wind.fromstring(tile['wind'])
+        turbulence.fromstring(tile['turbulence'])
+        pressure.fromstring(tile['pressure'])
+
+        return cls(tile['lat0'], tile['lon0'], tile['step'], tile['size'], tile['alts'], wind,
+                   tile['turbulence_alts'], turbulence, pressure, tile.get('info'))
+
+    def contains(self, lat, lon):
+        """True if the position is inside the tile central cells"""
+        lon = self.lon0 + (lon - self.lon0) % 360
+        return (self.lat0 + self.step <= lat <= self.lat0 + (self.size - 2) * self.step and
+                self.lon0 + self.step <= lon <= self.lon0 + (self.size - 2) * self.step)
+
+    def weights(self, lat, lon):
+        """Returns the bilinear interpolation node indexes and weights [(node, weight), ]"""
+        lon = self.lon0 + (lon - self.lon0) % 360
+        y = c.limit((lat - self.lat0) / self.step, self.size - 1, 0)
+        x = c.limit((lon - self.lon0) / self.step, self.size - 1, 0)
+        i, j = min(int(y), self.size - 2), min(int(x), self.size - 2)
+        fy, fx = y - i, x - j
+
+        node = i * self.size + j
+        return ((node, (1 - fy) * (1 - fx)),
+                (node + 1, (1 - fy) * fx),
+                (node + self.size, fy * (1 - fx)),
+                (node + self.size + 1, fy * fx))
+
+    def winds(self, lat, lon):
+        """Returns interpolated wind layers in the GFS response format"""
+        weights = self.weights(lat, lon)
+        nlevels = len(self.alts)
+        stride = nlevels * self.WIND_FIELDS
+
+        winds = []
+        for level, alt in enumerate(self.alts):
+            u, v = 0, 0
+            # Sums of values and weights of the nodes with temp, rh and dew
+            values, totals = [0, 0, 0], [0, 0, 0]
+            for node, weight in weights:
+                k = node * stride + level * self.WIND_FIELDS
+                u += self.wind[k] * weight
+                v += self.wind[k + 1] * weight
+                for i in range(3):
+                    if self.wind[k + 2 + i]:
+                        values[i] += self.wind[k + 2 + i] * weight
+                        totals[i] += weight
+
+            # Nodes without a value are left out of the blend
+            temp, rh, dew = [value / total if total else False for value, total in zip(values, totals)]
+
+            hdg, speed = c.c2p(u, v)
+            winds.append([alt, hdg, speed, {'temp': temp, 'rh': rh, 'dew': dew, 'gust': 0}])
+
+        return winds
+
+    def turbulences(self, lat, lon):
+        """Returns interpolated turbulence layers in the WAFS response format"""
+        weights = self.weights(lat, lon)
+        nlevels = len(self.turbulence_alts)
+
+        return [[alt, sum(self.turbulence[node * nlevels + level] * weight for node, weight in weights)]
+                for level, alt in enumerate(self.turbulence_alts)]
+
+    def pressure_at(self, lat, lon):
+        """Returns interpolated sea level pressure"""
+        return sum(self.pressure[node] * weight for node, weight in self.weights(lat, lon))
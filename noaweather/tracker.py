@@ -11,10 +11,6 @@ as published by the Free Software Foundation; either version 2
 of the License, or any later version.
 """
 import thread
-import ssl
-import urllib
-import urllib2
-import platform
 import json
 import struct
 import string
@@ -37,11 +33,19 @@ class Tracker:
 
         self.site_id = site_id
 
-        xpver, sdkver, hid = XPLMGetVersions()
+        self.xpver, sdkver, hid = XPLMGetVersions()
+
+        # System info is collected on the first tracking thread
+        self.cvars = False
+        self.userAgent = False
+
+    def system_info(self):
+        import platform
+
         uname = platform.uname()
 
         self.cvars = json.dumps({
-            "1": ['xp_ver', xpver],
+            "1": ['xp_ver', self.xpver],
             "2": ['plugin_ver', self.conf.__VERSION__],
             "3": ['os', uname[0]],
             "4": ['os_ver', uname[2]],
@@ -49,13 +53,20 @@ class Tracker:
         })
 
         self.userAgent = 'X-Plane/%s (%s ; %s/%s ; %s)' % (
-        xpver, self.conf.__VERSION__, uname[0], uname[2], platform.platform())
+        self.xpver, self.conf.__VERSION__, uname[0], uname[2], platform.platform())
 
     def track(self, url, action_name='', params={}):
         if self.conf.tracker_enabled:
             thread.start_new_thread(self._track, (url, action_name, params))
 
     def _track(self, url, action_name='', params={}):
+        import ssl
+        import urllib
+        import urllib2
+
+        if not self.userAgent:
+            self.system_info()
+
         tparams = {'idsite': self.site_id,
                    'rec': 1,
                    'apiv': 1,
@@ -0,0 +1,158 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+from random import random
+
+from c import c
+
+
+class Transition(object):
+    """Time based linear transition state"""
+
+    __slots__ = ('name', 'group', 'speed', 'heading', 'value', 'active')
+
+    def __init__(self, name, group, speed, heading):
+        self.name = name
+        self.group = group
+        self.speed = speed
+        self.heading = heading
+        self.value = 0
+        self.active = False
+
+    def reset(self):
+        self.value = 0
+        self.active = False
+
+    def dump(self):
+        return {'value': self.value, 'speed': self.speed, 'active': self.active}
+
+
+class Pattern(object):
+    """Random cosine interpolated pattern state"""
+
+    __slots__ = ('name', 'group', 'heading', 'x1', 'x2', 'start', 'end', 'time', 'active')
+
+    def __init__(self, name, group, heading):
+        self.name = name
+        self.group = group
+        self.heading = heading
+        self.reset()
+
+    def reset(self):
+        self.x1, self.x2, self.start, self.end, self.time = 0, 0, 0, 0, 0
+        self.active = False
+
+    def dump(self):
+        return {'x1': self.x1, 'x2': self.x2, 'start': self.start, 'end': self.end, 'time': self.time}
+
+
+class Transitions(object):
+    """Transition engine
+
+    States are registered once and referenced by an integer handle, every step updates the
+    state in place. Groups are bit flags, resetting a group resets all its states.
+
+    Usage:
+        transitions = Transitions()
+        handle = transitions.transition('pressure', Transitions.PRESSURE, speed=0.005)
+        transitions.dataref(handle, pressure_dataref, new_value, elapsed)
+    """
+
+    WIND = 1
+    TURBULENCE = 2
+    PRESSURE = 4
+    CLOUDS = 8
+    ALL = 0xff
+
+    def __init__(self):
+        self.states = []
+
+    def register(self, state):
+        self.states.append(state)
+        return len(self.states) - 1
+
+    def transition(self, name, group, speed=0.25, heading=False):
+        """Registers a linear transition, returns its handle"""
+        return self.register(Transition(name, group, speed, heading))
+
+    def pattern(self, name, group, heading=False):
+        """Registers a random pattern, returns its handle"""
+        return self.register(Pattern(name, group, heading))
+
+    def step(self, handle, new, elapsed):
+        """Transitions the state towards new and returns the current value"""
+        state = self.states[handle]
+
+        if not state.active:
+            state.value, state.active = new, True
+            return new
+
+        current, speed = state.value, state.speed
+
+        if state.heading:
+            diff = c.shortHdg(current, float(new))
+            if abs(diff) >= speed * elapsed:
+                new = (current + (1 if diff > 0 else -1) * speed * elapsed) % 360
+        elif abs(current - new) > speed * elapsed + speed:
+            new = current + (1 if new > current else -1) * speed * elapsed
+
+        state.value = new
+        return new
+
+    def dataref(self, handle, dataref, new, elapsed):
+        """Transitions a dataref to new
+
+        The transition value is kept in the state to ignore x-plane roundings,
+        the dataref is only written on changes.
+        """
+        state = self.states[handle]
+
+        if not state.active:
+            state.value, state.active = dataref.value, True
+
+        if state.value == new:
+            return
+
+        dataref.value = self.step(handle, new, elapsed)
+
+    def random(self, handle, max_val, elapsed, max_time=1, min_val=0, min_time=1):
+        """Returns the current value of a random cosine interpolated pattern"""
+        state = self.states[handle]
+
+        if not state.active:
+            state.x1, state.active = min_val, True
+
+        if state.heading:
+            ret = c.cosineInterpolateHeading(state.x1, state.x2, state.start, state.end, state.time)
+        else:
+            ret = c.cosineInterpolate(state.x1, state.x2, state.start, state.end, state.time)
+
+        state.time += elapsed
+
+        if state.time >= state.end:
+            state.x1 = ret
+            state.x2 = min_val + random() * (max_val - min_val)
+            state.start = state.time
+            state.end = state.time + min_time + random() * (max_time - min_time)
+
+        return ret
+
+    def value(self, handle):
+        return self.states[handle].value
+
+    def reset(self, groups=ALL):
+        """Resets all the states of the groups"""
+        for state in self.states:
+            if state.group & groups:
+                state.reset()
+
+    def dump(self):
+        """Returns the state of all the active transitions for the log"""
+        return dict((state.name, state.dump()) for state in self.states if state.active)
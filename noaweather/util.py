@@ -11,6 +11,8 @@ of the License, or any later version.
 import os
 import shutil
 import sys
+import threading
+from collections import OrderedDict
 
 
 class util:
@@ -48,6 +50,23 @@ class util:
             util.copy(opath, dpath)
             util.remove(opath)
 
+    @staticmethod
+    def replace(opath, dpath):
+        """Replaces dpath with opath, readers get the old or the new file
+
+        On windows the replace fails if a reader has dpath open without delete sharing, it falls
+        back to util.rename that isn't atomic.
+        """
+        if sys.platform == 'win32':
+            import ctypes
+            encoding = sys.getfilesystemencoding()
+            src, dst = [path if isinstance(path, unicode) else path.decode(encoding) for path in (opath, dpath)]
+            # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+            if not ctypes.windll.kernel32.MoveFileExW(src, dst, 0x1 | 0x8):
+                util.rename(opath, dpath)
+        else:
+            os.rename(opath, dpath)
+
     @staticmethod
     def copy(opath, dpath):
         if os.path.exists(dpath):
@@ -56,3 +75,56 @@ class util:
             shutil.copyfile(opath, dpath)
         except:
             print "Can't copy %s to %s" % (opath, dpath)
+
+
+class LRUCache(object):
+    """Thread safe least recently used cache
+
+    Attributes:
+        size (int): Maximum number of items to keep
+        hits (int): Number of cache hits
+        misses (int): Number of cache misses
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move to the end
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def dump(self):
+        """Returns the items [(key, value), ] least recently used first"""
+        with self.lock:
+            return self.items.items()
+
+    def load(self, items):
+        """Adds a list of items returned by dump"""
+        for key, value in items:
+            self.set(key, value)
+
+    def __len__(self):
+        return len(self.items)
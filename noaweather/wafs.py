@@ -8,13 +8,20 @@ as published by the Free Software Foundation; either version 2
 of the License, or any later version.
 """
 
+import os
 import subprocess
 from datetime import datetime, timedelta
 import re
 
 from weathersource import GribWeatherSource
+from wafsgrid import WAFSGrid
+from stats import stats
 
 from c import c
+from serverlog import log
+
+
+logger = log.logger('wafs')
 
 
 class WAFS(GribWeatherSource):
@@ -24,15 +31,88 @@ class WAFS(GribWeatherSource):
     forecasts = [6, 9, 12, 15, 18, 21, 24]
     baseurl = 'https://www.ftp.ncep.noaa.gov/data/nccf/com/gfs/prod'
 
-    download_wait = 0
     publish_delay = {'hours': 5, 'minutes': 0}
     grib_conf_var = 'lastwafsgrib'
+    grid_resolution = 0.25
+    cache_pattern = '*_gfs.t??z.wafs_0p25_unblended.f??.grib2'
 
     RE_PRAM = re.compile(r'\bparmcat=(?P<parmcat>[0-9]+) parm=(?P<parm>[0-9]+)')
 
     def __init__(self, conf):
+        # Only the messages we decode are downloaded, see wafs_levels_config.json
+        self.variable_list = conf.wafs_variable_list
+        # Decoded fields of the last grib
+        self.grid = False
+        self.grid_failed = False
         super(WAFS, self).__init__(conf)
 
+    def update(self):
+        """Downloads new cycles and decodes them to a grid"""
+        try:
+            return super(WAFS, self).update()
+        finally:
+            last_grib = self.last_grib
+            if last_grib and last_grib != self.grid_failed and (not self.grid or self.grid.name != last_grib):
+                self.load_grid(last_grib)
+
+    def load_grid(self, grib):
+        """Maps the decoded grib, decoding it if needed"""
+        grib_path = os.path.sep.join([self.cache_path, grib])
+        old_grid = self.grid
+
+        try:
+            grid = WAFSGrid.load(grib_path)
+            if not grid:
+                logger.info('Decoding: %s' % grib)
+                with stats.timer('wafs_decode'):
+                    grid = self.submit(WAFSGrid.decode, grib_path, self.conf.wgrib2bin, self.conf.spinfo,
+                                       host='wgrib2', cancellable=False, name='decode %s' % grib).result()
+        except (RuntimeError, OSError, IOError) as err:
+            logger.error('Error decoding WAFS grib file %s: %s' % (grib, str(err)))
+            self.grid_failed = grib
+            return
+
+        # Swap before closing, queries take a reference to the current grid
+        self.grid = grid
+        if old_grid:
+            old_grid.close()
+            if not self.conf.keepOldFiles:
+                old_grid.remove()
+
+    def restore_grid(self, grib):
+        """Maps an already decoded grib, returns True on success"""
+        grid = WAFSGrid.load(os.path.sep.join([self.cache_path, grib]))
+        if grid:
+            old_grid, self.grid = self.grid, grid
+            if old_grid:
+                old_grid.close()
+        return bool(grid)
+
+    def cache_files(self):
+        files = super(WAFS, self).cache_files()
+        if self.grid:
+            files += WAFSGrid.paths(self.grid.path[:-4])
+        return files
+
+    def superseded_files(self):
+        files = super(WAFS, self).superseded_files()
+        return files + [path for grib in files for path in WAFSGrid.paths(grib)]
+
+    def parse_points(self, points, grib=False):
+        """Returns the turbulence of a list of positions [(lat, lon), ] from the grid if decoded"""
+        grid = self.grid
+        if grid and grid.name == (grib or self.last_grib):
+            with stats.timer('wafs_grid'):
+                return grid.corridor(points)
+        return super(WAFS, self).parse_points(points, grib)
+
+    def get_hazards(self, lat, lon):
+        """Returns icing levels and cumulonimbus data for a position, empty if the grid is not ready"""
+        grid = self.grid
+        if not grid or grid.name != self.last_grib:
+            return {}
+        return {'icing': grid.column('icing', lat, lon), 'cb': grid.cb(lat, lon)}
+
     @classmethod
     def get_cycle_date(cls):
         """Returns last cycle date available"""
@@ -67,13 +147,18 @@ class WAFS(GribWeatherSource):
         varies from close to 0, "smooth", to near 1, "extreme for most aircraft types. The display colors
         of EDR range from white near 0 to violet near 1."
         """
+        return self.parse_grib_points(filepath, [(lat, lon)])[0]
 
-        args = ['-s',
-                '-lon',
-                '%f' % (lon),
-                '%f' % (lat),
-                filepath
-                ]
+    def parse_grib_points(self, filepath, points):
+        """Parses the turbulence of a list of positions in a single wgrib2 pass
+
+        Used until the grib file is decoded to a grid, see WAFSGrid for the other fields.
+        """
+
+        args = ['-s']
+        for lat, lon in points:
+            args += ['-lon', '%f' % (lon), '%f' % (lat)]
+        args.append(filepath)
 
         kwargs = {'stdout': subprocess.PIPE}
 
@@ -83,37 +168,25 @@ class WAFS(GribWeatherSource):
 
         it = iter(p.stdout)
 
-        cat = {}
+        npoints = len(points)
+        cat = [{} for _ in range(npoints)]
         for line in it:
-            print (line)
-            sline = line.split(':')
+            sline = line.rstrip('\n').split(':')
             m = self.RE_PRAM.search(sline[3])
+            if not m:
+                # Named parameters
+                continue
 
             parmcat, parm = m.groups()
-            value = float(sline[7].split(',')[-1:][0][4:-1])
 
             if parmcat == '19' and parm == '30':
                 # Eddy Dissipation Param
                 alt = int(c.mb2alt(float(sline[4][:-3])))
-                cat[alt] = value
-            if parmcat == '19' and parm == '37':
-                # Icing severity
-                pass
-            if parmcat == '6' and parm == '25':
-                # Horizontal Extent of Cumulonimbus (CB) %
-                pass
-            if parmcat == '3' and parm == '3':
-                # Cumulonimbus BASE or TOPS
-                # ICAO Standard Atmosphere Reference height in METERS
-                pass
-
-
-        turbulence = []
-        for key, value in cat.iteritems():
-            turbulence.append([key, value])
-        turbulence.sort()
-
-        return turbulence
+                for i in range(npoints):
+                    # One lon=,lat=,val= column per requested position
+                    cat[i][alt] = float(sline[7 + i].split(',')[-1][4:])
+
+        return [sorted([key, value] for key, value in point.iteritems()) for point in cat]
 
     @classmethod
     def get_download_url(cls, datecycle, cycle, forecast):
@@ -0,0 +1,241 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import os
+import re
+import json
+import mmap
+import struct
+import subprocess
+
+from c import c
+from util import util
+
+
+class WAFSGrid(object):
+    """WAFS fields decoded to a memory mapped level by lat by lon float grid
+
+    The grib file is decoded once per cycle with wgrib2 -bin to <grib>.bin, one record of
+    nx * ny floats in WE:SN order for each message, <grib>.json describes the records:
+
+        {'fields': {'turbulence': [[alt, record], ], 'icing': [...], 'cb_extent': [[0, record]], ...}}
+
+    Queries read the nearest grid node of each record.
+    """
+
+    VERSION = 1
+
+    # (parmcat, parm): field name
+    FIELDS = {
+        ('19', '30'): 'turbulence',  # Eddy Dissipation Param EDR
+        ('19', '37'): 'icing',  # Icing severity
+        ('6', '25'): 'cb_extent',  # Horizontal Extent of Cumulonimbus (CB) %
+        ('3', '3'): 'cb',  # Cumulonimbus BASE or TOPS, ICAO Standard Atmosphere height in meters
+    }
+
+    # wgrib2 undefined value
+    UNDEFINED = 9.9e20
+
+    RE_PARAM = re.compile(r'\bparmcat=(?P<parmcat>[0-9]+) parm=(?P<parm>[0-9]+)')
+    RE_GRID = re.compile(r'\((?P<nx>[0-9]+) x (?P<ny>[0-9]+)\)')
+    RE_LAT = re.compile(r'\blat (?P<start>-?[0-9.]+) to (?P<end>-?[0-9.]+) by (?P<step>[0-9.]+)')
+    RE_LON = re.compile(r'\blon (?P<start>-?[0-9.]+) to (?P<end>-?[0-9.]+) by (?P<step>[0-9.]+)')
+
+    def __init__(self, name, path, meta):
+        self.name = name
+        self.path = path
+        self.fields = meta['fields']
+        self.nx, self.ny = meta['nx'], meta['ny']
+        self.lat0, self.lon0 = meta['lat0'], meta['lon0']
+        self.dlat, self.dlon = meta['dlat'], meta['dlon']
+
+        self.record_size = self.nx * self.ny * 4
+        # The mapping keeps its own handle
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def paths(grib_path):
+        """Returns the grid and description paths of a grib file"""
+        return '%s.bin' % grib_path, '%s.json' % grib_path
+
+    @classmethod
+    def load(cls, grib_path):
+        """Maps a previously decoded grib file, returns False if not available"""
+        bin_path, meta_path = cls.paths(grib_path)
+        if not os.path.isfile(bin_path) or not os.path.isfile(meta_path):
+            return False
+
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if meta.get('version') != cls.VERSION \
+                or os.path.getsize(bin_path) != meta['nx'] * meta['ny'] * 4 * meta['records']:
+            return False
+
+        return cls(os.path.basename(grib_path), bin_path, meta)
+
+    @staticmethod
+    def wgrib2(args, wgrib2bin, spinfo=False, stdin=None):
+        """Runs wgrib2 returning its output"""
+        kwargs = {'stdout': subprocess.PIPE}
+        if stdin is not None:
+            kwargs['stdin'] = subprocess.PIPE
+        if spinfo:
+            kwargs.update({'startupinfo': spinfo, 'shell': True})
+
+        p = subprocess.Popen([wgrib2bin] + args, **kwargs)
+        out = p.communicate(stdin)[0]
+        if p.returncode:
+            raise RuntimeError('wgrib2 error %d running: %s' % (p.returncode, ' '.join(args)))
+        return out
+
+    @classmethod
+    def field(cls, parmcat, parm, level):
+        """Returns the field name and altitude of a grib message or False"""
+        name = cls.FIELDS.get((parmcat, parm))
+        if not name:
+            return False, 0
+
+        if level.endswith(' mb'):
+            try:
+                return name, int(c.mb2alt(float(level[:-3])))
+            except ValueError:
+                return False, 0
+
+        if name == 'cb':
+            name = 'cb_base' if 'base' in level else 'cb_top'
+        return name, 0
+
+    @classmethod
+    def select(cls, inventory):
+        """Returns the inventory lines to decode and the fields description
+
+        Messages of the same field and level (ex: spatial max and mean EDR) replace the previous one.
+        """
+        selected = {}
+        for line in inventory.splitlines():
+            cols = line.split(':')
+            if len(cols) < 6:
+                continue
+            m = cls.RE_PARAM.search(cols[3])
+            if not m:
+                continue
+            name, alt = cls.field(m.group('parmcat'), m.group('parm'), cols[4])
+            if name:
+                selected[(name, alt)] = line
+
+        lines = sorted(selected.values(), key=lambda line: int(line.split(':')[0]))
+        records = dict((line, record) for record, line in enumerate(lines))
+
+        fields = {}
+        for (name, alt), line in selected.items():
+            fields.setdefault(name, []).append([alt, records[line]])
+        for levels in fields.values():
+            levels.sort()
+
+        return lines, fields
+
+    @classmethod
+    def geometry(cls, grid):
+        """Parses wgrib2 -grid output of a regular lat-lon grid"""
+        size, lat, lon = cls.RE_GRID.search(grid), cls.RE_LAT.search(grid), cls.RE_LON.search(grid)
+        if not size or not lat or not lon:
+            raise RuntimeError('Unsupported WAFS grid: %s' % grid[:80])
+
+        return {'nx': int(size.group('nx')),
+                'ny': int(size.group('ny')),
+                # -bin writes WE:SN, the first row is the southernmost
+                'lat0': min(float(lat.group('start')), float(lat.group('end'))),
+                'lon0': float(lon.group('start')),
+                'dlat': float(lat.group('step')),
+                'dlon': float(lon.group('step')),
+                }
+
+    @classmethod
+    def decode(cls, grib_path, wgrib2bin, spinfo=False):
+        """Decodes the WAFS fields of a grib file and maps the result"""
+        bin_path, meta_path = cls.paths(grib_path)
+
+        lines, fields = cls.select(cls.wgrib2([grib_path, '-s'], wgrib2bin, spinfo))
+        if not lines:
+            raise RuntimeError('No WAFS fields found in %s' % grib_path)
+
+        meta = cls.geometry(cls.wgrib2([grib_path, '-d', '1', '-grid'], wgrib2bin, spinfo))
+        meta.update({'version': cls.VERSION, 'records': len(lines), 'fields': fields})
+
+        tmp_path = '%s.tmp' % bin_path
+        cls.wgrib2([grib_path, '-i', '-order', 'we:sn', '-no_header', '-bin', tmp_path], wgrib2bin, spinfo,
+                   stdin='\n'.join(lines) + '\n')
+
+        if os.path.isfile(bin_path):
+            util.remove(bin_path)
+        os.rename(tmp_path, bin_path)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+        return cls(os.path.basename(grib_path), bin_path, meta)
+
+    def close(self):
+        """Unmaps the grid, windows can't remove or replace a mapped file"""
+        self.mm.close()
+
+    def remove(self):
+        """Removes the decoded files, the grid must be closed"""
+        for path in self.paths(self.path[:-4]):
+            if os.path.isfile(path):
+                util.remove(path)
+
+    def node(self, lat, lon):
+        """Returns the byte offset of the nearest grid node in a record"""
+        j = int(round((lat - self.lat0) / self.dlat))
+        j = min(max(j, 0), self.ny - 1)
+        i = int(round(((lon - self.lon0) % 360) / self.dlon)) % self.nx
+        return (j * self.nx + i) * 4
+
+    def value(self, record, node):
+        value = struct.unpack_from('=f', self.mm, record * self.record_size + node)[0]
+        return None if value > self.UNDEFINED else value
+
+    def column(self, name, lat, lon):
+        """Returns the field levels at a position [[alt, value], ]"""
+        node = self.node(lat, lon)
+        return [[alt, self.value(record, node) or 0.0] for alt, record in self.fields.get(name, [])]
+
+    def cb(self, lat, lon):
+        """Returns the cumulonimbus extent % and base/top in meters or an empty dict"""
+        node = self.node(lat, lon)
+        cb = {}
+        for key, name in (('extent', 'cb_extent'), ('base', 'cb_base'), ('top', 'cb_top')):
+            for alt, record in self.fields.get(name, []):
+                value = self.value(record, node)
+                if value is not None:
+                    cb[key] = value
+        return cb if cb.get('extent') else {}
+
+    def point(self, lat, lon):
+        """Returns all the fields at a position"""
+        return {'turbulence': self.column('turbulence', lat, lon),
+                'icing': self.column('icing', lat, lon),
+                'cb': self.cb(lat, lon),
+                }
+
+    def corridor(self, points, name='turbulence'):
+        """Returns the field columns along a list of positions [(lat, lon), ]"""
+        levels = self.fields.get(name, [])
+        value = self.value
+        columns = []
+        for lat, lon in points:
+            node = self.node(lat, lon)
+            columns.append([[alt, value(record, node) or 0.0] for alt, record in levels])
+        return columns
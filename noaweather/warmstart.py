@@ -0,0 +1,99 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import os
+import time
+import cPickle
+
+from stationindex import StationIndex
+from util import util
+from serverlog import log
+
+
+logger = log.logger('warmstart')
+
+
+class WarmStart(object):
+    """Saves and restores the server state that is slow to rebuild
+
+    The snapshot has the parsed grib positions of the active GFS and WAFS cycles and the parsed METAR
+    cache. The decoded WAFS grid and the station index are files in the cache, the snapshot only
+    records them and they are memory mapped back on restore.
+
+    State of another cycle than the current one is not restored.
+    """
+
+    VERSION = 1
+
+    def __init__(self, conf, gfs, wafs, metar):
+        self.path = os.sep.join([conf.cachepath, 'warmstart.pkl'])
+        self.interval = conf.warmstart_interval
+        self.gfs = gfs
+        self.wafs = wafs
+        self.metar = metar
+
+    def register(self, scheduler):
+        if self.interval:
+            scheduler.add('warmstart', self.save, lane='warmstart', delay=self.interval, interval=self.interval)
+
+    def save(self):
+        """Writes the snapshot atomically"""
+        gfs, wafs, metar = self.gfs, self.wafs, self.metar
+        snapshot = {'version': self.VERSION,
+                    'time': time.time(),
+                    'gfs': {'grib': gfs.last_grib,
+                            'cache': gfs.parse_cache.dump()},
+                    'wafs': {'grib': wafs.last_grib,
+                             'grid': wafs.grid and wafs.grid.name,
+                             'cache': wafs.parse_cache.dump()},
+                    'metar': {'index': bool(metar.index),
+                              'parsed': metar.parsed_cache.dump()},
+                    }
+
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'wb') as f:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.isfile(self.path):
+            util.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def restore(self):
+        """Restores a saved snapshot, returns False if there was none"""
+        start = time.time()
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError, AttributeError):
+            return False
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.VERSION:
+            return False
+
+        restored = []
+        for source in (self.gfs, self.wafs):
+            state = snapshot[source.name]
+            if state['grib'] and state['grib'] == source.last_grib:
+                source.parse_cache.load(state['cache'])
+                restored.append('%s %d positions' % (source.name, len(state['cache'])))
+
+        grid = snapshot['wafs']['grid']
+        if grid and grid == self.wafs.last_grib and self.wafs.restore_grid(grid):
+            restored.append('wafs grid')
+
+        if snapshot['metar']['index']:
+            index = StationIndex.load(self.metar.index_path)
+            if index:
+                self.metar.index = index
+                restored.append('%d stations' % len(index))
+        self.metar.parsed_cache.load(snapshot['metar']['parsed'])
+        restored.append('%d METAR' % len(snapshot['metar']['parsed']))
+
+        logger.info('Warm start: %s restored in %.1fms.' % (', '.join(restored), (time.time() - start) * 1000))
+        return True
@@ -13,42 +13,90 @@ of the License, or any later version.
 '''
 
 from conf import Conf
-from gfs import GFS
-from wafs import WAFS
-from metar import Metar
-from weathersource import Worker
+from jobs import JobScheduler
+from executor import executor
+from cachemanager import cache
+from corridor import Corridor
+from tile import Tile
+from stats import stats, StatsDump
+from serverlog import log, LogStream, DEBUG, INFO, ERROR
 from c import c
 
 import SocketServer
+import argparse
 import cPickle
 import os, sys, signal
 import socket
 import time
-
-from datetime import datetime
 import threading
 
+logger = log.logger('server')
+
+
+class Client(object):
+    """Per client state"""
+
+    def __init__(self, address):
+        self.address = address
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+        self.requests = 0
+        self.position = False
+
+
+class ClientRegistry(object):
+    """Keeps track of the plugin instances using the server"""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.clients = {}
+        self.lock = threading.Lock()
+        # Last request of any client, the server start until then
+        self.last_seen = time.time()
+        self.server = None
+
+    def seen(self, address):
+        """Registers a client request and returns its state"""
+        with self.lock:
+            client = self.clients.get(address)
+            if not client:
+                client = self.clients[address] = Client(address)
+                logger.info('New client: %s:%d' % address)
+            client.last_seen = self.last_seen = time.time()
+            client.requests += 1
+            return client
+
+    def register(self, scheduler, server):
+        """Shuts the server down once no client has been seen in timeout seconds
+
+        Covers clients that exit without !shutdown and the last !shutdown arriving while a
+        disconnected client is still active.
+        """
+        self.server = server
+        scheduler.add('clients', self.check_idle, lane='clients', delay=60, interval=60)
+
+    def check_idle(self):
+        if time.time() - self.last_seen > self.timeout and not self.active():
+            logger.info('No clients in %d seconds, stopping the shared server.' % self.timeout)
+            self.server.shutdown()
+
+    def positions(self):
+        """Returns the last weather request position of the active clients"""
+        return [client.position for client in self.active() if client.position]
+
+    def remove(self, address):
+        with self.lock:
+            self.clients.pop(address, None)
+
+    def active(self):
+        """Returns the list of clients seen in the last timeout seconds"""
+        limit = time.time() - self.timeout
+        with self.lock:
+            for address in [address for address, client in self.clients.iteritems() if client.last_seen < limit]:
+                logger.info('Client timeout: %s:%d' % address)
+                self.clients.pop(address)
+            return self.clients.values()
 
-class LogFile:
-    """File object wrapper, adds timestamp to print output"""
-
-    def __init__(self, path, options):
-        self.f = open(path, options)
-
-    def write(self, data):
-        if len(data) > 1:
-            self.f.write('%s  %s' % (datetime.utcnow().strftime('%b %d %H:%M:%S'), data))
-        else:
-            self.f.write(data)
-
-    def __getattr__(self, name):
-        return getattr(self.f, name)
-
-    def __setattr__(self, name, value):
-        if name != 'f':
-            setattr(self.f, name, value)
-        else:
-            self.__dict__[name] = value
 
 class ClientHandler(SocketServer.BaseRequestHandler):
 
@@ -76,23 +124,74 @@ class ClientHandler(SocketServer.BaseRequestHandler):
 
         # Parse gfs and wafs
         if gfs.last_grib:
-            grib_path = os.path.sep.join([gfs.cache_path, gfs.last_grib])
-            response['gfs'] = gfs.parse_grib_data(grib_path, lat, lon)
             response['info']['gfs_cycle'] = gfs.last_grib
+            response['gfs'] = gfs.get_data(lat, lon)
         if wafs.last_grib:
-            grib_path = os.path.sep.join([wafs.cache_path, wafs.last_grib])
-            response['wafs'] = wafs.parse_grib_data(grib_path, lat, lon)
             response['info']['wafs_cycle'] = wafs.last_grib
+            response['wafs'] = wafs.get_data(lat, lon)
+            response.update(wafs.get_hazards(lat, lon))
 
         # Parse metar
-        apt = metar.get_closest_station(metar.connection, lat, lon)
+        with metar_lock, stats.timer('metar_lookup'):
+            apt = metar.get_closest_station(metar.connection, lat, lon)
         if apt and len(apt) > 4:
-            response['metar'] = metar.parse_metar(apt[0], apt[5], apt[3])
+            response['metar'] = metar.get_parsed_metar(apt[0], apt[5], apt[3])
             response['metar']['latlon'] = (apt[1], apt[2])
             response['metar']['distance'] = c.greatCircleDistance((lat, lon), (apt[1], apt[2]))
 
         return response
 
+    @staticmethod
+    def get_corridor_data(data):
+        """Collects weather data along a route in a single pass for each source"""
+
+        try:
+            spacing, vspacing, waypoints = Corridor.parse_request(data)
+        except ValueError:
+            return False
+
+        points = Corridor.sample_route(waypoints, spacing, Corridor.max_samples(vspacing))
+        latlons = [(lat, lon) for lat, lon, distance in points]
+
+        info = {'gfs_cycle': 'na', 'wafs_cycle': 'na'}
+        gfs_data = wafs_data = [False] * len(points)
+
+        if gfs.last_grib:
+            info['gfs_cycle'] = gfs.last_grib
+            gfs_data = gfs.parse_points(latlons)
+        if wafs.last_grib:
+            info['wafs_cycle'] = wafs.last_grib
+            wafs_data = wafs.parse_points(latlons)
+
+        return {'corridor': {'samples': Corridor.build(points, gfs_data, wafs_data, vspacing),
+                             'vspacing': vspacing,
+                             'info': info,
+                             }
+                }
+
+    @staticmethod
+    def get_tile_data(data):
+        """Collects the GFS grid nodes around a position for client side interpolation"""
+
+        lat, lon = float(data[0]), float(data[1])
+
+        lat0, lon0, nodes = Tile.nodes(lat, lon, gfs.grid_resolution)
+
+        info = {'lat': lat, 'lon': lon, 'gfs_cycle': 'na', 'wafs_cycle': 'na'}
+        gfs_data = wafs_data = [False] * len(nodes)
+
+        if gfs.last_grib:
+            info['gfs_cycle'] = gfs.last_grib
+            gfs_data = gfs.parse_points(nodes)
+        if wafs.last_grib:
+            info['wafs_cycle'] = wafs.last_grib
+            wafs_data = wafs.parse_points(nodes)
+
+        response = Tile.pack(lat0, lon0, gfs.grid_resolution, gfs_data, wafs_data)
+        response['tile']['info'] = info
+
+        return response
+
     def shutdown(self):
         # shutdown Needs to be from called from a different thread
         def shut_down_now(srv):
@@ -101,115 +200,242 @@ class ClientHandler(SocketServer.BaseRequestHandler):
         th = threading.Thread(target=shut_down_now, args=(self.server,))
         th.start()
 
+    @staticmethod
+    def request_name(data):
+        """Returns the request kind used for metrics"""
+        if data[0] == '?':
+            return 'weather' if '|' in data else 'icao'
+        elif data[0] == '#':
+            return 'tile'
+        elif data[0] == '@':
+            return 'corridor'
+        return data.split('|')[0]
+
     def handle(self):
+        start = time.time()
         response = False
         data = self.request[0].strip("\n\c\t ")
 
+        # Control requests (pings from plugins looking for a shared server...) aren't clients
+        client = clients.seen(self.client_address) if data[:1] != '!' else None
+
+        if data not in ('!ping', '!shutdown') and not ready.isSet():
+            # Wait for the weather sources, without timeout: python 2 polls timed waits
+            ready.wait()
+
         if len(data) > 1:
             if data[0] == '?':
                 # weather data request
                 sdata = data[1:].split('|')
                 if len(sdata) > 1:
                     response = self.get_weather_data(sdata)
+                    if response:
+                        client.position = (response['info']['lat'], response['info']['lon'])
                 elif len(data) == 5:
                     # Icao
                     response = {}
-                    apt = metar.get_metar(metar.connection, data[1:])
+                    with metar_lock, stats.timer('metar_lookup'):
+                        apt = metar.get_metar(metar.connection, data[1:])
                     if len(apt) and apt[5]:
-                        response['metar'] = metar.parse_metar(apt[0], apt[5], apt[3])
+                        response['metar'] = metar.get_parsed_metar(apt[0], apt[5], apt[3])
                     else:
                         response['metar'] = {'icao': 'METAR STATION',
                                              'metar': 'NOT AVAILABLE'}
 
+            elif data[0] == '#':
+                # Grid tile request
+                sdata = data[1:].split('|')
+                if len(sdata) > 1:
+                    response = self.get_tile_data(sdata)
+
+            elif data[0] == '@':
+                # Route corridor request
+                response = self.get_corridor_data(data[1:].split('|'))
+
             elif data == '!shutdown':
-                conf.serverSave()
-                self.shutdown()
+                clients.remove(self.client_address)
+                if conf.server_shared and len(clients.active()):
+                    # Keep serving the other clients
+                    logger.info('Client disconnected, %d clients left.' % len(clients.active()))
+                else:
+                    conf.serverSave()
+                    self.shutdown()
                 response = '!bye'
             elif data == '!reload':
                 conf.serverSave()
                 conf.pluginLoad()
             elif data == '!resetMetar':
                 # Clear database and force redownload
-                metar.clear_reports(metar.connection)
-                metar.last_timestamp = 0
+                with metar_lock:
+                    metar.clear_reports(metar.connection)
+                    metar.index = False
+                scheduler.trigger('metar')
             elif data == '!ping':
                 response = '!pong'
+            elif data == '!stats':
+                response = {'stats': stats.report()}
+            elif data == '!jobs':
+                response = {'jobs': scheduler.queue(), 'executor': executor.status()}
+            elif data == '!cache':
+                response = {'cache': cache.report()}
             else:
                 return
+        else:
+            return
 
         socket = self.request[1]
         nbytes = 0
 
         if response:
-            response = cPickle.dumps(response)
-            socket.sendto(response + "\n", self.client_address)
-            nbytes = sys.getsizeof(response)
+            with stats.timer('serialize'):
+                response = cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL) + "\n"
+            socket.sendto(response, self.client_address)
+            nbytes = len(response)
 
-        print '%s:%s: %d bytes sent.' % (self.client_address[0], data, nbytes)
+        name = self.request_name(data)
+        elapsed = time.time() - start
+        stats.incr('requests.%s' % name)
+        stats.incr('bytes_sent', nbytes)
+        stats.timing('request.%s' % name, elapsed)
 
+        if logger.enabled(DEBUG):
+            logger.debug('%s:%s: %d bytes sent in %.1fms.' % (self.client_address[0], data, nbytes, elapsed * 1000))
 
-if __name__ == "__main__":
-    debug = False
-    # Get the X-Plane path from the arguments
-    if len(sys.argv) > 1:
-        path = sys.argv[1]
-    else:
-        # Debug run
-        debug = True
-        path = False
 
-    conf = Conf(path)
+class WeatherServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+    """Threaded UDP server, a slow client request doesn't block the others"""
+    daemon_threads = True
 
-    if not debug:
-        logfile = LogFile(os.sep.join([conf.respath, 'weatherServerLog.txt']), 'a')
 
-        sys.stderr = logfile
-        sys.stdout = logfile
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='NOAA weather server')
+    parser.add_argument('path', nargs='?', default=False, help='X-Plane path, debug run if not set')
+    parser.add_argument('--cache', help='Cache directory, ex: benchmark fixtures')
+    parser.add_argument('--offline', action='store_true', help="Don't download, use the cached files")
+    parser.add_argument('--port', type=int, help='Server port')
+    args = parser.parse_args()
 
-    print '---------------'
-    print 'Starting server'
-    print '---------------'
-    print sys.argv
+    # Get the X-Plane path from the arguments
+    path = args.path
+    debug = not path
+
+    start = time.time()
+    conf = Conf(path, server=True)
+
+    if args.cache:
+        conf.cachepath = os.path.abspath(args.cache)
+        # Keep server variables with the cache
+        conf.serverSettingsFile = os.sep.join([conf.cachepath, 'weatherServer.pkl'])
+        conf.lastgrib, conf.lastwafsgrib, conf.weatherServerPid = False, False, False
+        conf.loadSettings(conf.serverSettingsFile)
+    if args.offline:
+        conf.download = False
+        conf.updateMetarRWX = False
+    if args.port:
+        conf.server_port = args.port
+
+    # Console log on debug runs
+    log.configure(conf)
+    log.start(False if debug else os.sep.join([conf.respath, 'weatherServerLog.txt']))
+
+    # Print output and tracebacks of the shared modules
+    sys.stdout = LogStream(log, 'print', INFO)
+    sys.stderr = LogStream(log, 'stderr', ERROR)
+
+    logger.info('---------------')
+    logger.info('Starting server')
+    logger.info('---------------')
+    logger.info(str(sys.argv))
+
+    address = (conf.server_bind_address, conf.server_port)
 
     try:
-        server = SocketServer.UDPServer(("localhost", conf.server_port), ClientHandler)
+        server = WeatherServer(address, ClientHandler)
     except socket.error:
-        print "Can't bind address: %s, port: %d." % ("localhost", conf.server_port)
+        logger.warning("Can't bind address: %s, port: %d." % address)
+
+        if conf.server_shared:
+            # Another instance is already serving, don't kill it.
+            logger.info('Shared server already running.')
+            log.shutdown()
+            sys.exit(0)
 
         if conf.weatherServerPid is not False:
-            print 'Killing old server with pid %d' % conf.weatherServerPid
+            logger.warning('Killing old server with pid %d' % conf.weatherServerPid)
             os.kill(conf.weatherServerPid, signal.SIGTERM)
             time.sleep(2)
             conf.serverLoad()
-            server = SocketServer.UDPServer(("localhost", conf.server_port), ClientHandler)
+            server = WeatherServer(address, ClientHandler)
 
     # Save pid
     conf.weatherServerPid = os.getpid()
     conf.serverSave()
 
+    clients = ClientRegistry(conf.server_client_timeout)
+    metar_lock = threading.Lock()
+
+    # Answer pings while the sources start, other requests wait for ready
+    ready = threading.Event()
+    server_thread = threading.Thread(target=server.serve_forever, name='server')
+    server_thread.daemon = True
+    server_thread.start()
+
+    logger.info('Listening on %s:%d after %.1fms.' % (address + ((time.time() - start) * 1000,)))
+
+    # Sources are imported once the socket is bound
+    from gfs import GFS
+    from wafs import WAFS
+    from metar import Metar
+    from warmstart import WarmStart
+
+    executor.configure(conf.download_workers, conf.download_host_limit)
+    cache.configure(conf)
+
     # Weather classes
     gfs = GFS(conf)
     metar = Metar(conf)
+    metar.positions = clients.positions
     wafs = WAFS(conf)
 
-    # Init worker thread
-    worker = Worker([gfs, metar, wafs], conf.parserate)
-    worker.start()
+    # Source jobs, each source runs on its own lane
+    sources = [gfs, metar, wafs, StatsDump(stats, conf.server_stats_interval)]
+    scheduler = JobScheduler()
+    for source in sources:
+        source.register(scheduler)
+
+    # Adopt the cached files, discard partial downloads
+    for source in (gfs, metar, wafs):
+        cache.add_source(source)
+    cache.enforce(startup=True)
+    cache.register(scheduler)
+
+    if conf.server_shared:
+        clients.register(scheduler, server)
+
+    # Restore the last state before serving
+    warmstart = WarmStart(conf, gfs, wafs, metar)
+    warmstart.restore()
+    warmstart.register(scheduler)
 
-    print 'Server started.'
+    scheduler.start()
+    ready.set()
+
+    logger.info('Server started in %.1fms.' % ((time.time() - start) * 1000))
 
     # Server loop
     try:
-        server.serve_forever()
+        while server_thread.is_alive():
+            server_thread.join(1)
     except KeyboardInterrupt:
-        pass
-
-    # Close gfs worker and save config
-    worker.shutdown()
+        server.shutdown()
+
+    # Cancel downloads, stop the jobs and save config
+    for source in sources:
+        source.shutdown()
+    executor.shutdown()
+    scheduler.shutdown()
+    warmstart.save()
     conf.serverSave()
-    sys.stdout.flush()
-
-    print 'Server stopped.'
 
-    if not debug:
-        logfile.close()
+    logger.info('Server stopped.')
+    log.shutdown()
@@ -13,13 +13,22 @@ import ssl
 import urllib2
 import zlib
 import os
+import re
+import fnmatch
 import subprocess
-import sys
+import time
 from datetime import datetime, timedelta
 from tempfile import TemporaryFile
 
-from util import util
+from util import util, LRUCache
 from conf import Conf
+from stats import stats
+from executor import executor
+from cachemanager import cache
+from serverlog import log
+
+
+logger = log.logger('weathersource')
 
 
 class WeatherSource(object):
@@ -28,9 +37,10 @@ class WeatherSource(object):
     cache_path = False
 
     def __init__(self, conf):
-        self.download = False
         self.conf = conf
         self.die = threading.Event()
+        # Running executor tasks
+        self.futures = set()
 
         if not self.cache_path:
             self.cache_path = self.conf.cachepath
@@ -41,11 +51,28 @@ class WeatherSource(object):
     def shutdown(self):
         """Stop pending processes"""
         self.die.set()
-
-    def run(self, elapsed):
-        """Called by a worker thread"""
+        for future in list(self.futures):
+            future.cancel()
+
+    def submit(self, function, *args, **kwargs):
+        """Runs a task on the shared executor, canceled on shutdown. See Executor.submit"""
+        future = executor.submit(function, *args, **kwargs)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def register(self, scheduler):
+        """Adds the source jobs to the JobScheduler"""
         return
 
+    def cache_files(self):
+        """Returns the cached files in use, protected from the cache manager"""
+        return []
+
+    def superseded_files(self):
+        """Returns the cached files of older cycles, evicted by the cache manager"""
+        return []
+
 
 class GribWeatherSource(WeatherSource):
     """Grib file weather source"""
@@ -53,17 +80,58 @@ class GribWeatherSource(WeatherSource):
     cycles = range(0, 24, 6)
     publish_delay = {'hours': 4, 'minutes': 25}
     variable_list = []
-    download_wait = 0
     grib_conf_var = 'lastgrib'
+    grid_resolution = 0.5  # degrees
+    cache_pattern = '*'
 
     def __init__(self, conf):
         self.cache_path = os.path.sep.join([conf.cachepath, 'gfs'])
 
         super(GribWeatherSource, self).__init__(conf)
 
+        # Parsed data shared between all the server clients
+        self.name = self.__class__.__name__.lower()
+        self.parse_cache = LRUCache(conf.server_cache_size)
+        stats.register_cache(self.name, self.parse_cache)
+
         if self.last_grib and not os.path.isfile(os.path.sep.join([self.cache_path, self.last_grib])):
             self.last_grib = False
 
+        if not self.last_grib and not conf.download:
+            # Offline, use the newest cached file
+            self.last_grib = self.find_cached_grib()
+
+    def find_cached_grib(self):
+        """Returns the newest grib file of this source in the cache"""
+        files = sorted(fnmatch.filter(os.listdir(self.cache_path), self.cache_pattern))
+        if files:
+            return files[-1]
+        return False
+
+    def get_data(self, lat, lon):
+        """Returns the parsed grib data for a position using the shared cache
+
+        wgrib2 returns the nearest grid point value, positions are cached by grid node.
+        """
+        last_grib = self.last_grib
+        if not last_grib:
+            return False
+
+        key = (last_grib, int(round(lat / self.grid_resolution)), int(round(lon / self.grid_resolution)))
+        data = self.parse_cache.get(key)
+        if data is None:
+            data = self.parse_points([(lat, lon)], last_grib)[0]
+            self.parse_cache.set(key, data)
+
+        return data
+
+    def parse_points(self, points, grib=False):
+        """Parses a list of positions [(lat, lon), ] of the last or the specified grib file"""
+        grib_path = os.path.sep.join([self.cache_path, grib or self.last_grib])
+        cache.touch(grib_path)
+        with stats.timer('%s_parse' % self.name):
+            return self.parse_grib_points(grib_path, points)
+
     @classmethod
     def get_cycle_date(cls):
         """Returns last cycle date available"""
@@ -83,60 +151,62 @@ class GribWeatherSource(WeatherSource):
 
         return '%d%02d%02d' % (cnow.year, cnow.month, cnow.day), lcycle, forecast
 
-    def run(self, elapsed):
-        """Worker function called by a worker thread to update the data"""
+    def register(self, scheduler):
+        scheduler.add(self.name, self.update, lane=self.name, interval=600)
 
-        if not self.conf.download:
-            return
+    def cache_files(self):
+        if self.last_grib:
+            return [os.path.sep.join([self.cache_path, self.last_grib])]
+        return []
+
+    def superseded_files(self):
+        """Returns the cached grib files sorting before the current one: older cycles and forecasts"""
+        if not self.last_grib or self.conf.keepOldFiles or not os.path.isdir(self.cache_path):
+            return []
+        return [os.path.sep.join([self.cache_path, name])
+                for name in fnmatch.filter(os.listdir(self.cache_path), self.cache_pattern) if name < self.last_grib]
 
-        if self.download_wait:
-            self.download_wait -= elapsed
-            return
+    def update(self):
+        """Downloads the current cycle if not cached, returns the seconds to the next check"""
+
+        if not self.conf.download:
+            return None
 
         datecycle, cycle, forecast = self.get_cycle_date()
         cache_file = self.get_cache_filename(datecycle, cycle, forecast)
-
-        if not self.download:
-            cache_file_path = os.sep.join([self.cache_path, cache_file])
-
-            if self.last_grib == cache_file and os.path.isfile(cache_file_path):
-                # Nothing to do
-                return
-            else:
-                # Trigger new download
-                url = self.get_download_url(datecycle, cycle, forecast)
-                print 'Downloading: %s' % cache_file
-                self.download = AsyncTask(GribDownloader.download,
-                                          url,
-                                          cache_file_path,
-                                          binary=True,
-                                          variable_list=self.variable_list,
-                                          cancel_event=self.die,
-                                          decompress=self.conf.wgrib2bin,
-                                          spinfo=self.conf.spinfo)
-                self.download.start()
-        else:
-            if not self.download.pending():
-
-                self.download.join()
-                if isinstance(self.download.result, Exception):
-                    print 'Error Downloading Grib file: %s.' % str(self.download.result)
-                    if os.path.isfile(cache_file):
-                        util.remove(os.sep.join([self.cache_path, cache_file]))
-                    # wait a try again
-                    self.download_wait = 60
-                else:
-                    # New file available
-                    if not self.conf.keepOldFiles and self.last_grib:
-                        util.remove(os.path.sep.join([self.cache_path, self.last_grib]))
-                    self.last_grib = str(self.download.result.split(os.path.sep)[-1])
-                    print '%s successfully downloaded.' % self.last_grib
-
-                # reset download
-                self.download = False
-            else:
-                # Waiting for download
-                return
+        cache_file_path = os.sep.join([self.cache_path, cache_file])
+
+        if self.last_grib != cache_file or not os.path.isfile(cache_file_path):
+            url = self.get_download_url(datecycle, cycle, forecast)
+            logger.info('Downloading: %s' % cache_file)
+            path = self.submit(GribDownloader.download,
+                               url,
+                               cache_file_path,
+                               binary=True,
+                               variable_list=self.variable_list,
+                               decompress=self.conf.wgrib2bin,
+                               spinfo=self.conf.spinfo,
+                               host=url,
+                               timeout=self.conf.download_timeout,
+                               name=cache_file).result()
+
+            # New file available
+            if not self.conf.keepOldFiles and self.last_grib:
+                util.remove(os.path.sep.join([self.cache_path, self.last_grib]))
+            self.last_grib = str(path.split(os.path.sep)[-1])
+            logger.info('%s successfully downloaded.' % self.last_grib)
+
+        return self.next_change()
+
+    def next_change(self):
+        """Seconds until get_cycle_date can return a new cycle or forecast
+
+        The cycle date only changes on the hour or at the publish delay minutes past the hour.
+        """
+        now = datetime.utcnow()
+        elapsed = now.minute * 60 + now.second + now.microsecond / 1e6
+        waits = [(minutes * 60 - elapsed) % 3600 or 3600 for minutes in (0, self.publish_delay.get('minutes', 0))]
+        return min(waits) + 1
 
     def __getattr__(self, item):
         if item == 'last_grib':
@@ -149,86 +219,27 @@ class GribWeatherSource(WeatherSource):
         self.__dict__[key] = value
 
 
-class Worker(threading.Thread):
-    """Creates a new thread to periodically run worker functions on weather sources to trigger
-    data updating or other tasks
-
-    Attributes:
-        workers (list): Worker functions to be called
-        die (threading.Event): Se the flag to end the thread
-        rate (int): wait rate seconds between runs
-    """
-
-    def __init__(self, workers, rate):
-        self.workers = workers
-        self.die = threading.Event()
-        self.rate = rate
-        threading.Thread.__init__(self)
-
-    def run(self):
-        while not self.die.wait(self.rate):
-            for worker in self.workers:
-                worker.run(self.rate)
-
-        if self.die.isSet():
-            for worker in self.workers:
-                worker.shutdown()
-
-    def shutdown(self):
-        if self.is_alive():
-            self.die.set()
-            self.join(3)
-
-
-class AsyncTask(threading.Thread):
-    """Run an asynchronous task on a new thread
-
-    Attributes:
-        task (method): Worker method to be called
-        die (threading.Event): Set the flag to end the tasks
-        result (): return of the task method
-    """
-
-    def __init__(self, task, *args, **kwargs):
-
-        self.task = task
-        self.cancel = threading.Event()
-        self.kwargs = kwargs
-        self.args = args
-        self.result = False
-        threading.Thread.__init__(self)
-
-        self.pending = self.is_alive
-
-    def run(self):
-        try:
-            self.result = self.task(*self.args, **self.kwargs)
-        except Exception as result:
-            self.result = result
-        return
-
-    def stop(self):
-        if self.is_alive():
-            self.cancel.set()
-            self.join(3)
-
-
 class GribDownloader(object):
     """Grib download utilities"""
 
+    RE_PARAM = re.compile(r'\bparmcat=(?P<parmcat>[0-9]+) parm=(?P<parm>[0-9]+)')
+
     @staticmethod
     def decompress_grib(path_in, path_out, wgrib2bin, spinfo=False):
         """Unpacks grib file using wgrib2 binary
         """
 
         args = [wgrib2bin, path_in, '-set_grib_type', 'simple', '-grib_out', path_out]
-        kwargs = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        # The server stdout is the log, not a file
+        kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
 
         if spinfo:
             kwargs.update({'shell': True, 'startupinfo': spinfo})
 
         p = subprocess.Popen(args, **kwargs)
-        p.wait()
+        out = p.communicate()[0]
+        if p.returncode:
+            raise OSError('wgrib2 error %d: %s' % (p.returncode, out.strip()))
 
     @staticmethod
     def download_part(url, file_out, start=0, end=0, **kwargs):
@@ -244,6 +255,7 @@ class GribDownloader(object):
         Kwargs:
             cancel_event (threading.Event): Cancel download setting the flag
             user_agent (str): User-Agent HTTP header
+            socket_timeout (float): Seconds without data to fail
 
         """
 
@@ -262,7 +274,7 @@ class GribDownloader(object):
         else:
             params = {}
 
-        response = urllib2.urlopen(req, **params)
+        response = urllib2.urlopen(req, timeout=kwargs.pop('socket_timeout', 60), **params)
 
         gz = False
         if url[-3:] == '.gz' or response.headers.get('content-encoding', '').find('gzip') > -1:
@@ -270,6 +282,7 @@ class GribDownloader(object):
 
         cancel = kwargs.pop('cancel_event', False)
 
+        start = time.time()
         while True:
             if cancel and cancel.isSet():
                 raise GribDownloaderCancel("Download canceled by user.")
@@ -278,13 +291,30 @@ class GribDownloader(object):
             if not data:
                 # End of file
                 break
+            stats.incr('download_bytes', len(data))
             if gz:
                 data = gz.decompress(data)
             file_out.write(data)
 
-    @staticmethod
-    def to_download(level, var, variable_list):
+        stats.timing('download', time.time() - start)
+
+    @classmethod
+    def var_name(cls, var):
+        """Returns the variable of an index entry
+
+        Parameters without a wgrib2 name are indexed by number, ex:
+            var discipline=0 master_table=2 parmcat=19 parm=30
+        and are returned as 'parmcat=19 parm=30' to be listed in the variable list.
+        """
+        m = cls.RE_PARAM.search(var)
+        if m:
+            return 'parmcat=%s parm=%s' % m.groups()
+        return var
+
+    @classmethod
+    def to_download(cls, level, var, variable_list):
         """Returns true if level/var combination is in the download list"""
+        var = cls.var_name(var)
         for group in variable_list:
             if var in group['vars'] and level in group['levels']:
                 return True
@@ -331,13 +361,14 @@ class GribDownloader(object):
         Index sample:
             1:0:d=2020022418:HGT:100 mb:6 hour fcst:
             2:38409:d=2020022418:TMP:100 mb:6 hour fcst:
+            3:74560:d=2020101200:var discipline=0 master_table=2 parmcat=19 parm=30:300 mb:6 hour fcst:spatial max
 
         """
 
         index = []
         for line in iter(index_file):
-            cols = line.split(':')
-            if len(cols) != 7:
+            cols = line.rstrip('\r\n').split(':')
+            if len(cols) < 6:
                 raise RuntimeError("Bad GRIB file index format: Missing columns")
             try:
                 cols[1] = int(cols[1])
@@ -360,8 +391,12 @@ class GribDownloader(object):
             Kwargs:
                 cancel_event (threading.Event): Set the flat to cancel the download at any time
                 variable_list (list): List of variables dicts ex: [{'level': ['500mb', ], 'vars': 'TMP'}, ]
+                                      numbered parameters as 'parmcat=19 parm=30'
                 decompress (str): Path to the wgrib2 to decompress the file.
 
+            The file is downloaded to <file_path>.tmp and only renamed to file_path on success,
+            an interrupted download never leaves a partial file under the final name.
+
             Returns:
                 str: the path to the final file on success
 
@@ -387,28 +422,36 @@ class GribDownloader(object):
                 chunk_list = cls.gen_chunk_list(index, variable_list)
 
         flags = 'wb' if binary else 'w'
-
-        with open(file_path, flags) as grib_file:
-            if not variable_list:
-                # Fake chunk list for non filtered files
-                chunk_list = [[False, False]]
-
-            for chunk in chunk_list:
-                try:
-                    cls.download_part('%s' % url, grib_file, start=chunk[0], end=chunk[1], **kwargs)
-                except urllib2.URLError as err:
-                    raise GribDownloaderError('Unable to open url: %s\n\t%s' % (url, str(err)))
-
         wgrib2 = kwargs.pop('decompress', False)
         spinfo = kwargs.pop('spinfo', False)
-        if wgrib2:
-            tmp_file = "%s.tmp" % file_path
-            try:
-                os.rename(file_path, tmp_file)
-                cls.decompress_grib(tmp_file, file_path, wgrib2, spinfo)
-                util.remove(tmp_file)
-            except OSError as err:
-                raise GribDownloaderError('Unable to decompress: %s \n\t%s' % (file_path, str(err)))
+        tmp_file = '%s.tmp' % file_path
+        unpacked_file = '%s.unpacked.tmp' % file_path
+
+        try:
+            with open(tmp_file, flags) as grib_file:
+                if not variable_list:
+                    # Fake chunk list for non filtered files
+                    chunk_list = [[False, False]]
+
+                for chunk in chunk_list:
+                    try:
+                        cls.download_part('%s' % url, grib_file, start=chunk[0], end=chunk[1], **kwargs)
+                    except urllib2.URLError as err:
+                        raise GribDownloaderError('Unable to open url: %s\n\t%s' % (url, str(err)))
+
+            if wgrib2:
+                try:
+                    cls.decompress_grib(tmp_file, unpacked_file, wgrib2, spinfo)
+                    util.remove(tmp_file)
+                    tmp_file = unpacked_file
+                except OSError as err:
+                    raise GribDownloaderError('Unable to decompress: %s \n\t%s' % (file_path, str(err)))
+
+            util.replace(tmp_file, file_path)
+        finally:
+            for path in (tmp_file, unpacked_file):
+                if os.path.isfile(path):
+                    util.remove(path)
 
         return file_path
 
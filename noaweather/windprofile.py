@@ -0,0 +1,165 @@
+"""
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+from bisect import bisect_right
+
+from c import c
+
+
+class WindProfile(object):
+    """Vertical wind and temperature profile precomputed for per frame lookups
+
+    Built once for each weather data: layer altitudes are sorted and every interval has its
+    deltas, inverse height and interpolation exponents ready, a lookup is a bisect and a few
+    multiplications. Temperatures are stored as sea level equivalents.
+    """
+
+    __slots__ = ('alts', 'hdg', 'speed', 'gust', 'temp', 'dew',
+                 'inv', 'dhdg', 'dspeed', 'dgust', 'dtemp', 'ddew', 'hexpo', 'sexpo', 'xexpo',
+                 'variation', 'values', 'size')
+
+    def __init__(self, layers, variation=0):
+        """Layers: sorted list of [alt, hdg, speed, gust, msl temp or None, msl dew or None]"""
+
+        self.alts = [layer[0] for layer in layers]
+        self.hdg = [layer[1] for layer in layers]
+        self.speed = [layer[2] for layer in layers]
+        self.gust = [layer[3] for layer in layers]
+        self.temp = self.fill([layer[4] for layer in layers])
+        self.dew = self.fill([layer[5] for layer in layers])
+        self.size = len(layers)
+
+        # Variable wind range of the first (METAR) layer
+        self.variation = variation
+
+        self.inv, self.dhdg, self.dspeed, self.dgust, self.dtemp, self.ddew = [], [], [], [], [], []
+        self.hexpo, self.sexpo, self.xexpo = [], [], []
+
+        # Intervals are interpolated from the top layer (t) to the bottom one (b)
+        for b in range(self.size - 1):
+            t = b + 1
+            height = self.alts[t] - self.alts[b]
+            self.inv.append(1.0 / height if height else 0)
+            self.dhdg.append(c.shortHdg(self.hdg[t], self.hdg[b]))
+            self.dspeed.append(self.speed[b] - self.speed[t])
+            self.dgust.append(self.gust[b] - self.gust[t])
+            self.dtemp.append(self.temp[b] - self.temp[t] if self.temp[t] is not None else 0)
+            self.ddew.append(self.dew[b] - self.dew[t] if self.dew[t] is not None else 0)
+
+            # Weight heading interpolation using wind speed
+            if self.speed[t] or self.speed[b]:
+                self.hexpo.append(2.0 * self.speed[t] / (self.speed[t] + self.speed[b]))
+            else:
+                self.hexpo.append(1)
+
+            # The first layer transition to the ground is exponential
+            self.sexpo.append(self.hexpo[-1] if b == 0 else 1)
+            self.xexpo.append(3 if b == 0 else 1)
+
+        # Lookup output: hdg, speed, gust, msl temp, msl dew, variation weight
+        self.values = [0, 0, 0, None, None, 0]
+
+    @staticmethod
+    def fill(values):
+        """Fills missing values with the next layer above or the closest below"""
+        last = None
+        for i in reversed(range(len(values))):
+            if values[i] is None:
+                values[i] = last
+            else:
+                last = values[i]
+
+        last = None
+        for i in range(len(values)):
+            if values[i] is None:
+                values[i] = last
+            else:
+                last = values[i]
+        return values
+
+    @classmethod
+    def build(cls, winds, metar=None, metar_agl_limit=10):
+        """Builds the profile from GFS wind layers and the METAR surface layer
+
+        Args:
+            winds (list): GFS wind layers [[alt, hdg, speed, extra], ]
+            metar (dict): parsed METAR
+            metar_agl_limit (float): METAR layer height over the airport in meters
+        """
+        layers = []
+        variation = 0
+
+        for alt, hdg, speed, extra in winds:
+            temp, dew = extra.get('temp'), extra.get('dew')
+            layers.append([alt, hdg, speed, extra.get('gust', 0) or 0,
+                           c.oat2msltemp(temp - 273.15, alt) if temp else None,
+                           c.oat2msltemp(dew - 273.15, alt) if dew else None])
+
+        if metar and 'wind' in metar:
+            alt = metar['elevation'] + metar_agl_limit
+            hdg, speed, gust = metar['wind']
+
+            if metar.get('variable_wind'):
+                h1, h2 = metar['variable_wind']
+                h1 %= 360
+                if h1 > h2:
+                    variation = 360 - h1 + h2
+                else:
+                    variation = h2 - h1
+                hdg = h1
+
+            temp, dew = None, None
+            if 'temperature' in metar:
+                if metar['temperature'][0] is not False:
+                    temp = c.oat2msltemp(metar['temperature'][0], alt)
+                if metar['temperature'][1] is not False:
+                    dew = c.oat2msltemp(metar['temperature'][1], alt)
+
+            # remove first wind layer if is too close (for high altitude airports)
+            if len(layers) > 1 and layers[0][0] < alt + metar_agl_limit:
+                layers.pop(0)
+
+            layers = [[alt, hdg, speed, gust, temp, dew]] + layers
+
+        layers.sort(key=lambda layer: layer[0])
+
+        return cls(layers, variation)
+
+    def lookup(self, alt):
+        """Returns [hdg, speed, gust, msl temp, msl dew, variation weight] at an altitude
+
+        The returned list is reused on every call.
+        """
+        values = self.values
+        alts = self.alts
+        b = bisect_right(alts, alt) - 1
+
+        if b < 0 or b >= self.size - 1:
+            # Below the first layer or above the last one
+            i = 0 if b < 0 else self.size - 1
+            values[0], values[1], values[2] = self.hdg[i], self.speed[i], self.gust[i]
+            values[3], values[4] = self.temp[i], self.dew[i]
+            values[5] = 1 if i == 0 else 0
+            return values
+
+        t = b + 1
+        # 0 at the top layer, 1 at the bottom one
+        x = (alts[t] - alt) * self.inv[b]
+
+        values[0] = (self.hdg[t] + self.dhdg[b] * x ** self.hexpo[b]) % 360
+        values[1] = self.speed[t] + self.dspeed[b] * x ** self.sexpo[b]
+
+        xe = x ** self.xexpo[b]
+        values[2] = self.gust[t] + self.dgust[b] * xe
+        values[3] = self.temp[t] + self.dtemp[b] * xe if self.temp[t] is not None else None
+        values[4] = self.dew[t] + self.ddew[b] * xe if self.dew[t] is not None else None
+        values[5] = xe if b == 0 else 0
+
+        return values
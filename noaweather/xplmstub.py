@@ -0,0 +1,392 @@
+"""
+In memory X-Plane SDK stub to run the plugin outside X-Plane
+
+Emulates the subset of the Sandy Barbour python interface used by the plugin: datarefs
+(plain and registered accessors), flight loop callbacks, commands, menus and widgets.
+install() registers the SDK modules in sys.modules, it must be called before importing the plugin.
+
+X-plane NOAA GFS weather plugin.
+Copyright (C) 2020 Joan Perez i Cauhe
+---
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or any later version.
+"""
+
+import os
+import sys
+import types
+
+MODULES = ['XPLMDefs', 'XPLMProcessing', 'XPLMDataAccess', 'XPLMUtilities', 'XPLMPlanes', 'XPLMNavigation',
+           'SandyBarbourUtilities', 'PythonScriptMessaging', 'XPLMPlugin', 'XPLMMenus', 'XPWidgetDefs',
+           'XPWidgets', 'XPStandardWidgets']
+
+# SDK calls counter by function name
+calls = {}
+
+xplmType_Int, xplmType_Float, xplmType_Double = 1, 2, 4
+xplmType_FloatArray, xplmType_IntArray, xplmType_DataArray = 8, 16, 32
+
+XPLM_NO_PLUGIN_ID = -1
+XPLM_PLUGIN_XPLANE = 0
+XPLM_MSG_AIRPORT_LOADED = 103
+
+
+class Dataref(object):
+    """A dataref value or an accessor of a registered dataref"""
+
+    def __init__(self, name, value=0.0, accessor=None):
+        self.name = name
+        self.value = value
+        self.accessor = accessor
+
+
+class State(object):
+    """SDK state shared by all the stub functions"""
+
+    def __init__(self):
+        self.system_path = os.sep
+        self.datarefs = {}
+        self.flight_loops = []
+        self.widgets = {}
+        self.commands = {}
+        self.fms = []
+        self.next_id = 1
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+
+state = State()
+
+
+def count(name):
+    calls[name] = calls.get(name, 0) + 1
+
+
+def dataref(name, value=None):
+    """Returns the stub dataref, created on first access"""
+    if name not in state.datarefs:
+        state.datarefs[name] = Dataref(name, 0.0)
+    if value is not None:
+        state.datarefs[name].value = value
+    return state.datarefs[name]
+
+
+def set_dataref(name, value):
+    """Sets a dataref value from the harness"""
+    dataref(name).value = value
+
+
+def run_flight_loops(elapsed, counter=0):
+    """Calls the registered flight loop callbacks like x-plane does each frame"""
+    for plugin, callback, interval, refcon in list(state.flight_loops):
+        callback(elapsed, elapsed, counter, refcon)
+
+
+# XPLMDataAccess
+
+def XPLMFindDataRef(name):
+    count('XPLMFindDataRef')
+    return dataref(name)
+
+
+def _get(ref):
+    if ref.accessor:
+        return ref.accessor['get'](ref.accessor['refcon'])
+    return ref.value
+
+
+def _set(ref, value):
+    if ref.accessor:
+        if ref.accessor['set']:
+            ref.accessor['set'](ref.accessor['refcon'], value)
+    else:
+        ref.value = value
+
+
+def XPLMGetDatai(ref):
+    count('XPLMGetDatai')
+    return int(_get(ref))
+
+
+def XPLMGetDataf(ref):
+    count('XPLMGetDataf')
+    return float(_get(ref))
+
+
+def XPLMGetDatad(ref):
+    count('XPLMGetDatad')
+    return float(_get(ref))
+
+
+def XPLMSetDatai(ref, value):
+    count('XPLMSetDatai')
+    _set(ref, int(value))
+
+
+def XPLMSetDataf(ref, value):
+    count('XPLMSetDataf')
+    _set(ref, float(value))
+
+
+def XPLMSetDatad(ref, value):
+    count('XPLMSetDatad')
+    _set(ref, float(value))
+
+
+def _getv(ref, values, offset, limit):
+    if ref.accessor:
+        return ref.accessor['rget'](ref.accessor['refcon'], values, offset, limit)
+    if not isinstance(ref.value, list):
+        ref.value = []
+    items = ref.value[offset:offset + limit]
+    values.extend(items)
+    return len(items)
+
+
+def _setv(ref, values, offset, n):
+    if ref.accessor:
+        if ref.accessor['rset']:
+            ref.accessor['rset'](ref.accessor['refcon'], values, offset, n)
+        return
+    if not isinstance(ref.value, list):
+        ref.value = []
+    if len(ref.value) < offset + n:
+        ref.value.extend([0] * (offset + n - len(ref.value)))
+    ref.value[offset:offset + n] = values[:n]
+
+
+def XPLMGetDatavf(ref, values, offset, limit):
+    count('XPLMGetDatavf')
+    return _getv(ref, values, offset, limit)
+
+
+def XPLMGetDatavi(ref, values, offset, limit):
+    count('XPLMGetDatavi')
+    return _getv(ref, values, offset, limit)
+
+
+def XPLMGetDatab(ref, values, offset, limit):
+    count('XPLMGetDatab')
+    return _getv(ref, values, offset, limit)
+
+
+def XPLMSetDatavf(ref, values, offset, n):
+    count('XPLMSetDatavf')
+    _setv(ref, values, offset, n)
+
+
+def XPLMSetDatavi(ref, values, offset, n):
+    count('XPLMSetDatavi')
+    _setv(ref, values, offset, n)
+
+
+def XPLMSetDatab(ref, values, offset, n):
+    count('XPLMSetDatab')
+    _setv(ref, values, offset, n)
+
+
+def XPLMRegisterDataAccessor(plugin, name, type, writable, geti, seti, getf, setf, getd, setd,
+                             getvi, setvi, getvf, setvf, getb, setb, readrefcon, writerefcon):
+    count('XPLMRegisterDataAccessor')
+    accessor = {'get': geti or getf or getd, 'set': seti or setf or setd,
+                'rget': getvi or getvf or getb, 'rset': setvi or setvf or setb, 'refcon': readrefcon}
+    ref = dataref(name)
+    ref.accessor = accessor
+    return ref
+
+
+def XPLMUnregisterDataAccessor(plugin, ref):
+    ref.accessor = None
+
+
+# XPLMProcessing
+
+def XPLMRegisterFlightLoopCallback(plugin, callback, interval, refcon):
+    state.flight_loops.append((plugin, callback, interval, refcon))
+
+
+def XPLMUnregisterFlightLoopCallback(plugin, callback, refcon):
+    state.flight_loops = [loop for loop in state.flight_loops if loop[1] != callback]
+
+
+# XPLMUtilities
+
+def XPLMGetSystemPath(path):
+    path.append(state.system_path)
+    return state.system_path
+
+
+def XPLMGetVersions():
+    return 11550, 301, 1
+
+
+def XPLMCreateCommand(name, description):
+    state.commands[name] = []
+    return name
+
+
+def XPLMRegisterCommandHandler(plugin, command, handler, before, refcon):
+    state.commands.setdefault(command, []).append(handler)
+
+
+def XPLMUnregisterCommandHandler(plugin, command, handler, before, refcon):
+    if handler in state.commands.get(command, []):
+        state.commands[command].remove(handler)
+
+
+# XPLMPlugin
+
+def XPLMFindPluginBySignature(signature):
+    return XPLM_NO_PLUGIN_ID
+
+
+def XPLMSendMessageToPlugin(plugin, message, param):
+    pass
+
+
+# XPLMNavigation
+
+def XPLMCountFMSEntries():
+    return len(state.fms)
+
+
+def XPLMGetFMSEntryInfo(index, type, id, ref, alt, lat, lon):
+    entry = state.fms[index]
+    type.append(1)
+    id.append('WPT%d' % index)
+    ref.append(0)
+    alt.append(entry[2] if len(entry) > 2 else 0)
+    lat.append(entry[0])
+    lon.append(entry[1])
+
+
+# XPLMMenus
+
+def XPLMFindPluginsMenu():
+    return 0
+
+
+def XPLMAppendMenuItem(menu, name, ref, deprecated):
+    return state.new_id()
+
+
+def XPLMCreateMenu(plugin, name, parent, item, handler, refcon):
+    return state.new_id()
+
+
+def XPLMDestroyMenu(plugin, menu):
+    pass
+
+
+# SandyBarbourUtilities
+
+def PI_GetKeyState(param):
+    return param, 0, 0
+
+
+# XPWidgets
+
+class Widget(object):
+    def __init__(self, descriptor, visible, parent, cls):
+        self.descriptor = descriptor
+        self.visible = visible
+        self.parent = parent
+        self.cls = cls
+        self.properties = {}
+        self.callbacks = []
+
+
+def XPCreateWidget(left, top, right, bottom, visible, descriptor, root, container, cls):
+    count('XPCreateWidget')
+    wid = state.new_id()
+    state.widgets[wid] = Widget(descriptor, visible, container, cls)
+    return wid
+
+
+def XPDestroyWidget(plugin, widget, children):
+    if children:
+        for wid in [wid for wid, w in state.widgets.items() if w.parent == widget]:
+            XPDestroyWidget(plugin, wid, 1)
+    state.widgets.pop(widget, None)
+
+
+def XPSetWidgetDescriptor(widget, descriptor):
+    count('XPSetWidgetDescriptor')
+    state.widgets[widget].descriptor = descriptor
+
+
+def XPGetWidgetDescriptor(widget, buff, maxlen):
+    count('XPGetWidgetDescriptor')
+    buff.append(state.widgets[widget].descriptor[:maxlen])
+    return len(buff[-1])
+
+
+def XPSetWidgetProperty(widget, prop, value):
+    state.widgets[widget].properties[prop] = value
+
+
+def XPGetWidgetProperty(widget, prop, exists):
+    return state.widgets[widget].properties.get(prop, 0)
+
+
+def XPIsWidgetVisible(widget):
+    count('XPIsWidgetVisible')
+    return widget in state.widgets and state.widgets[widget].visible
+
+
+def XPShowWidget(widget):
+    state.widgets[widget].visible = 1
+
+
+def XPHideWidget(widget):
+    state.widgets[widget].visible = 0
+
+
+def XPAddWidgetCallback(plugin, widget, callback):
+    state.widgets[widget].callbacks.append(callback)
+
+
+def XPSetKeyboardFocus(widget):
+    pass
+
+
+def XPLoseKeyboardFocus(widget):
+    pass
+
+
+def _constant(name):
+    """Widget constants only need to be unique"""
+    return abs(hash(name)) % 100000 + 1000
+
+
+def install(system_path=False):
+    """Registers the stub as the SDK modules"""
+    if system_path:
+        state.system_path = system_path if system_path.endswith(os.sep) else system_path + os.sep
+
+    namespace = dict((name, value) for name, value in globals().items()
+                     if name.startswith(('XP', 'xp', 'PI_')))
+
+    # Standard widgets constants
+    for name in ['xpWidgetClass_MainWindow', 'xpWidgetClass_SubWindow', 'xpWidgetClass_Button',
+                 'xpWidgetClass_TextField', 'xpWidgetClass_Caption', 'xpWidgetClass_ScrollBar',
+                 'xpProperty_MainWindowType', 'xpProperty_MainWindowHasCloseBoxes', 'xpProperty_SubWindowType',
+                 'xpProperty_ButtonType', 'xpProperty_ButtonBehavior', 'xpProperty_ButtonState',
+                 'xpProperty_TextFieldType', 'xpProperty_Enabled', 'xpProperty_CaptionLit',
+                 'xpProperty_EditFieldSelStart', 'xpProperty_EditFieldSelEnd', 'xpProperty_ScrollBarType',
+                 'xpProperty_ScrollBarSliderPosition', 'xpProperty_ScrollBarMin', 'xpProperty_ScrollBarMax',
+                 'xpProperty_ScrollBarPageAmount', 'xpMainWindowStyle_Translucent', 'xpSubWindowStyle_SubWindow',
+                 'xpPushButton', 'xpRadioButton', 'xpButtonBehaviorCheckBox', 'xpTextEntryField',
+                 'xpTextTranslucent', 'xpScrollBarTypeSlider', 'xpMsg_PushButtonPressed',
+                 'xpMessage_CloseButtonPushed', 'xpMsg_ButtonStateChanged', 'xpMsg_ScrollBarSliderPositionChanged',
+                 'xpMsg_KeyPress', 'xpMsg_MouseDown', 'xpMsg_MouseUp', 'xpMsg_MouseDrag']:
+        namespace[name] = _constant(name)
+
+    for name in MODULES:
+        module = types.ModuleType(name)
+        module.__dict__.update(namespace)
+        sys.modules[name] = module